@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+from PIL import Image
+
+import collections
+import threading
+import os
+import logging
+
+logger = logging.getLogger("photobooth")
+
+def pad_image(img):
+    """
+    Return the image data padded to the camera`s block size and the original image size
+
+    "The camera`s block size is 32x16 so any image data
+     provided to a renderer must have a width which is a
+     multiple of 32, and a height which is a multiple of
+     16."
+     Refer: http://picamera.readthedocs.io/en/release-1.10/recipes1.html#overlaying-images-on-the-preview
+    """
+
+    # Create an image padded to the required size with
+    # mode 'RGB'
+    pad = Image.new('RGB', (
+        ((img.size[0] + 31) // 32) * 32,
+        ((img.size[1] + 15) // 16) * 16,
+    ))
+
+    # Paste the original image into the padded one
+    pad.paste(img, (0, 0))
+
+    #Get the padded image data
+    try:
+        padded_img_data = pad.tobytes()
+    except AttributeError:
+        padded_img_data = pad.tostring() # Note: tostring() is deprecated in PIL v3.x
+
+    return padded_img_data, img.size
+
+
+class AssetCache:
+    """
+    Keeps the decoded and padded overlay images in memory
+    (LRU with a memory limit, reloaded when the file changes)
+    """
+
+    max_bytes = 32 * 1024 * 1024
+
+    def __init__(self, config = None):
+        if config is not None and hasattr(config, "asset_cache_size"):
+            self.max_bytes = config.asset_cache_size
+
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def preload(self, folder):
+        for name in sorted(os.listdir(folder)):
+            if name.lower().endswith(('.png', '.jpg', '.jpeg')):
+                self.get(os.path.join(folder, name))
+        logger.info("Preloaded assets from %s (%s KB)", folder, self.size // 1024)
+
+    def get(self, path):
+        """
+        Return the padded image data and the original size of the image file
+        """
+        mtime = os.stat(path).st_mtime
+
+        with self.lock:
+            entry = self.entries.get(path)
+            if entry is not None and entry[0] == mtime:
+                self.entries.move_to_end(path)
+                self.hits += 1
+                return entry[1], entry[2]
+            self.misses += 1
+
+        with Image.open(path) as img:
+            data, size = pad_image(img)
+
+        with self.lock:
+            if path in self.entries:
+                self.size -= len(self.entries.pop(path)[1])
+            # an image which is larger than the whole cache is not stored
+            if len(data) <= self.max_bytes:
+                self.entries[path] = (mtime, data, size)
+                self.size += len(data)
+                while self.size > self.max_bytes:
+                    _, evicted = self.entries.popitem(last=False)
+                    self.size -= len(evicted[1])
+                    self.evictions += 1
+
+        return data, size
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes": self.size,
+            }
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+
+from time import time, monotonic
+
+import threading
+import collections
+import hashlib
+import json
+import os
+import shutil
+import logging
+
+from Metrics import metrics
+
+logger = logging.getLogger("photobooth")
+
+class BackupJournal:
+    """
+    Append-only journal of the pending copies (one json object per line)
+    so that copies which were not finished are done after a restart.
+    The journal is rewritten with the pending copies only when it is loaded
+    and after compact_after finished copies, so that it does not grow during a long event.
+    """
+
+    compact_after   = 500
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.pending = collections.OrderedDict()
+        self.finished = 0       # finished copies since the last compaction
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.filename):
+            return
+        with open(self.filename) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # the last line can be incomplete after a power cut
+                    continue
+                if entry.get("op") == "add":
+                    self.pending[entry["id"]] = entry
+                else:
+                    self.pending.pop(entry["id"], None)
+
+        with self.lock:
+            self.compact()
+
+    def compact(self):
+        """
+        Rewrite the journal with the pending copies only (must be called with the lock)
+        """
+        with open(self.filename + ".tmp", "w") as f:
+            for entry in self.pending.values():
+                f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.filename + ".tmp", self.filename)
+        self.finished = 0
+
+    def write(self, entry):
+        # must be called with the lock, so that a compaction does not drop the entry
+        with open(self.filename, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def add(self, item_id, src, dest):
+        entry = {"op": "add", "id": item_id, "src": src, "dest": dest, "time": time()}
+        with self.lock:
+            self.write(entry)
+            self.pending[item_id] = entry
+
+    def done(self, item_id, checksum = None, error = None):
+        with self.lock:
+            self.write({"op": "done", "id": item_id, "checksum": checksum, "error": error})
+            self.pending.pop(item_id, None)
+            self.finished += 1
+            if self.finished >= self.compact_after:
+                self.compact()
+
+    def get_pending(self):
+        with self.lock:
+            return list(self.pending.values())
+
+
+class BackupDestination:
+    """
+    Worker thread which copies the files into one destination folder
+    """
+
+    fsync_policy    = "file"    # "file": fsync every file, "idle": sync once the queue is empty, "never"
+    checksum        = "sha1"
+    chunk_size      = 1024 * 1024
+    retries         = 5         # retries of a failing copy while the destination is available
+    backoff_min     = 1
+    backoff_max     = 60
+
+    def __init__(self, folder, journal, config = None, on_copied = None, on_failed = None):
+        self.folder = folder
+        self.journal = journal
+        self.on_copied = on_copied
+        self.on_failed = on_failed
+
+        if config is not None:
+            if hasattr(config, "backup_fsync"):
+                self.fsync_policy = config.backup_fsync
+            if hasattr(config, "backup_checksum"):
+                self.checksum = config.backup_checksum
+            if hasattr(config, "backup_retries"):
+                self.retries = config.backup_retries
+            if hasattr(config, "backup_backoff_max"):
+                self.backoff_max = config.backup_backoff_max
+
+        self.items = collections.deque()
+        self.condition = threading.Condition()
+        self.running = True
+        self.available = True
+
+        # statistics
+        self.copied = 0
+        self.failed = 0
+        self.bytes_copied = 0
+        self.seconds_copying = 0.0
+
+        self.thread = threading.Thread(target=self.run, name="backup " + folder, daemon=True)
+        self.thread.start()
+
+    def enqueue(self, item):
+        with self.condition:
+            self.items.append(item)
+            self.condition.notify()
+
+    def queue_depth(self):
+        with self.condition:
+            return len(self.items)
+
+    def throughput(self):
+        """
+        Average copy throughput in bytes per second
+        """
+        if self.seconds_copying == 0:
+            return 0.0
+        return self.bytes_copied / self.seconds_copying
+
+    def stats(self):
+        return {
+            "queue": self.queue_depth(),
+            "copied": self.copied,
+            "failed": self.failed,
+            "bytes": self.bytes_copied,
+            "throughput": self.throughput(),
+            "available": self.available,
+        }
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and not self.items:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                item = self.items[0]
+
+            self.process(item)
+
+            with self.condition:
+                self.items.popleft()
+                idle = not self.items
+            if idle and self.fsync_policy == "idle":
+                os.sync()
+
+    def wait(self, seconds):
+        """
+        Sleep but wake up when the destination is stopped
+        """
+        with self.condition:
+            if self.running:
+                self.condition.wait(seconds)
+            return self.running
+
+    def process(self, item):
+        backoff = self.backoff_min
+        attempts = 0
+        while True:
+            if not os.path.exists(item["src"]):
+                logger.error("Backup source %s does not exist anymore", item["src"])
+                self.fail(item, "missing source")
+                return
+
+            # the destination (e.g. an usb stick) can disappear and come back later
+            if not os.path.isdir(self.folder):
+                if self.available:
+                    print("Backup folder %s is not available" % self.folder)
+                    logger.warning("Backup folder %s is not available, retrying", self.folder)
+                self.available = False
+            else:
+                self.available = True
+                try:
+                    checksum = self.copy(item["src"])
+                    self.copied += 1
+                    self.journal.done(item["id"], checksum)
+                    if self.on_copied is not None:
+                        self.on_copied(item, checksum)
+                    return
+                except (IOError, OSError) as e:
+                    attempts += 1
+                    print("Error: %s" % e)
+                    logger.error('Error copying %s -> %s: %s ', item["src"], self.folder, e)
+                    if attempts > self.retries:
+                        self.fail(item, str(e))
+                        return
+
+            if not self.wait(backoff):
+                # stopped, the copy stays in the journal
+                return
+            backoff = min(backoff * 2, self.backoff_max)
+
+    def fail(self, item, error):
+        self.failed += 1
+        self.journal.done(item["id"], error=error)
+        if self.on_failed is not None:
+            self.on_failed(item, error)
+
+    def copy(self, src):
+        """
+        Copy src into the folder and compute the checksum while copying
+        so that the file does not have to be read again for verification
+        """
+        start = monotonic()
+        dest = os.path.join(self.folder, os.path.basename(src))
+        temp = dest + ".part"
+        digest = hashlib.new(self.checksum)
+        size = 0
+
+        with open(src, "rb") as fsrc, open(temp, "wb") as fdest:
+            while True:
+                chunk = fsrc.read(self.chunk_size)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                fdest.write(chunk)
+                size += len(chunk)
+            if self.fsync_policy == "file":
+                fdest.flush()
+                os.fsync(fdest.fileno())
+
+        shutil.copystat(src, temp)
+        os.replace(temp, dest)
+
+        self.bytes_copied += size
+        self.seconds_copying += monotonic() - start
+        metrics.observe("backup_copy", monotonic() - start, destination=self.folder)
+        print(src + ' -> ' + dest)
+        logger.info('Copied %s -> %s (%s %s)', src, dest, self.checksum, digest.hexdigest())
+        return digest.hexdigest()
+
+
+class Backup:
+    """
+    Copies the images into the folders of config.images_folder_copy
+    with one worker per destination and a persistent journal of the pending copies
+    """
+
+    journal_file = os.path.dirname(os.path.realpath(__file__)) + '/backup_journal.jsonl'
+
+    def __init__(self, config, on_copied = None, on_failed = None):
+        if hasattr(config, "backup_journal"):
+            self.journal_file = config.backup_journal
+
+        self.counter = 0
+        self.lock = threading.Lock()
+        self.journal = BackupJournal(self.journal_file)
+        self.destinations = {}
+        if hasattr(config, "images_folder_copy") and isinstance(config.images_folder_copy, list):
+            for folder in config.images_folder_copy:
+                self.destinations[folder] = BackupDestination(folder, self.journal, config, on_copied, on_failed)
+
+        # copies which were not finished before the last shutdown
+        for entry in self.journal.get_pending():
+            if entry["dest"] in self.destinations:
+                logger.info("Resume backup %s -> %s", entry["src"], entry["dest"])
+                self.destinations[entry["dest"]].enqueue(entry)
+            else:
+                self.journal.done(entry["id"], error="destination removed from config")
+
+    def next_id(self):
+        with self.lock:
+            self.counter += 1
+            return "%d-%d" % (int(time() * 1000), self.counter)
+
+    def submit(self, files):
+        for dest, destination in self.destinations.items():
+            for src in files:
+                item_id = self.next_id()
+                self.journal.add(item_id, src, dest)
+                destination.enqueue({"id": item_id, "src": src, "dest": dest})
+                logger.info('Queued copy %s -> %s', src, dest)
+
+    def stats(self):
+        return {dest: destination.stats() for dest, destination in self.destinations.items()}
+
+    def log_stats(self):
+        for dest, stats in self.stats().items():
+            logger.info("Backup %s: %s queued, %s copied, %s failed, %.0f KB/s",
+                dest, stats["queue"], stats["copied"], stats["failed"], stats["throughput"] / 1024)
+
+    def stop(self):
+        for destination in self.destinations.values():
+            destination.stop()
+        for destination in self.destinations.values():
+            destination.thread.join(1)
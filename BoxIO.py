@@ -1,10 +1,14 @@
 #!/usr/bin/env python3
 
 import RPi.GPIO as GPIO
-from time import sleep
-import cups
+from time import perf_counter, time
 import logging
 
+from PrinterMonitor import PrinterMonitor
+from PrintQueue import PrintQueue
+from OutputScheduler import OutputScheduler
+from Metrics import metrics
+
 logger = logging.getLogger("photobooth")
 
 class BoxIO:
@@ -22,6 +26,7 @@ class BoxIO:
     led_dome    = None     # pin that the big dome led is attached to
     
     relay       = None     # pin that the relay for enable the printer is connected
+    relay_time  = 2        # seconds the relay is closed
     
     btn_print_pressed       = False
     btn_dome_pressed        = False
@@ -35,14 +40,21 @@ class BoxIO:
     btn_exit_enabled        = False
     btn_relay_enabled       = False
     
+    event_loop      = None     # button presses are posted as events when set
+    
     conn            = None
     default_printer = None
-    print_job_id    = None
-    document        = None
+    monitor         = None
+    print_queue     = None
+    print_job       = None     # handle of the last print request
+    print_span      = None     # from the first queued print until all prints are done
 
     def __init__(self, config):
     
         logger.info("Init Buttons")
+        
+        # time of the last press per event for the button latency
+        self.pressed_at = {}
     
         if hasattr(config, "btn_single"):
             self.btn_single = config.btn_single
@@ -66,9 +78,14 @@ class BoxIO:
             self.led_dome = config.led_dome
         if hasattr(config, "relay"):
             self.relay = config.relay
+        if hasattr(config, "relay_time"):
+            self.relay_time = config.relay_time
                 
         GPIO.setmode(GPIO.BCM)
         
+        # relay pulses and LED blinking run in the timer thread of the scheduler
+        self.outputs = OutputScheduler(GPIO.output)
+        
         if not self.btn_single is None:
             GPIO.setup(self.btn_single, GPIO.IN, pull_up_down=GPIO.PUD_UP)
             
@@ -103,17 +120,8 @@ class BoxIO:
             GPIO.setup(self.led_dome,   GPIO.OUT)
             
             
-        # Start printer with relay
-        # the printer is connected to NO which means HIGH is holding this state and LOW is closing the relay
         if not self.relay is None:
             GPIO.setup(self.relay, GPIO.OUT, initial=GPIO.HIGH)
-            self.trigger_relay()
-
-        self.conn = cups.Connection()
-        self.default_printer = self.conn.getDefault()
-        cups.setUser('pi')
-        self.enable_printer()
-        self.conn.cancelAllJobs(self.default_printer)
         
         self.enable_button_exit()
         self.enable_button_relay()
@@ -207,10 +215,10 @@ class BoxIO:
         self.image_mode_multi = False
         
         if not self.led_single is None:
-            GPIO.output(self.led_single, True)
+            self.outputs.set(self.led_single, True)
             
         if not self.led_multi is None:
-            GPIO.output(self.led_multi, False)
+            self.outputs.set(self.led_multi, False)
         
 
     def btn_multi_press(self, channel):
@@ -220,26 +228,29 @@ class BoxIO:
         self.image_mode_multi = True
         
         if not self.led_single is None:
-            GPIO.output(self.led_single, False)
+            self.outputs.set(self.led_single, False)
         
         if not self.led_multi is None:
-            GPIO.output(self.led_multi, True)
+            self.outputs.set(self.led_multi, True)
 
     def btn_print_press(self, channel):
         print("Button Print pressed") 
         logger.info("Button Print pressed")
         self.btn_print_pressed = True
         self.set_print_led(True)
+        self.post("print")
         
     def btn_exit_press(self, channel):
         print("Button Exit pressed")   
         logger.info("Button Exit pressed")        
         self.btn_exit_pressed = True    
+        self.post("exit")
 
     def btn_dome_press(self, channel):
         print("Button Dome pressed") 
         logger.info("Button Dome pressed")
         self.btn_dome_pressed  = True
+        self.post("dome")
         
     def btn_relay_press(self, channel):
         print("Button Relay pressed")
@@ -247,6 +258,60 @@ class BoxIO:
         self.trigger_relay()   
         
         
+    def start_printer(self, config):
+        """
+        Switch the printer on and connect to CUPS
+        (called from its own startup stage because the relay and CUPS are slow)
+        """
+        # pycups is imported here so that it does not delay the start of the camera
+        import cups
+        
+        # Start printer with relay (the pulse runs in the background while CUPS is set up)
+        # the printer is connected to NO which means HIGH is holding this state and LOW is closing the relay
+        if not self.relay is None:
+            self.trigger_relay()
+
+        self.conn = cups.Connection()
+        self.default_printer = self.conn.getDefault()
+        cups.setUser('pi')
+        self.enable_printer()
+        self.conn.cancelAllJobs(self.default_printer)
+        
+        # the printer state is requested by the monitor thread with its own connection
+        self.monitor = PrinterMonitor(self.default_printer, cups.Connection, config, self.printer_changed)
+        self.print_queue = PrintQueue(self.default_printer, cups.Connection, self.monitor, config, self.print_queue_changed)
+        
+    def printer_changed(self):
+        # called from the printer monitor thread
+        if not self.print_queue is None:
+            self.print_queue.update()
+        self.post("printer")
+        
+    def print_queue_changed(self):
+        # called from the print queue or the printer monitor thread
+        self.post("printer")
+        
+    def set_event_loop(self, event_loop):
+        self.event_loop = event_loop
+        
+    def post(self, event):
+        # called from the GPIO thread, the event loop queue is thread-safe
+        if not self.event_loop is None:
+            self.pressed_at[event] = perf_counter()
+            self.event_loop.post(event)
+            
+    def observe_press(self, event):
+        """
+        Record the latency from the button interrupt until the event is handled,
+        returns the time of the button press (as time()) or None
+        """
+        pressed_at = self.pressed_at.pop(event, None)
+        if pressed_at is None:
+            return None
+        latency = perf_counter() - pressed_at
+        metrics.observe("button_latency", latency, button=event)
+        return time() - latency
+        
     def is_image_mode_multi(self):
         return self.image_mode_multi
         
@@ -266,91 +331,114 @@ class BoxIO:
         return self.btn_exit_pressed   
 
     def cleanup(self):
+        # the printer stage may not have finished
+        if not self.print_queue is None:
+            logger.info("Print statistics: %s", self.print_queue.stats())
+            self.print_queue.stop()
+        if not self.monitor is None:
+            self.monitor.stop()
+        # waits for a running relay pulse
+        self.outputs.stop(self.relay_time + 1)
         GPIO.cleanup()
         
     def set_dome_led(self, state):
+        # replaces the blinking
         if not self.led_dome is None:
-            GPIO.output(self.led_dome, state)
+            self.outputs.set(self.led_dome, state)
             
     def set_print_led(self, state):
         if not self.led_print is None:
-            GPIO.output(self.led_print, state)
+            self.outputs.set(self.led_print, state)
+            
+    def blink_dome_led(self, interval):
+        """
+        Blink the dome led until it is set or cancelled with the returned handle
+        """
+        if not self.led_dome is None:
+            return self.outputs.blink(self.led_dome, interval)
+            
+    def blink_print_led(self, interval):
+        if not self.led_print is None:
+            return self.outputs.blink(self.led_print, interval)
             
     def trigger_relay(self):
-        GPIO.output(self.relay, GPIO.LOW)
-        sleep(2)
-        GPIO.output(self.relay, GPIO.HIGH) 
+        """
+        Close the relay for relay_time seconds without blocking,
+        returns the handle of the pulse (e.g. to wait for it)
+        """
+        if self.relay is None:
+            return None
+        return self.outputs.pulse(self.relay, GPIO.LOW, self.relay_time, GPIO.HIGH)
             
-    def print_image(self, filename):
+    def print_image(self, filename, options = None, variant = None, pressed_at = None):
         """
-        This function prints the image on the printers
+        This function queues the image for printing and returns immediately
+        (variant and pressed_at, the time of the print button press, are for the print statistics)
         inspired by https://github.com/zoroloco/boothy/blob/master/pbooth.py
         and https://stackoverflow.com/a/39118346
         """
+        # the printer stage of the startup failed
+        if self.print_queue is None:
+            return None
         if filename is not None:
-            self.document = filename
-            print("Try to print %s" %(self.document))
-            logger.info("Try to print %s", self.document)
-            # possible options:
-            #   'fit-to-page':'True'
-            #   'copies': '2'
-            #   'scaling' : '100'
-            self.print_job_id = self.conn.printFile(self.default_printer, self.document, 'photobooth', {})
-            
-            print("Print job successfully created.")
-            logger.info("Print job successfully created")
-            
-            return self.print_job_id
+            # the same image is not queued twice (e.g. the button was pressed again)
+            handle = self.print_queue.find(filename)
+            if handle is None:
+                if self.print_span is None:
+                    self.print_span = metrics.span("print_busy")
+                handle = self.print_queue.submit(filename, options=options, variant=variant, pressed_at=pressed_at)
+            self.print_job = handle
+            return handle
 
     def print_started(self):
-        if self.print_job_id is None:
+        if self.print_queue is None:
             return False
-        return True
+        return self.print_queue.has_active()
 
-    # Check if print job is done
+    # Check if all print jobs are done (from the snapshot of the printer monitor)
     def printed(self):
-        #logger.info(self.conn.getJobs().get(self.print_job_id, None))
-        if self.conn.getJobs().get(self.print_job_id, None):
+        if self.print_queue is None:
+            return True
+        if self.print_queue.has_active():
             return False
-        
-        # Reset
-        print("Job printed")
-        logger.info("Job printed")
-        self.print_job_id = None
-        self.document = None
+        if self.print_span is not None:
+            self.print_span.stop()
+            self.print_span = None
         return True
 
-    # Check if print job is hold 
+    # Check if the printer is stopped or a print job is hold 
     def has_print_error(self):
-        attr = self.conn.getPrinterAttributes(self.default_printer)
-
-        if attr["printer-state"] == 5:
-            return attr["printer-state-message"]
+        if self.monitor is None or self.print_queue is None:
+            return False
+        error = self.monitor.get_printer_error()
+        if error is not None:
+            return error
         
-        if self.print_started() and not self.printed():
-            job = self.conn.getJobAttributes(self.print_job_id)
-
-            if job["job-state"] == 4 or job["job-state"] == 6:
-                return job["job-printer-state-message"]
+        for handle in self.print_queue.errors():
+            return handle.message
 
         return False
         
     def cancel_print_job(self, retry = False):
         print("Cancel/Restart Job")
         logger.info("Cancel/Restart Job")
+        if self.print_queue is None:
+            return
         self.enable_printer()
         
-        if self.print_started() and not self.printed():
-            # Release of job is not supported so instead cancel and resubmit the job
-            self.conn.cancelJob(self.print_job_id)
-            
+        # only the jobs with errors are retried/canceled, the others keep printing
+        for handle in self.print_queue.errors():
             if retry:
-                self.print_image(self.document)
+                self.print_queue.retry(handle)
             else:
-                self.print_job_id = None
+                self.print_queue.cancel(handle)
                 
     def enable_printer(self, retry = False):
         print("Enable Printer/Accept Jobs")
         logger.info("Enable Printer/Accept Jobs")
+        if self.conn is None:
+            return
         self.conn.enablePrinter(self.default_printer)
-        self.conn.acceptJobs(self.default_printer)
\ No newline at end of file
+        self.conn.acceptJobs(self.default_printer)
+        if not self.monitor is None:
+            self.monitor.refresh()
\ No newline at end of file
@@ -1,18 +1,65 @@
 #!/usr/bin/env python3
 
 import picamera
-from PIL import Image, ImageFont, ImageDraw
-import numpy as np
-from time import sleep, time
+from PIL import Image, ImageDraw
+from time import sleep, time, monotonic
 
 import datetime
-import subprocess
+import io
 import os
 
+from Montage import create_montage
+from Layout import LayoutError, create_layout
+from PostProcessor import PostProcessJob
+from AssetCache import AssetCache, pad_image
+from LabelCache import LabelCache, draft_fitted
+from TextCache import TextCache
+from PrintImage import PrintImage
+from Metrics import metrics
+
 import logging
 
 logger = logging.getLogger("photobooth")
 
+class CapturedFrame:
+    """
+    A captured photo which is kept in memory (jpeg bytes or rgb array)
+    or already written to filename by the camera
+    """
+
+    def __init__(self, filename, jpeg = None, array = None):
+        self.filename = filename
+        self.jpeg = jpeg
+        self.array = array
+
+    def in_memory(self):
+        return self.jpeg is not None or self.array is not None
+
+    def source(self):
+        """
+        Return something the montage can read without touching the disk
+        """
+        if self.jpeg is not None:
+            return io.BytesIO(self.jpeg)
+        if self.array is not None:
+            return Image.fromarray(self.array)
+        return self.filename
+
+    def save(self, jpeg_quality = 90):
+        """
+        Write the frame to filename (only needed when the frames should be archived)
+        """
+        if self.jpeg is not None:
+            with open(self.filename, 'wb') as f:
+                f.write(self.jpeg)
+        elif self.array is not None:
+            Image.fromarray(self.array).save(self.filename, 'JPEG', quality=jpeg_quality)
+        # the file is the only copy from now on
+        self.jpeg = None
+        self.array = None
+        return self.filename
+
+
 class Camera:
     photo_w         = 1920
     photo_h         = 1280
@@ -26,12 +73,20 @@ class Camera:
     photo_countdown_time = 3
     image_overlay       = -1    # Preview of montage
     base_filename       = None
-    final_image         = None
+    current_job         = None     # post processing job of the last session
     image_mode_multi    = False
     photo_hflip         = True
     preview_hflip       = True
     show_image_time     = 0
     final_image_start   = 0
+    capture_to_memory   = False
+    capture_memory_format = 'jpeg'     # 'jpeg' or 'rgb'
+    archive_frames      = True
+    staging_folder      = None     # RAM folder for the session images (see Staging.py)
+    on_written          = None     # called with the path of every written session image (e.g. the staging journal)
+    capture_video_port  = False    # faster captures from the video port with a lower quality
+    frames              = []
+    last_shot           = None     # end of the previous capture of the session
 
 
     def __init__(self, config):
@@ -61,9 +116,26 @@ class Camera:
             self.preview_hflip = config.preview_hflip
         if hasattr(config, "show_image_time"):
             self.show_image_time = config.show_image_time            
+        if hasattr(config, "capture_to_memory"):
+            self.capture_to_memory = config.capture_to_memory
+        if hasattr(config, "capture_memory_format"):
+            self.capture_memory_format = config.capture_memory_format
+        if hasattr(config, "archive_frames"):
+            self.archive_frames = config.archive_frames
+        if hasattr(config, "capture_video_port"):
+            self.capture_video_port = config.capture_video_port
+        if hasattr(config, "staging_folder") and config.staging_folder is not None:
+            self.staging_folder = os.path.abspath(config.staging_folder)
             
         # create absolute path
         self.path = os.path.dirname(os.path.realpath(__file__))
+        
+        # rendered text overlays and fonts
+        self.texts = TextCache(self.screen_w, self.screen_h, config)
+        
+        # decoded and padded overlay images (filled by prepare())
+        self.assets = AssetCache(config)
+        self.countdown_frames = []
     
         #Setup Camera
         try:
@@ -75,10 +147,38 @@ class Camera:
             
         self.camera.annotate_text_size = 80
         
+        # the label fitted to the photo width in memory, read again only when the file changes
+        # (the booth keeps the cached label when the USB stick with the label is removed)
+        self.label = None
+        if self.label_path is not None:
+            self.label = LabelCache(self.label_path, self.photo_w, self.label_h, config)
+            if not self.label.load():
+                print("label %s not found - no label" % self.label_path)
+                logger.warning("Label %s not found, no label", self.label_path)
+                self.label = None
+                self.label_path = None
+        
         # subtract label height
         if not self.label_path is None:
             self.photo_h = self.photo_h - self.label_h
         
+        # compositor for the final image
+        self.montage = create_montage(self.photo_w, self.photo_h, self.label_h, config)
+        
+        # slot geometry and capture sizes of the montages
+        # (a bad template raises a LayoutError at startup, not at the first session)
+        label_h = self.label_h if self.label_path is not None else 0
+        self.layout_single = create_layout(config, self.photo_w, self.photo_h, label_h, 1, False)
+        self.layout_multi = create_layout(config, self.photo_w, self.photo_h, label_h, self.image_count, True)
+        if not self.montage.supports(self.layout_multi):
+            raise LayoutError("The montage backend does not support the %s layout" % self.layout_multi.name)
+        self.print_renderer = PrintImage(config)
+        if self.capture_to_memory and not self.montage.reads_memory:
+            logger.warning("The montage backend can only read files, capturing to disk")
+            self.capture_to_memory = False
+        
+        # the resolution is set only once: every resolution change restarts the camera pipeline,
+        # the smaller multi shots are scaled by the GPU with resize
         self.camera.resolution = (self.photo_w, self.photo_h)
         
         # the image preview is flipped horizontally
@@ -94,6 +194,15 @@ class Camera:
         # Create static black background overlay in layer 1
         self.overlay_background()
         
+    def prepare(self, texts = (), x = 50, y = 50, fontsize = 80):
+        """
+        Render everything which is needed for a session
+        (called after the intro is shown so that it does not delay the first frame)
+        """
+        self.assets.preload(self.path + "/assets")
+        self.countdown_frames = self.render_countdown()
+        self.prerender_text(texts, x, y, fontsize)
+        
     def get_path(self):
         return self.path
         
@@ -103,33 +212,48 @@ class Camera:
     def overlay_text(self,text):
         self.camera.annotate_text = text
         
-    def overlay_countdown(self):
-        countdownFont = ImageFont.truetype("/usr/share/fonts/dejavu/DejaVuSans.ttf", 80)
+    def render_countdown(self):
+        """
+        Render the countdown frames once so that the countdown only updates the overlay
+        """
+        countdownFont = self.texts.font(80)
         countdownImage = Image.new("RGBA", (self.screen_w,self.screen_h), (0,0,0,0))
-        countdown_overlay = self.camera.add_overlay(countdownImage.tobytes(), size=(self.screen_w, self.screen_h), format='rgba', layer=5)
-
+        
+        frames = []
         for counter in range(self.photo_countdown_time,0,-1):
             img = countdownImage.copy()
             draw = ImageDraw.Draw(img)
             draw.text((self.screen_w/2,50), "..." + str(counter), (255,255,255), font=countdownFont)
-            
-            # create new overlay with countdown number
-            countdown_overlay_new = self.camera.add_overlay(img.tobytes(), size=(self.screen_w, self.screen_h), format='rgba', layer=5)
-            # remove previous overlay
-            self.camera.remove_overlay(countdown_overlay)
-            # save this overlay as previous 
-            countdown_overlay = countdown_overlay_new
-            sleep(1)
+            frames.append(img.tobytes())
+        return frames
+        
+    def overlay_countdown(self):
+        if not self.countdown_frames:
+            return
+        
+        # one overlay which is updated with the next number
+        countdown_overlay = self.camera.add_overlay(self.countdown_frames[0], size=(self.screen_w, self.screen_h), format='rgba', layer=5)
+        
+        # every number is shown for one second measured from the start
+        # so that the render time does not delay the shutter
+        start = monotonic()
+        for index, frame in enumerate(self.countdown_frames):
+            if index > 0:
+                countdown_overlay.update(frame)
+            remaining = start + index + 1 - monotonic()
+            if remaining > 0:
+                sleep(remaining)
         # remove last overlay
         self.camera.remove_overlay(countdown_overlay)
         
     def overlay_text_as_image(self, text, layer, x = 50, y = 50, fontsize = 80):
-        font = ImageFont.truetype("/usr/share/fonts/dejavu/DejaVuSans.ttf", fontsize)
-        img = Image.new("RGBA", (self.screen_w,self.screen_h), (0,0,0,0))
-        draw = ImageDraw.Draw(img)
-        draw.text((x,y), "%s" % text, (255,255,255), font=font)
-
-        return self.camera.add_overlay(img.tobytes(), size=(self.screen_w, self.screen_h), format='rgba', layer=layer)      
+        # the text is rendered only in its own size and placed with a window
+        data, size, window = self.texts.get("%s" % text, x, y, fontsize)
+        return self.camera.add_overlay(data, size=size, format='rgba', layer=layer, fullscreen=False, window=window)      
+        
+    def prerender_text(self, texts, x = 50, y = 50, fontsize = 80):
+        for text in texts:
+            self.texts.get("%s" % text, x, y, fontsize)
         
     def remove_overlay(self,overlay_id):
         if overlay_id != -1:
@@ -140,36 +264,18 @@ class Camera:
         Add an overlay (and sleep for an optional duration).
         If sleep duration is not supplied, then overlay will need to be removed later.
         This function returns an overlay id, which can be used to remove_overlay(id).
+        image_path can be an image file (cached) or an already loaded image.
         """
 
-        # "The camera`s block size is 32x16 so any image data
-        #  provided to a renderer must have a width which is a
-        #  multiple of 32, and a height which is a multiple of
-        #  16."
-        #  Refer: http://picamera.readthedocs.io/en/release-1.10/recipes1.html#overlaying-images-on-the-preview
-
-        # Load the arbitrarily sized image
-        img = Image.open(image_path)
-
-        # Create an image padded to the required size with
-        # mode 'RGB'
-        pad = Image.new('RGB', (
-            ((img.size[0] + 31) // 32) * 32,
-            ((img.size[1] + 15) // 16) * 16,
-        ))
-
-        # Paste the original image into the padded one
-        pad.paste(img, (0, 0))
-
-        #Get the padded image data
-        try:
-            padded_img_data = pad.tobytes()
-        except AttributeError:
-            padded_img_data = pad.tostring() # Note: tostring() is deprecated in PIL v3.x
+        # Get the image data padded to the camera`s block size
+        if isinstance(image_path, Image.Image):
+            padded_img_data, size = pad_image(image_path)
+        else:
+            padded_img_data, size = self.assets.get(image_path)
 
         # Add the overlay with the padded image as the source,
         # but the original image's dimensions
-        o_id = self.camera.add_overlay(padded_img_data, size=img.size)
+        o_id = self.camera.add_overlay(padded_img_data, size=size)
         o_id.layer = layer
         
 
@@ -182,7 +288,8 @@ class Camera:
             
             
     def overlay_background(self, layer = 1, alpha = 255):
-        a = np.zeros((self.screen_h, self.screen_w, 3), dtype=np.uint8)
+        # black rgb buffer, no numpy needed
+        a = bytes(self.screen_w * self.screen_h * 3)
         o_bg = self.camera.add_overlay(a, size=(self.screen_w, self.screen_h), format='rgb', layer=layer)
         o_bg.alpha = alpha
         
@@ -192,11 +299,27 @@ class Camera:
             get_ready_image = self.path + "/assets/get_ready_next.png"
         else:
             get_ready_image = self.path + "/assets/get_ready.png"
-        self.overlay_image(get_ready_image, self.prep_delay)
+        with metrics.span("prep"):
+            self.overlay_image(get_ready_image, self.prep_delay)
+
+    def show_processing(self):
+        print("Processing...")
+        logger.info("Processing...")      
+        processing_image = self.path + "/assets/processing.png"
+        return self.overlay_image(processing_image)
 
     def show_image(self):        
-        filename = self.get_image()
-        self.image_overlay = self.overlay_image(filename, 0, 5)
+        if self.current_job is None:
+            return
+        # the screen sized preview is available before the full resolution image is written
+        image = self.current_job.preview
+        if image is None:
+            filename = self.get_image()
+            if filename is None:
+                return
+            # not through the asset cache, the session images are only shown once
+            image = self.load_screen_image(filename)
+        self.image_overlay = self.overlay_image(image, 0, 5)
         self.final_image_start = time()
         
     def hide_image(self):
@@ -205,7 +328,7 @@ class Camera:
             self.image_overlay = -1
             # Reset current image
             self.base_filename = None
-            self.final_image = None
+            self.current_job = None
         
         
     def hide_image_if_needed(self):
@@ -214,45 +337,59 @@ class Camera:
             self.hide_image()
     
     def get_image(self):
-        if self.final_image is not None:
-            return self.final_image
+        """
+        Return the full resolution image of the current session
+        (waits until the post processing has written it)
+        """
+        if self.current_job is not None:
+            return self.current_job.wait()
         return None
     
+    def get_print_image(self):
+        """
+        Return the image which should be sent to the printer, the print options
+        and the variant ("prerendered" or "original", for the print statistics)
+        """
+        filename = self.get_image()
+        if filename is not None and self.current_job.print_image is not None:
+            return self.current_job.print_image, self.print_renderer.options(), "prerendered"
+        return filename, {}, "original"
+    
+    def create_job(self):
+        """
+        Hand the captured frames of this session over to the post processing
+        """
+        self.current_job = PostProcessJob(self.base_filename, self.frames, self.image_mode_multi)
+        return self.current_job
+    
     def create_file_name(self):
-        base_filename = self.path + '/' + self.images_folder + '/' + str(datetime.datetime.now()).split('.')[0]
+        # the images are written into the staging folder and flushed to the images folder in the background
+        folder = self.staging_folder if self.staging_folder is not None else self.path + '/' + self.images_folder
+        base_filename = folder + '/' + str(datetime.datetime.now()).split('.')[0]
         base_filename = base_filename.replace(' ', '_')
         base_filename = base_filename.replace(':', '-')
         self.base_filename = base_filename
+        self.frames = []
+        self.last_shot = None
     
     def capture(self, photo_number):
 
         if self.base_filename is None:
             self.create_file_name()
     
-        # set resolution and filename
+        # set output size and filename
+        # (the camera resolution is not changed, so the preview resolution stays as well)
         if self.image_mode_multi:
             filename = self.base_filename + '_multi_' + str(photo_number) + 'of'+ str(self.image_count)+'.jpg'
-            
-            # for the multi image the picture can be half width/height and the tile spacing (2*10) must be subtracted
-            photo_w_multi = round(self.photo_w / 2.0) - (2*10)
-            photo_h_multi = round(self.photo_h / 2.0) - (2*10)
-            
-            self.camera.resolution = (photo_w_multi, photo_h_multi)
-            
+            layout = self.layout_multi
         else:
             filename = self.base_filename + '_single.jpg'
+            layout = self.layout_single
             
-            # resolution for single shot is full shot
-            photo_w_single = self.photo_w
-            photo_h_single = self.photo_h
-            
-            self.camera.resolution = (photo_w_single, photo_h_single)
-            
-        # it is possible that the preview resolution is smaller when switching from
-        # mode multi to mode single so reset the resolution here
-        # see https://github.com/waveform80/picamera/blob/master/picamera/renderers.py#L516-L520
-        if self.camera.resolution.width > self.screen_w and self.camera.resolution.height > self.screen_h:
-            self.camera.preview.resolution = (self.screen_w, self.screen_h)
+        # the frame is captured in the size of its slot in the montage
+        resize = layout.capture_size(photo_number - 1)
+        if resize == (self.photo_w, self.photo_h):
+            resize = None
 
         # show preview
         self.camera.preview.alpha = 255    
@@ -261,74 +398,152 @@ class Camera:
         #for counter in range(self.photo_countdown_time,0,-1):
         #    self.overlay_text("             ..." + str(counter))
         #    sleep(1)
-        self.overlay_countdown()
+        with metrics.span("countdown"):
+            self.overlay_countdown()
 
         # capture
         self.camera.annotate_text = ''
-        self.camera.capture(filename)
+        shutter = metrics.span("shutter", target="memory" if self.capture_to_memory else "file")
+        if self.last_shot is not None:
+            metrics.observe("shot_gap", shutter.start - self.last_shot)
+        if self.capture_to_memory and self.capture_memory_format == 'rgb':
+            # imports numpy, only needed in this mode
+            import picamera.array
+            output = picamera.array.PiRGBArray(self.camera, size=resize)
+            self.camera.capture(output, format='rgb', resize=resize, use_video_port=self.capture_video_port)
+            frame = CapturedFrame(filename, array=output.array)
+        elif self.capture_to_memory:
+            stream = io.BytesIO()
+            self.camera.capture(stream, format='jpeg', resize=resize, use_video_port=self.capture_video_port)
+            frame = CapturedFrame(filename, jpeg=stream.getvalue())
+        else:
+            self.camera.capture(filename, resize=resize, use_video_port=self.capture_video_port)
+            frame = CapturedFrame(filename)
+            self.written(filename)
+        shutter.stop()
+        self.last_shot = shutter.start + shutter.duration
+        self.frames.append(frame)
         
         # hide preview
         self.camera.preview.alpha = 0
-        print("Photo saved: " + filename)
-        logger.info("Photo saved: %s", filename)        
+        if frame.in_memory():
+            print("Photo captured: " + filename)
+            logger.info("Photo captured into memory: %s", filename)
+        else:
+            print("Photo saved: " + filename)
+            logger.info("Photo saved: %s", filename)        
         
         return filename
 
 
-    def convertMergeImages(self):
+    def get_layout(self, job):
+        return self.layout_multi if job.image_mode_multi else self.layout_single
+
+    def screen_image(self, img):
+        """
+        Scale an image down so that it fits on the screen
+        """
+        img = img.copy()
+        img.thumbnail((self.screen_w, self.screen_h))
+        return img
+
+    def load_screen_image(self, source):
+        """
+        Load an image (file, stream or PIL image) in the screen size.
+        A jpeg is decoded with draft so that the decoder already scales it down
+        by 1/2, 1/4 or 1/8 instead of decoding the full resolution.
+        """
+        if isinstance(source, Image.Image):
+            return self.screen_image(source)
+        img = draft_fitted(Image.open(source), self.screen_w, self.screen_h)
+        img.thumbnail((self.screen_w, self.screen_h))
+        return img
+
+    def convertMergeImages(self, job):
         """
         This function merges the images when multi mode is selected
         inspired by https://github.com/zoroloco/boothy/blob/master/pbooth.py
         and https://github.com/safay/RPi_photobooth/blob/master/assemble_and_print
+        It is called from the post processing thread so it must not touch the camera.
         """
-
-        # Processing
-        print("Processing...")
-        logger.info("Processing...")      
-        processing_image = self.path + "/assets/processing.png"
-        processing_overlay = self.overlay_image(processing_image)
         
-        filename = self.base_filename + '_montage.jpg'
+        filename = job.base_filename + '_montage.jpg'
+        img = None
 
-        # combine the 4 images
-        if self.image_mode_multi:
-            IMG1 = "%s_multi_%sof%s.jpg" % (self.base_filename, 1, self.image_count)
-            IMG2 = "%s_multi_%sof%s.jpg" % (self.base_filename, 2, self.image_count)
-            IMG3 = "%s_multi_%sof%s.jpg" % (self.base_filename, 3, self.image_count)
-            IMG4 = "%s_multi_%sof%s.jpg" % (self.base_filename, 4, self.image_count)
-            
-            fileNameTemp = self.base_filename + '_montageTemp.jpg'
-            
-            subprocess.call(["montage", IMG1,IMG2,IMG3,IMG4,"-tile", "2x2", "-geometry", "+10+10",fileNameTemp])
-            
-        else:
-            fileNameTemp = self.base_filename + '_single.jpg'
-
-        
-        if self.label_path is not None:
-            # prepare filename for correct width
-            fileNameTemp = "%s[%sx%s]" % (fileNameTemp, self.photo_w, self.photo_h)
-            
-            # append label to image
-            label = "%s[%sx%s]" % (self.label_path, self.photo_w, self.label_h)
-            
-            # when using geometry +0+0 the concatenate mode is selected which is okay here
-            # see http://www.imagemagick.org/Usage/montage/#zero_geometry
-            subprocess.call(["montage",fileNameTemp,label,"-tile", "1x2","-geometry", "+0+0",filename])
-        
+        if len(job.frames) > 1 or self.label is not None:
+            # combine the images and append the label
+            sources = [frame.source() for frame in job.frames]
+            if self.montage.reads_memory:
+                with metrics.span("montage"):
+                    img = self.montage.compose(sources, self.label.get() if self.label is not None else None, self.get_layout(job))
+                    # the preview can be shown before the full resolution image is encoded
+                    job.set_preview(self.screen_image(img))
+                with metrics.span("encode", image="montage"):
+                    self.montage.save(img, filename)
+            else:
+                with metrics.span("montage"):
+                    filename = self.montage.create(sources, filename, self.label.get_file() if self.label is not None else None, self.get_layout(job))
+            self.written(filename)
         else:
-            filename = fileNameTemp
-            
+            # a single shot without label is already the final image
+            filename = job.frames[0].filename
+            # the preview is decoded from memory before the frame is written
+            self.create_preview(job, job.frames[0].source())
+            if job.frames[0].in_memory():
+                with metrics.span("encode", image="frame"):
+                    job.frames[0].save()
+                self.written(filename)
         
         # set the final name
-        self.final_image = filename
+        job.final_image = filename
+        
+        # e.g. the montage of ImageMagick
+        if job.preview is None:
+            self.create_preview(job, filename)
                                             
         print("Images have been merged.")
         logger.info("Images have been merged.")      
-        self.remove_overlay(processing_overlay)
+        
+        # image in the native resolution of the printer so that pressing print submits it as is
+        if self.print_renderer.enabled:
+            try:
+                with metrics.span("print_render"):
+                    job.print_image = self.print_renderer.create(img if img is not None else filename, job.base_filename)
+            except Exception as e:
+                # the final image is printed instead
+                logger.error("Error creating print image: %s", e)
         
         return filename
         
+    def written(self, filename):
+        if self.on_written is not None:
+            self.on_written(filename)
+        
+    def create_preview(self, job, source):
+        try:
+            with metrics.span("preview"):
+                job.set_preview(self.load_screen_image(source))
+        except Exception as e:
+            # show_image falls back to the final image
+            logger.error("Error creating preview: %s", e)
+        
+    def save_frames(self, job):
+        """
+        Write the frames which are still in memory to disk if they should be archived
+        and return the list of the frame files
+        """
+        filenames = []
+        for frame in job.frames:
+            if frame.in_memory():
+                if not self.archive_frames:
+                    continue
+                with metrics.span("encode", image="frame"):
+                    frame.save()
+                self.written(frame.filename)
+                logger.info("Photo saved: %s", frame.filename)
+            if not frame.filename in filenames:
+                filenames.append(frame.filename)
+        return filenames
         
     def stop(self):
         self.camera.stop_preview()
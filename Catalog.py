@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+
+from time import time
+
+import sqlite3
+import threading
+import os
+import logging
+
+logger = logging.getLogger("photobooth")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id              INTEGER PRIMARY KEY,
+    base_filename   TEXT NOT NULL UNIQUE,
+    started_at      REAL NOT NULL,
+    multi           INTEGER NOT NULL,
+    final_image     TEXT,
+    print_image     TEXT,
+    finished_at     REAL,
+    error           TEXT
+);
+CREATE INDEX IF NOT EXISTS sessions_started ON sessions (started_at);
+
+CREATE TABLE IF NOT EXISTS files (
+    id              INTEGER PRIMARY KEY,
+    session_id      INTEGER NOT NULL REFERENCES sessions (id),
+    path            TEXT NOT NULL UNIQUE,
+    kind            TEXT NOT NULL,
+    checksum        TEXT
+);
+CREATE INDEX IF NOT EXISTS files_session ON files (session_id);
+
+CREATE TABLE IF NOT EXISTS copies (
+    file_id         INTEGER NOT NULL REFERENCES files (id),
+    destination     TEXT NOT NULL,
+    status          TEXT NOT NULL,
+    checksum        TEXT,
+    error           TEXT,
+    updated_at      REAL NOT NULL,
+    PRIMARY KEY (file_id, destination)
+);
+CREATE INDEX IF NOT EXISTS copies_status ON copies (destination, status);
+
+CREATE TABLE IF NOT EXISTS prints (
+    id              INTEGER PRIMARY KEY,
+    session_id      INTEGER REFERENCES sessions (id),
+    filename        TEXT NOT NULL,
+    copies          INTEGER NOT NULL,
+    state           TEXT NOT NULL,
+    message         TEXT,
+    attempts        INTEGER NOT NULL DEFAULT 0,
+    queued_at       REAL NOT NULL,
+    done_at         REAL
+);
+CREATE INDEX IF NOT EXISTS prints_session ON prints (session_id);
+"""
+
+class Catalog:
+    """
+    SQLite catalog of the sessions: frames, final and print image, checksums,
+    copy status per backup destination and the print jobs.
+    Every change is one transaction. The connection is shared by the threads
+    (event loop, post processing, backup workers, print queue) under a lock.
+    """
+
+    filename = os.path.dirname(os.path.realpath(__file__)) + '/catalog.sqlite'
+
+    def __init__(self, config = None):
+        if config is not None and hasattr(config, "catalog_file"):
+            self.filename = config.catalog_file
+
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.filename, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        # WAL: readers are not blocked and a commit is one sequential write (SD card)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        # print handle id => row id (the handle ids start again after a restart)
+        self.prints = {}
+
+    def execute(self, sql, parameters = ()):
+        with self.lock, self.connection:
+            return self.connection.execute(sql, parameters)
+
+    def query(self, sql, parameters = ()):
+        with self.lock:
+            return [dict(row) for row in self.connection.execute(sql, parameters)]
+
+    def session_id(self, base_filename):
+        # must be called with the lock
+        row = self.connection.execute("SELECT id FROM sessions WHERE base_filename = ?", (base_filename,)).fetchone()
+        return row["id"] if row is not None else None
+
+    def start_session(self, base_filename, multi):
+        self.execute("INSERT OR IGNORE INTO sessions (base_filename, started_at, multi) VALUES (?, ?, ?)",
+            (base_filename, time(), int(bool(multi))))
+
+    def finish_session(self, job, destinations = ()):
+        """
+        Record the written files of a post processing job and the pending copies
+        """
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR IGNORE INTO sessions (base_filename, started_at, multi) VALUES (?, ?, ?)",
+                (job.base_filename, time(), int(bool(job.image_mode_multi))))
+            session_id = self.session_id(job.base_filename)
+            self.connection.execute("UPDATE sessions SET final_image = ?, print_image = ?, finished_at = ?, error = ? WHERE id = ?",
+                (job.final_image, job.print_image, time(), None if job.error is None else str(job.error), session_id))
+
+            now = time()
+            for path in job.files:
+                kind = "final" if path == job.final_image else "frame"
+                self.connection.execute("INSERT OR IGNORE INTO files (session_id, path, kind) VALUES (?, ?, ?)", (session_id, path, kind))
+                file_id = self.connection.execute("SELECT id FROM files WHERE path = ?", (path,)).fetchone()["id"]
+                for destination in destinations:
+                    self.connection.execute("INSERT OR REPLACE INTO copies (file_id, destination, status, updated_at) VALUES (?, ?, 'pending', ?)",
+                        (file_id, destination, now))
+
+    def copy_done(self, src, destination, checksum = None, error = None):
+        """
+        Record the result of a backup copy (called from the backup workers)
+        """
+        with self.lock, self.connection:
+            row = self.connection.execute("SELECT id FROM files WHERE path = ?", (src,)).fetchone()
+            if row is None:
+                return
+            if checksum is not None:
+                self.connection.execute("UPDATE files SET checksum = ? WHERE id = ?", (checksum, row["id"]))
+            self.connection.execute("INSERT OR REPLACE INTO copies (file_id, destination, status, checksum, error, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (row["id"], destination, "copied" if error is None else "failed", checksum, error, time()))
+
+    def print_queued(self, base_filename, handle):
+        with self.lock, self.connection:
+            # the print button was pressed again for a queued image
+            if handle.id in self.prints:
+                return
+            cursor = self.connection.execute("INSERT INTO prints (session_id, filename, copies, state, queued_at) VALUES (?, ?, ?, ?, ?)",
+                (self.session_id(base_filename), handle.filename, handle.copies, handle.state, handle.queued_at))
+            self.prints[handle.id] = cursor.lastrowid
+
+    def print_finished(self, handle):
+        """
+        Record the final state of a print job (called from the print queue)
+        """
+        with self.lock:
+            row_id = self.prints.pop(handle.id, None)
+        if row_id is None:
+            return
+        self.execute("UPDATE prints SET state = ?, message = ?, attempts = ?, done_at = ? WHERE id = ?",
+            (handle.state, handle.message, handle.attempts, handle.done_at, row_id))
+
+    def last_sessions(self, count = 10):
+        return self.query("SELECT * FROM sessions ORDER BY started_at DESC LIMIT ?", (count,))
+
+    def session_files(self, base_filename):
+        return self.query("SELECT f.* FROM files f JOIN sessions s ON s.id = f.session_id WHERE s.base_filename = ?", (base_filename,))
+
+    def session_prints(self, base_filename):
+        return self.query("SELECT p.* FROM prints p JOIN sessions s ON s.id = p.session_id WHERE s.base_filename = ? ORDER BY p.queued_at", (base_filename,))
+
+    def not_backed_up(self, destination):
+        """
+        Sessions with a file which is not (yet) copied to the destination
+        """
+        return self.query("""SELECT DISTINCT s.* FROM copies c
+            JOIN files f ON f.id = c.file_id
+            JOIN sessions s ON s.id = f.session_id
+            WHERE c.destination = ? AND c.status IN ('pending', 'failed')
+            ORDER BY s.started_at""", (destination,))
+
+    def eviction_candidates(self, destination, primary, frames_only = False, limit = 20):
+        """
+        Files of the oldest sessions which are in the destination and confirmed in another
+        destination, so that they can be deleted there (frames_only: the frames of multi sessions).
+        primary is the images folder (the paths of the catalog), the other destinations
+        are backup folders. Files with a pending copy are never returned.
+        """
+        if destination == primary:
+            present = "NOT EXISTS (SELECT 1 FROM copies e WHERE e.file_id = f.id AND e.destination = :primary AND e.status = 'evicted')"
+            elsewhere = "EXISTS (SELECT 1 FROM copies c WHERE c.file_id = f.id AND c.destination != :primary AND c.status = 'copied')"
+        else:
+            present = "EXISTS (SELECT 1 FROM copies d WHERE d.file_id = f.id AND d.destination = :destination AND d.status = 'copied')"
+            elsewhere = """(NOT EXISTS (SELECT 1 FROM copies e WHERE e.file_id = f.id AND e.destination = :primary AND e.status = 'evicted')
+                OR EXISTS (SELECT 1 FROM copies c WHERE c.file_id = f.id AND c.destination NOT IN (:destination, :primary) AND c.status = 'copied'))"""
+        condition = elsewhere
+        if frames_only:
+            # the montage of a multi session is kept, a single shot is the final image
+            condition = "f.kind = 'frame' AND s.multi = 1 AND " + elsewhere
+        return self.query("""SELECT f.path, f.kind, s.base_filename FROM files f
+            JOIN sessions s ON s.id = f.session_id
+            WHERE """ + present + " AND " + condition + """
+            AND NOT EXISTS (SELECT 1 FROM copies p WHERE p.file_id = f.id AND p.status = 'pending')
+            ORDER BY s.started_at, f.id LIMIT :limit""", {"destination": destination, "primary": primary, "limit": limit})
+
+    def evicted(self, path, destination):
+        """
+        Record that the retention policy deleted the file in the destination
+        """
+        with self.lock, self.connection:
+            row = self.connection.execute("SELECT id FROM files WHERE path = ?", (path,)).fetchone()
+            if row is None:
+                return
+            self.connection.execute("INSERT OR REPLACE INTO copies (file_id, destination, status, updated_at) VALUES (?, ?, 'evicted', ?)",
+                (row["id"], destination, time()))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+from time import monotonic
+
+import threading
+import queue
+import heapq
+import itertools
+import logging
+
+logger = logging.getLogger("photobooth")
+
+class Timer:
+    """
+    Handle of a scheduled callback which can be cancelled
+    """
+
+    def __init__(self, deadline, interval, callback, args):
+        self.deadline = deadline
+        self.interval = interval
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class EventLoop:
+    """
+    Runs the handlers of posted events and timers in one thread.
+    post() is thread-safe so it can be called from the GPIO callbacks and worker threads.
+    The loop sleeps until the next event or timer so there is no polling interval.
+    """
+
+    def __init__(self):
+        self.events = queue.Queue()
+        self.handlers = {}
+        self.timers = []
+        self.timers_lock = threading.Lock()
+        self.counter = itertools.count()
+        self.running = False
+        self.thread = None
+
+    def on(self, event, handler):
+        self.handlers.setdefault(event, []).append(handler)
+
+    def post(self, event, *args):
+        self.events.put((event, args))
+
+    def call_later(self, delay, callback, *args):
+        return self.schedule(Timer(monotonic() + delay, None, callback, args))
+
+    def call_every(self, interval, callback, *args):
+        return self.schedule(Timer(monotonic() + interval, interval, callback, args))
+
+    def schedule(self, timer):
+        with self.timers_lock:
+            heapq.heappush(self.timers, (timer.deadline, next(self.counter), timer))
+        # wake up the loop if it is waiting for a later deadline
+        if threading.current_thread() is not self.thread:
+            self.post(None)
+        return timer
+
+    def stop(self):
+        self.running = False
+        self.post(None)
+
+    def next_timeout(self):
+        with self.timers_lock:
+            while self.timers and self.timers[0][2].cancelled:
+                heapq.heappop(self.timers)
+            if not self.timers:
+                return None
+            return max(0, self.timers[0][0] - monotonic())
+
+    def run_timers(self):
+        now = monotonic()
+        while True:
+            with self.timers_lock:
+                if not self.timers or self.timers[0][0] > now:
+                    return
+                deadline, _, timer = heapq.heappop(self.timers)
+                if timer.cancelled:
+                    continue
+                if timer.interval is not None:
+                    # keep the period stable, but do not try to catch up missed ticks
+                    timer.deadline = max(deadline + timer.interval, now)
+                    heapq.heappush(self.timers, (timer.deadline, next(self.counter), timer))
+            timer.callback(*timer.args)
+
+    def dispatch(self, event, args):
+        for handler in self.handlers.get(event, []):
+            handler(*args)
+
+    def run(self):
+        self.thread = threading.current_thread()
+        self.running = True
+        while self.running:
+            try:
+                event, args = self.events.get(timeout=self.next_timeout())
+                if event is not None:
+                    self.dispatch(event, args)
+            except queue.Empty:
+                pass
+            self.run_timers()
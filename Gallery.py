@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+
+from PIL import Image
+
+import glob
+import threading
+import os
+import logging
+
+from AssetCache import pad_image
+from LabelCache import draft_fitted
+
+logger = logging.getLogger("photobooth")
+
+class ThumbnailCache:
+    """
+    Persistent cache of the session images in the screen size as padded raw rgb data,
+    so that showing a slide is a file read without jpeg decoding.
+    The entries are named after the image (which starts with the timestamp)
+    and only the newest max_entries are kept.
+    """
+
+    folder      = os.path.dirname(os.path.realpath(__file__)) + '/thumbnails'
+    max_entries = 50
+
+    def __init__(self, screen_w, screen_h, config = None):
+        self.screen_w = screen_w
+        self.screen_h = screen_h
+
+        if config is not None:
+            if hasattr(config, "gallery_cache_folder"):
+                self.folder = config.gallery_cache_folder
+            if hasattr(config, "gallery_size"):
+                self.max_entries = config.gallery_size
+
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+
+        self.lock = threading.Lock()
+        # newest first
+        self.entries = sorted((name for name in os.listdir(self.folder) if name.endswith(".rgb")), reverse=True)
+        self.evict()
+
+    def entry_name(self, image):
+        return os.path.basename(image) + ".rgb"
+
+    def contains(self, image):
+        with self.lock:
+            return self.entry_name(image) in self.entries
+
+    def render(self, img):
+        """
+        Center the image on a black screen sized slide,
+        so that all slides have the same size and one overlay can be updated
+        """
+        if img.size[0] > self.screen_w or img.size[1] > self.screen_h:
+            img = img.copy()
+            img.thumbnail((self.screen_w, self.screen_h))
+        slide = Image.new('RGB', (self.screen_w, self.screen_h))
+        slide.paste(img.convert('RGB'), ((self.screen_w - img.size[0]) // 2, (self.screen_h - img.size[1]) // 2))
+        data, _ = pad_image(slide)
+        return data
+
+    def add(self, image, img = None):
+        """
+        Add the image file to the cache, img is an already decoded version (e.g. the preview)
+        """
+        name = self.entry_name(image)
+        if img is None:
+            with Image.open(image) as img:
+                # the decoder scales down while decoding (to at least the fitted size)
+                data = self.render(draft_fitted(img, self.screen_w, self.screen_h))
+        else:
+            data = self.render(img)
+
+        path = os.path.join(self.folder, name)
+        temp = path + ".tmp"
+        with open(temp, "wb") as f:
+            f.write(data)
+        os.replace(temp, path)
+
+        with self.lock:
+            if not name in self.entries:
+                self.entries.append(name)
+                self.entries.sort(reverse=True)
+        self.evict()
+
+    def evict(self):
+        with self.lock:
+            evicted = self.entries[self.max_entries:]
+            del self.entries[self.max_entries:]
+        for name in evicted:
+            try:
+                os.remove(os.path.join(self.folder, name))
+            except OSError:
+                pass
+
+    def scan(self, images_folder):
+        """
+        Add the newest final images of the images folder which are not cached yet
+        (e.g. after the cache was deleted)
+        """
+        images = set(glob.glob(os.path.join(images_folder, "*_montage.jpg")))
+        # a single shot without label is the final image itself
+        for single in glob.glob(os.path.join(images_folder, "*_single.jpg")):
+            if not single.replace("_single.jpg", "_montage.jpg") in images:
+                images.add(single)
+
+        added = 0
+        for image in sorted(images, key=os.path.basename, reverse=True)[:self.max_entries]:
+            if self.contains(image):
+                continue
+            try:
+                self.add(image)
+                added += 1
+            except Exception as e:
+                logger.error("Error creating thumbnail of %s: %s", image, e)
+        logger.info("Thumbnail cache: %s new, %s entries", added, len(self.entries))
+
+    def get_entries(self):
+        with self.lock:
+            return list(self.entries)
+
+    def read(self, name):
+        try:
+            with open(os.path.join(self.folder, name), "rb") as f:
+                return f.read()
+        except (IOError, OSError):
+            # evicted in the meantime
+            return None
+
+
+class Gallery:
+    """
+    Attract mode slideshow of the cached sessions in one overlay,
+    the next slide is read in the background while the current one is shown.
+    Every intro_every slides the overlay is hidden for one slide to show the intro.
+    """
+
+    layer       = 5
+    intro_every = 4
+
+    def __init__(self, camera, cache, config = None):
+        # the picamera object (the overlay is updated in place)
+        self.camera = camera
+        self.cache = cache
+
+        if config is not None and hasattr(config, "gallery_intro_every"):
+            self.intro_every = config.gallery_intro_every
+
+        self.overlay = None
+        self.position = 0
+        self.shown = 0
+        self.next_data = None
+        self.condition = threading.Condition()
+        # (generation, position) of the slide to read, a new generation drops old reads
+        self.request = None
+        self.generation = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def is_running(self):
+        return self.overlay is not None
+
+    def start(self):
+        if self.overlay is not None:
+            return True
+        entries = self.cache.get_entries()
+        if not entries:
+            return False
+        self.position = 0
+        self.shown = 0
+        # the newest session is read directly, it is in the page cache after it was added
+        data = self.cache.read(entries[0])
+        if data is None:
+            return False
+        self.overlay = self.camera.add_overlay(data, size=(self.cache.screen_w, self.cache.screen_h), format='rgb', layer=self.layer)
+        self.position = 1
+        self.prefetch()
+        return True
+
+    def stop(self):
+        if self.overlay is not None:
+            self.camera.remove_overlay(self.overlay)
+            self.overlay = None
+        with self.condition:
+            self.generation += 1
+            self.request = None
+            self.next_data = None
+
+    def show_next(self):
+        """
+        Show the prefetched slide (called from the slideshow timer)
+        """
+        if self.overlay is None:
+            return
+
+        self.shown += 1
+        if self.intro_every > 0 and self.shown % (self.intro_every + 1) == 0:
+            self.overlay.alpha = 0
+            return
+
+        data = self.take()
+        if data is None:
+            # not prefetched yet, the current slide stays
+            return
+        self.overlay.update(data)
+        self.overlay.alpha = 255
+        self.prefetch()
+
+    def take(self):
+        with self.condition:
+            data, self.next_data = self.next_data, None
+            return data
+
+    def prefetch(self):
+        with self.condition:
+            self.request = (self.generation, self.position)
+            self.position += 1
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.request is None:
+                    self.condition.wait()
+                generation, position = self.request
+                self.request = None
+
+            entries = self.cache.get_entries()
+            if not entries:
+                continue
+            data = self.cache.read(entries[position % len(entries)])
+            with self.condition:
+                if generation == self.generation:
+                    self.next_data = data
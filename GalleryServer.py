@@ -0,0 +1,431 @@
+#!/usr/bin/env python3
+"""
+Download server for the guests: serves the sessions of the images folder
+with precomputed thumbnails over the local network.
+
+It runs as a separate process (started by photobooth.py if server_enabled is set)
+with a lower priority, so that serving many phones does not compete with the
+capture path of the booth for the GIL or the CPU.
+
+usage: GalleryServer.py --folder PHOTOS [--port 8080] [--thumbnails FOLDER]
+"""
+
+from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import unquote, urlsplit, parse_qs
+
+import argparse
+import asyncio
+import glob
+import html
+import os
+import subprocess
+import sys
+import logging
+
+from LabelCache import draft_fitted
+
+logger = logging.getLogger("photobooth")
+
+path = os.path.dirname(os.path.realpath(__file__))
+
+REASONS = {
+    200: "OK",
+    206: "Partial Content",
+    304: "Not Modified",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    416: "Range Not Satisfiable",
+    503: "Service Unavailable",
+}
+
+PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><meta name="viewport" content="width=device-width, initial-scale=1">
+<title>Photobooth</title>
+<style>
+body {{ font-family: sans-serif; margin: 0; background: #222; color: #eee; }}
+.grid {{ display: grid; grid-template-columns: repeat(auto-fill, minmax(160px, 1fr)); gap: 8px; padding: 8px; }}
+.grid a {{ color: #eee; text-decoration: none; text-align: center; font-size: 12px; }}
+.grid img {{ width: 100%; }}
+.pages {{ padding: 8px; text-align: center; }}
+.pages a {{ color: #eee; margin: 0 8px; }}
+</style></head>
+<body><div class="grid">
+{items}
+</div><div class="pages">{pages}</div></body></html>
+"""
+
+ITEM = """<a href="/download/{name}"><img src="/thumb/{name}" loading="lazy" alt=""><br>{title}</a>"""
+
+
+class Sessions:
+    """
+    The final images of the images folder (newest first), listed again only when the folder changes
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.mtime = None
+        self.names = []
+        self.lookup = set()
+
+    def get(self):
+        try:
+            mtime = os.stat(self.folder).st_mtime_ns
+        except OSError:
+            return self.names
+        if mtime != self.mtime:
+            images = set(os.path.basename(image) for image in glob.glob(os.path.join(self.folder, "*_montage.jpg")))
+            # a single shot without label is the final image itself
+            for single in glob.glob(os.path.join(self.folder, "*_single.jpg")):
+                single = os.path.basename(single)
+                if not single.replace("_single.jpg", "_montage.jpg") in images:
+                    images.add(single)
+            self.names = sorted(images, reverse=True)
+            self.lookup = set(self.names)
+            self.mtime = mtime
+        return self.names
+
+    def contains(self, name):
+        self.get()
+        return name in self.lookup
+
+
+class Thumbnails:
+    """
+    Small jpeg versions of the final images for the gallery page. They are created
+    in a worker thread when a new session appears, a request for a missing one waits for it.
+    """
+
+    size    = 400
+    quality = 80
+
+    def __init__(self, folder, thumbnails_folder, size = None):
+        self.folder = folder
+        self.thumbnails_folder = thumbnails_folder
+        if size is not None:
+            self.size = size
+        if not os.path.exists(self.thumbnails_folder):
+            os.makedirs(self.thumbnails_folder)
+        # one thread, the thumbnails are created one after the other
+        self.executor = ThreadPoolExecutor(1)
+        self.pending = {}
+
+    def path(self, name):
+        return os.path.join(self.thumbnails_folder, name)
+
+    def is_current(self, name):
+        try:
+            return os.stat(self.path(name)).st_mtime >= os.stat(os.path.join(self.folder, name)).st_mtime
+        except OSError:
+            return False
+
+    def create(self, name):
+        temp = self.path(name) + ".tmp"
+        with Image.open(os.path.join(self.folder, name)) as img:
+            # the jpeg decoder scales down while decoding (to at least the fitted size)
+            draft_fitted(img, self.size, self.size)
+            img.thumbnail((self.size, self.size))
+            img.convert('RGB').save(temp, 'JPEG', quality=self.quality)
+        os.replace(temp, self.path(name))
+
+    async def get(self, name):
+        """
+        Return the path of the thumbnail, create it if needed
+        """
+        if self.is_current(name):
+            return self.path(name)
+        future = self.pending.get(name)
+        if future is None:
+            future = asyncio.get_running_loop().run_in_executor(self.executor, self.create, name)
+            self.pending[name] = future
+            future.add_done_callback(lambda _: self.pending.pop(name, None))
+        await future
+        return self.path(name)
+
+    async def precompute(self, names):
+        for name in names:
+            if not self.is_current(name):
+                try:
+                    await self.get(name)
+                except Exception as e:
+                    logger.error("Error creating thumbnail of %s: %s", name, e)
+
+
+class GalleryServer:
+    """
+    HTTP/1.1 server on asyncio streams: GET and HEAD, keep-alive,
+    ETag/Last-Modified revalidation, single byte ranges and sendfile for the file bodies.
+    More than max_connections connections are answered with 503,
+    at most max_transfers files are sent at the same time.
+    """
+
+    host            = "0.0.0.0"
+    port            = 8080
+    max_connections = 32
+    max_transfers   = 4
+    page_size       = 60
+    idle_timeout    = 15
+    scan_interval   = 5
+
+    def __init__(self, folder, thumbnails_folder, port = None, host = None, max_connections = None, max_transfers = None, thumbnail_size = None):
+        if port is not None:
+            self.port = port
+        if host is not None:
+            self.host = host
+        if max_connections is not None:
+            self.max_connections = max_connections
+        if max_transfers is not None:
+            self.max_transfers = max_transfers
+
+        self.folder = folder
+        self.sessions = Sessions(folder)
+        self.thumbnails = Thumbnails(folder, thumbnails_folder, thumbnail_size)
+        self.connections = 0
+        self.transfers = None
+        self.scanner = None
+
+    async def serve(self):
+        self.transfers = asyncio.Semaphore(self.max_transfers)
+        server = await asyncio.start_server(self.handle, self.host, self.port)
+        logger.info("Gallery server on %s:%s serving %s", self.host, self.port, self.folder)
+        self.scanner = asyncio.get_running_loop().create_task(self.scan())
+        async with server:
+            await server.serve_forever()
+
+    async def scan(self):
+        # the thumbnails of new sessions are created before the first guest asks for them
+        while True:
+            await self.thumbnails.precompute(self.sessions.get())
+            await asyncio.sleep(self.scan_interval)
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        try:
+            if self.connections > self.max_connections:
+                await self.respond(writer, 503, {"Retry-After": "5", "Connection": "close"}, b"busy")
+                return
+            while True:
+                try:
+                    request = await asyncio.wait_for(self.read_request(reader), self.idle_timeout)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    return
+                if request is None:
+                    await self.respond(writer, 400, {"Connection": "close"}, b"bad request")
+                    return
+                method, target, headers = request
+                keep_alive = headers.get("connection", "").lower() != "close"
+                await self.dispatch(writer, method, target, headers, keep_alive)
+                if not keep_alive:
+                    return
+        except ConnectionError:
+            pass
+        except Exception as e:
+            logger.error("Gallery server error: %s", e)
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    async def read_request(self, reader):
+        line = await reader.readuntil(b"\r\n")
+        parts = line.decode("latin-1").split()
+        if len(parts) != 3 or not parts[2].startswith("HTTP/"):
+            return None
+        headers = {}
+        while True:
+            line = await reader.readuntil(b"\r\n")
+            if line == b"\r\n":
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+            if len(headers) > 100:
+                return None
+        return parts[0], parts[1], headers
+
+    async def dispatch(self, writer, method, target, headers, keep_alive):
+        connection = {"Connection": "keep-alive" if keep_alive else "close"}
+        if method not in ("GET", "HEAD"):
+            await self.respond(writer, 405, dict(connection, Allow="GET, HEAD"), b"method not allowed")
+            return
+        head = method == "HEAD"
+        url = urlsplit(target)
+        route, _, name = unquote(url.path).lstrip("/").partition("/")
+
+        if route == "":
+            page = parse_qs(url.query).get("page", ["1"])[0]
+            body = self.index(int(page) if page.isdigit() else 1).encode("utf-8")
+            await self.respond(writer, 200, dict(connection, **{"Content-Type": "text/html; charset=utf-8", "Cache-Control": "no-cache"}), body, head)
+        elif route in ("photo", "download", "thumb") and name == os.path.basename(name) and self.sessions.contains(name):
+            if route == "thumb":
+                filename = await self.thumbnails.get(name)
+                extra = {}
+            else:
+                filename = os.path.join(self.folder, name)
+                extra = {"Content-Disposition": 'attachment; filename="%s"' % name} if route == "download" else {}
+            await self.send_file(writer, filename, headers, dict(connection, **extra), head)
+        else:
+            await self.respond(writer, 404, connection, b"not found", head)
+
+    def index(self, page):
+        names = self.sessions.get()
+        pages = max(1, (len(names) + self.page_size - 1) // self.page_size)
+        page = min(max(page, 1), pages)
+        items = []
+        for name in names[(page - 1) * self.page_size:page * self.page_size]:
+            # the name starts with the timestamp of the session, e.g. 2018-06-01_20-15-00_montage.jpg
+            title = name.rsplit("_", 1)[0].replace("_", " ")
+            items.append(ITEM.format(name=html.escape(name), title=html.escape(title)))
+        links = []
+        if page > 1:
+            links.append('<a href="/?page=%s">&lt;</a>' % (page - 1))
+        if page < pages:
+            links.append('<a href="/?page=%s">&gt;</a>' % (page + 1))
+        return PAGE.format(items="\n".join(items), pages=" ".join(links))
+
+    def parse_range(self, value, size):
+        """
+        Return (start, end) of a single byte range (end inclusive), None if it is not satisfiable
+        """
+        unit, _, spec = value.partition("=")
+        if unit.strip() != "bytes" or "," in spec:
+            return None
+        first, _, last = spec.strip().partition("-")
+        try:
+            if first == "":
+                # the last n bytes
+                length = int(last)
+                if length <= 0:
+                    return None
+                return max(0, size - length), size - 1
+            start = int(first)
+            end = int(last) if last else size - 1
+        except ValueError:
+            return None
+        if start >= size or end < start:
+            return None
+        return start, min(end, size - 1)
+
+    def not_modified(self, headers, etag, mtime):
+        if "if-none-match" in headers:
+            return etag in [tag.strip() for tag in headers["if-none-match"].split(",")] or headers["if-none-match"].strip() == "*"
+        if "if-modified-since" in headers:
+            try:
+                return int(mtime) <= parsedate_to_datetime(headers["if-modified-since"]).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    async def send_file(self, writer, filename, headers, extra, head = False):
+        try:
+            f = open(filename, "rb")
+        except OSError:
+            await self.respond(writer, 404, extra, b"not found", head)
+            return
+        with f:
+            stat = os.fstat(f.fileno())
+            size = stat.st_size
+            etag = '"%x-%x"' % (stat.st_mtime_ns, size)
+            response = dict(extra, **{
+                "Content-Type": "image/jpeg",
+                "ETag": etag,
+                "Last-Modified": formatdate(stat.st_mtime, usegmt=True),
+                # the images are named after the timestamp and are never changed
+                "Cache-Control": "public, max-age=86400",
+                "Accept-Ranges": "bytes",
+            })
+            if self.not_modified(headers, etag, stat.st_mtime):
+                await self.respond(writer, 304, response, b"", True)
+                return
+
+            status = 200
+            start, end = 0, size - 1
+            # a range of another version of the file (If-Range) is answered with the whole file
+            if "range" in headers and headers.get("if-range", etag) == etag:
+                byte_range = self.parse_range(headers["range"], size)
+                if byte_range is None:
+                    await self.respond(writer, 416, dict(extra, **{"Content-Range": "bytes */%s" % size}), b"", head)
+                    return
+                status = 206
+                start, end = byte_range
+                response["Content-Range"] = "bytes %s-%s/%s" % (start, end, size)
+
+            count = end - start + 1 if size > 0 else 0
+            self.write_head(writer, status, response, count)
+            if head or count == 0:
+                await writer.drain()
+                return
+            async with self.transfers:
+                await writer.drain()
+                # zero copy from the page cache to the socket (falls back to read/send)
+                await asyncio.get_running_loop().sendfile(writer.transport, f, start, count)
+
+    def write_head(self, writer, status, headers, length):
+        lines = ["HTTP/1.1 %s %s" % (status, REASONS[status]), "Server: photobooth"]
+        if status != 304:
+            lines.append("Content-Length: %s" % length)
+        lines.extend("%s: %s" % (name, value) for name, value in headers.items())
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+
+    async def respond(self, writer, status, headers, body, head = False):
+        if status != 304 and not "Content-Type" in headers:
+            headers = dict(headers, **{"Content-Type": "text/plain; charset=utf-8"})
+        self.write_head(writer, status, headers, len(body))
+        if not head and status != 304:
+            writer.write(body)
+        await writer.drain()
+
+
+def spawn(config, images_folder):
+    """
+    Start the server process if config.server_enabled is set, returns the process or None
+    """
+    if not hasattr(config, "server_enabled") or not config.server_enabled:
+        return None
+    command = [sys.executable, os.path.realpath(__file__), "--folder", images_folder]
+    options = {
+        "server_port": "--port",
+        "server_host": "--host",
+        "server_thumbnails_folder": "--thumbnails",
+        "server_thumbnail_size": "--thumbnail-size",
+        "server_max_connections": "--max-connections",
+        "server_max_transfers": "--max-transfers",
+    }
+    for name, option in options.items():
+        if hasattr(config, name):
+            command.extend([option, str(getattr(config, name))])
+    process = subprocess.Popen(command)
+    logger.info("Gallery server started (pid %s)", process.pid)
+    return process
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Gallery and download server of the photobooth")
+    parser.add_argument("--folder", required=True, help="images folder")
+    parser.add_argument("--thumbnails", default=path + "/web_thumbnails", help="folder of the thumbnails")
+    parser.add_argument("--thumbnail-size", type=int)
+    parser.add_argument("--host")
+    parser.add_argument("--port", type=int)
+    parser.add_argument("--max-connections", type=int)
+    parser.add_argument("--max-transfers", type=int)
+    parser.add_argument("--nice", type=int, default=10, help="lower priority than the booth")
+    args = parser.parse_args()
+
+    handler = logging.FileHandler(path + '/photobooth.log')
+    handler.setFormatter(logging.Formatter('%(asctime)s | %(levelname)s | server | %(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+
+    if args.nice:
+        os.nice(args.nice)
+
+    server = GalleryServer(args.folder, args.thumbnails, args.port, args.host, args.max_connections, args.max_transfers, args.thumbnail_size)
+    try:
+        asyncio.run(server.serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,55 +1,170 @@
 #!/usr/bin/env python3
 
-import Adafruit_WS2801
-import Adafruit_GPIO.SPI as SPI
+from time import monotonic
+
+import threading
 
 class LEDs:
+    """
+    Animation engine for the WS2801 strip.
+    The frames of every effect are precomputed as byte strings and a dedicated thread
+    writes the current frame with one SPI write when the animation reaches the next frame
+    (at most fps frames per second) and sleeps in between.
+    The effect can be switched from any thread.
+    """
 
-    rainbow_index = 0
+    fps             = 30
+    rainbow_speed   = 10      # rainbow steps per second
+
+    def __init__(self, SPI_PORT = 0, SPI_DEVICE = 0, PIXEL_COUNT = 14, spi = None, config = None):
+        if spi is None:
+            import Adafruit_GPIO.SPI as SPI
+            spi = SPI.SpiDev(SPI_PORT, SPI_DEVICE)
+            # WS2801 is SPI mode 0, MSB first
+            spi.set_mode(0)
+            spi.set_bit_order(SPI.MSBFIRST)
+            spi.set_clock_hz(1000000)
+        self.spi = spi
+        self.count = PIXEL_COUNT
+
+        if config is not None:
+            if hasattr(config, "led_fps"):
+                self.fps = config.led_fps
+            if hasattr(config, "led_rainbow_speed"):
+                self.rainbow_speed = config.led_rainbow_speed
+
+        self.off_frame = bytes(3 * self.count)
+        self.rainbow_frames = self.create_rainbow_frames()
+
+        self.condition = threading.Condition()
+        self.frames = [self.off_frame]
+        self.frame_duration = 0
+        self.loop = False
+        self.started = monotonic()
+        # incremented by every set_effect, so that a change during the SPI write is not missed
+        self.generation = 0
+        self.last_frame = None
+        self.running = True
+
+        self.thread = threading.Thread(target=self.run, name="leds", daemon=True)
+        self.thread.start()
 
-    def __init__(self, SPI_PORT = 0, SPI_DEVICE = 0, PIXEL_COUNT = 14):
-        self.pixels = Adafruit_WS2801.WS2801Pixels(PIXEL_COUNT, spi=SPI.SpiDev(SPI_PORT, SPI_DEVICE))
-        self.clear()
-        
-    def clear(self):
-        self.pixels.clear()
-        self.pixels.show()
-        
-    def show(self, r, g, b):
-        for i in range(self.pixels.count()):
-            self.pixels.set_pixel_rgb(i, r, g, b)
-        self.pixels.show()
-        
     def wheel(self, pos):
         """
         Define the wheel function to interpolate between different hues.
         """
         if pos < 85:
-            return Adafruit_WS2801.RGB_to_color(pos * 3, 255 - pos * 3, 0)
+            return (pos * 3, 255 - pos * 3, 0)
         elif pos < 170:
             pos -= 85
-            return Adafruit_WS2801.RGB_to_color(255 - pos * 3, 0, pos * 3)
+            return (255 - pos * 3, 0, pos * 3)
         else:
             pos -= 170
-            return Adafruit_WS2801.RGB_to_color(0, pos * 3, 255 - pos * 3)    
+            return (0, pos * 3, 255 - pos * 3)
 
-    """
-    def rainbow_cycle(self):
-        for j in range(256): # one cycle of all 256 colors in the wheel
-            for i in range(self.pixels.count()):
-                # tricky math! we use each pixel as a fraction of the full 96-color wheel
-                # (thats the i / strip.numPixels() part)
-                # Then add in j which makes the colors go around per pixel
-                # the % 96 is to make the wheel cycle around
-                self.pixels.set_pixel(i, self.wheel(((i * 256 // self.pixels.count()) + j) % 256) )
-                self.pixels.show()        
-    """
-    def rainbow_step(self):
-        for i in range(self.pixels.count()):
-            self.pixels.set_pixel(i, self.wheel(((i * 256 // self.pixels.count()) + self.rainbow_index) % 256) )
-        self.pixels.show()   
-        
-        self.rainbow_index += 1
-        if self.rainbow_index >= 255:
-            self.rainbow_index = 0
-        
\ No newline at end of file
+    def solid_frame(self, r, g, b):
+        return bytes((r, g, b)) * self.count
+
+    def create_rainbow_frames(self):
+        # each pixel is a fraction of the full color wheel, the frame index rotates the wheel
+        colors = [self.wheel(pos) for pos in range(256)]
+        frames = []
+        for index in range(255):
+            frame = bytearray()
+            for i in range(self.count):
+                frame.extend(colors[((i * 256 // self.count) + index) % 256])
+            frames.append(bytes(frame))
+        return frames
+
+    def set_effect(self, frames, frame_duration = 0, loop = True):
+        """
+        Show the frames (one after another every frame_duration seconds)
+        """
+        with self.condition:
+            self.frames = frames
+            self.frame_duration = frame_duration
+            self.loop = loop
+            self.started = monotonic()
+            self.generation += 1
+            self.condition.notify()
+
+    def clear(self):
+        self.set_effect([self.off_frame])
+
+    def show(self, r, g, b):
+        self.set_effect([self.solid_frame(r, g, b)])
+
+    def flash(self):
+        self.show(255, 255, 255)
+
+    def rainbow(self):
+        self.set_effect(self.rainbow_frames, 1.0 / self.rainbow_speed)
+
+    def current_frame(self):
+        # must be called with the lock
+        if len(self.frames) == 1 or self.frame_duration <= 0:
+            return self.frames[0]
+        index = int((monotonic() - self.started) / self.frame_duration)
+        if self.loop:
+            index %= len(self.frames)
+        else:
+            index = min(index, len(self.frames) - 1)
+        return self.frames[index]
+
+    def next_change(self):
+        """
+        Time of the next frame of the animation (must be called with the lock)
+        """
+        steps = int((monotonic() - self.started) / self.frame_duration) + 1
+        return self.started + steps * self.frame_duration
+
+    def is_static(self):
+        # must be called with the lock
+        if len(self.frames) == 1 or self.frame_duration <= 0:
+            return True
+        return not self.loop and monotonic() - self.started >= self.frame_duration * (len(self.frames) - 1)
+
+    def run(self):
+        interval = 1.0 / self.fps
+        next_frame = monotonic()
+        while True:
+            with self.condition:
+                if not self.running:
+                    break
+                frame = self.current_frame()
+                static = self.is_static()
+                generation = self.generation
+
+            # skip the SPI write if nothing changed
+            if frame is not self.last_frame and frame != self.last_frame:
+                self.spi.write(frame)
+                self.last_frame = frame
+
+            with self.condition:
+                if not self.running:
+                    break
+                if self.generation != generation:
+                    # the effect was changed while the frame was written
+                    next_frame = monotonic()
+                elif static:
+                    # nothing to animate, sleep until the effect is changed
+                    while self.running and self.generation == generation:
+                        self.condition.wait()
+                    next_frame = monotonic()
+                else:
+                    # sleep until the frame changes, but not shorter than one fps interval
+                    next_frame = max(self.next_change(), next_frame + interval)
+                    now = monotonic()
+                    if next_frame < now:
+                        # too late, do not try to catch up
+                        next_frame = now
+                    self.condition.wait(next_frame - now)
+
+    def stop(self):
+        self.clear()
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join(1)
+        # the last frame should be dark
+        self.spi.write(self.off_frame)
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+from PIL import Image
+
+import threading
+import os
+import logging
+
+logger = logging.getLogger("photobooth")
+
+def fit_image(img, width, height):
+    """
+    Resize the image so that it fits into width x height (keeping the aspect ratio)
+    like the ImageMagick read modifier `image.jpg[WxH]`
+    """
+    if img.size == (width, height):
+        return img
+    scale = min(width / img.size[0], height / img.size[1])
+    size = (max(1, round(img.size[0] * scale)), max(1, round(img.size[1] * scale)))
+    if size == img.size:
+        # already fitted (e.g. the cached label)
+        return img
+    return img.resize(size, Image.LANCZOS)
+
+
+def draft_fitted(img, width, height):
+    """
+    Let the jpeg decoder scale the opened image down by 1/2, 1/4 or 1/8 while decoding.
+    draft only scales down while both sides stay at least the requested size,
+    so it gets the fitted size (e.g. 900x600 of 1920x1280 on a 1024x600 screen
+    is decoded at 960x640) and not width x height (decoded at full size)
+    """
+    scale = min(width / img.size[0], height / img.size[1])
+    if scale < 1:
+        img.draft('RGB', (round(img.size[0] * scale), round(img.size[1] * scale)))
+    return img
+
+
+class LabelCache:
+    """
+    The label decoded and fitted to width x label_h once, so that the compositor only pastes it.
+    The label file (usually on the USB stick) is read again only when its mtime changes.
+    When the file can not be reached (e.g. the stick was removed during the event)
+    the cached label is used. A local copy of the fitted label (cache_file) is used
+    after a restart without the stick and by the ImageMagick backend.
+    """
+
+    cache_file = os.path.dirname(os.path.realpath(__file__)) + '/label_cache.png'
+
+    def __init__(self, path, width, height, config = None):
+        if config is not None and hasattr(config, "label_cache_file"):
+            self.cache_file = config.label_cache_file
+
+        self.path = path
+        self.width = width
+        self.height = height
+
+        self.image = None
+        self.mtime = None
+        self.missing = False
+        self.lock = threading.Lock()
+
+    def load(self):
+        """
+        Load the label at startup, returns False if there is neither the label file nor a local copy
+        """
+        with self.lock:
+            if self.refresh():
+                return True
+            try:
+                with Image.open(self.cache_file) as img:
+                    img = img.convert('RGB')
+            except (IOError, OSError):
+                return False
+            # the copy of a different label size (e.g. after a config change) is fitted again
+            self.image = fit_image(img, self.width, self.height)
+            print("label %s not found - using the copy %s" % (self.path, self.cache_file))
+            logger.warning("Label %s not found, using the copy %s", self.path, self.cache_file)
+            return True
+
+    def refresh(self):
+        # must be called with the lock, returns whether a label is available
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            if not self.missing:
+                logger.warning("Label %s is not available, using the cached label", self.path)
+                self.missing = True
+            return self.image is not None
+
+        if self.missing:
+            logger.info("Label %s is available again", self.path)
+            self.missing = False
+        if mtime == self.mtime:
+            return True
+
+        try:
+            with Image.open(self.path) as img:
+                image = fit_image(img.convert('RGB'), self.width, self.height)
+        except (IOError, OSError) as e:
+            # e.g. the stick is removed while reading or the file is written right now
+            logger.error("Error loading the label %s: %s", self.path, e)
+            return self.image is not None
+
+        self.image = image
+        self.mtime = mtime
+        logger.info("Label %s loaded (%sx%s)", self.path, image.size[0], image.size[1])
+        self.store()
+        return True
+
+    def store(self):
+        # must be called with the lock
+        temp = self.cache_file + ".tmp"
+        try:
+            self.image.save(temp, 'PNG')
+            os.replace(temp, self.cache_file)
+        except (IOError, OSError) as e:
+            logger.error("Error saving the label copy %s: %s", self.cache_file, e)
+
+    def get(self):
+        """
+        Return the fitted label image
+        """
+        with self.lock:
+            self.refresh()
+            return self.image
+
+    def get_file(self):
+        """
+        Return the local copy of the fitted label (for the ImageMagick backend)
+        """
+        with self.lock:
+            self.refresh()
+            return self.cache_file if self.image is not None else None
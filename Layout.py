@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+import math
+import logging
+
+logger = logging.getLogger("photobooth")
+
+class LayoutError(ValueError):
+    pass
+
+
+class Slot:
+    """
+    Pixel box of one photo in the final image and the index of the frame shown in it
+    """
+
+    def __init__(self, x, y, w, h, frame):
+        self.x = x
+        self.y = y
+        self.w = w
+        self.h = h
+        self.frame = frame
+
+    def box(self):
+        return (self.x, self.y, self.x + self.w, self.y + self.h)
+
+    def crop(self, size):
+        """
+        Center crop box of an image of the given size with the aspect ratio of the slot
+        """
+        width, height = size
+        if width * self.h > height * self.w:
+            # too wide
+            crop_w = max(1, round(height * self.w / self.h))
+            left = (width - crop_w) // 2
+            return (left, 0, left + crop_w, height)
+        crop_h = max(1, round(width * self.h / self.w))
+        top = (height - crop_h) // 2
+        return (0, top, width, top + crop_h)
+
+
+class Layout:
+    """
+    Geometry of a montage: the canvas size, the photo slots and the label box.
+    Templates are declarative: the slots are (x, y, w, h[, frame]) fractions of the photo area
+    (the canvas without the label band) and every slot is inset by spacing pixels.
+    Everything is computed once when the layout is created.
+    """
+
+    def __init__(self, name, photo_w, photo_h, template, image_count, label_h = 0, label_position = "bottom", sensor_size = None):
+        self.name = name
+        self.image_count = image_count
+        self.spacing = template.get("spacing", 0)
+        self.background = tuple(template.get("background", (255, 255, 255)))
+        # grid size for the ImageMagick backend (None for other layouts)
+        self.columns = template.get("columns")
+        self.rows = template.get("rows")
+
+        self.width = photo_w
+        self.height = photo_h + label_h
+        top = 0
+        self.label = None
+        if label_h > 0:
+            if label_position == "top":
+                self.label = Slot(0, 0, photo_w, label_h, None)
+                top = label_h
+            elif label_position == "bottom":
+                self.label = Slot(0, photo_h, photo_w, label_h, None)
+            else:
+                raise LayoutError("%s: unknown label position %s" % (name, label_position))
+
+        self.slots = []
+        for index, slot in enumerate(template.get("slots", [])):
+            if len(slot) == 4:
+                x, y, w, h = slot
+                frame = index
+            elif len(slot) == 5:
+                x, y, w, h, frame = slot
+            else:
+                raise LayoutError("%s: slot %s must be (x, y, w, h) or (x, y, w, h, frame)" % (name, index + 1))
+            if x < 0 or y < 0 or w <= 0 or h <= 0 or x + w > 1.0001 or y + h > 1.0001:
+                raise LayoutError("%s: slot %s %s is outside of the photo area" % (name, index + 1, slot))
+            left = round(x * photo_w) + self.spacing
+            upper = top + round(y * photo_h) + self.spacing
+            right = round((x + w) * photo_w) - self.spacing
+            lower = top + round((y + h) * photo_h) - self.spacing
+            self.slots.append(Slot(left, upper, right - left, lower - upper, frame))
+
+        self.validate()
+
+        # capture size per frame: the sensor aspect ratio covering the largest slot of the frame
+        # (the frame is cropped to the slot in the montage instead of being distorted)
+        sensor_w, sensor_h = sensor_size if sensor_size is not None else (photo_w, photo_h)
+        self.capture_sizes = []
+        for frame in range(image_count):
+            scale = max(max(slot.w / sensor_w, slot.h / sensor_h) for slot in self.slots if slot.frame == frame)
+            self.capture_sizes.append((min(sensor_w, math.ceil(sensor_w * scale)), min(sensor_h, math.ceil(sensor_h * scale))))
+
+    def validate(self):
+        if not self.slots:
+            raise LayoutError("%s: no slots" % self.name)
+        for index, slot in enumerate(self.slots):
+            if slot.w < 16 or slot.h < 16:
+                raise LayoutError("%s: slot %s is too small (%sx%s px)" % (self.name, index + 1, slot.w, slot.h))
+            if not 0 <= slot.frame < self.image_count:
+                raise LayoutError("%s: slot %s shows frame %s but there are %s frames" % (self.name, index + 1, slot.frame + 1, self.image_count))
+        missing = set(range(self.image_count)) - set(slot.frame for slot in self.slots)
+        if missing:
+            raise LayoutError("%s: no slot for frame %s (image_count is %s)" % (self.name, min(missing) + 1, self.image_count))
+
+    def capture_size(self, frame):
+        return self.capture_sizes[frame]
+
+    def describe(self):
+        return "%s: %sx%s, %s slots for %s frames, capture %s" % (self.name, self.width, self.height, len(self.slots), self.image_count,
+            ", ".join("%sx%s" % size for size in self.capture_sizes))
+
+
+def grid_template(count, columns, spacing):
+    columns = max(1, min(columns, count))
+    rows = (count + columns - 1) // columns
+    return {
+        "columns": columns,
+        "rows": rows,
+        "spacing": spacing,
+        "slots": [((index % columns) / columns, (index // columns) / rows, 1 / columns, 1 / rows) for index in range(count)],
+    }
+
+
+def strip_template(count, spacing):
+    # two identical 1 x count strips side by side (the print is cut in the middle)
+    slots = []
+    for column in range(2):
+        for index in range(count):
+            slots.append((column / 2, index / count, 1 / 2, 1 / count, index))
+    return {"spacing": spacing, "slots": slots}
+
+
+def feature_template(count, spacing):
+    # the first photo large on the left, the others stacked on the right third
+    if count == 1:
+        return grid_template(1, 1, spacing)
+    others = count - 1
+    slots = [(0, 0, 2 / 3, 1)]
+    for index in range(others):
+        slots.append((2 / 3, index / others, 1 / 3, 1 / others))
+    return {"spacing": spacing, "slots": slots}
+
+
+def create_layout(config, photo_w, photo_h, label_h = 0, image_count = 4, multi = True, sensor_size = None):
+    """
+    Create the layout of the multi shots (montage_layout) or of the single shot
+    """
+    name = "grid"
+    columns = 2
+    spacing = 10
+    label_position = "bottom"
+    if config is not None:
+        if hasattr(config, "montage_layout"):
+            name = config.montage_layout
+        if hasattr(config, "montage_columns"):
+            columns = config.montage_columns
+        if hasattr(config, "montage_spacing"):
+            spacing = config.montage_spacing
+        if hasattr(config, "label_position"):
+            label_position = config.label_position
+
+    if not multi:
+        # the single shot fills the photo area
+        name, template, image_count = "single", grid_template(1, 1, 0), 1
+    elif isinstance(name, dict):
+        template = name
+        name = "template"
+    elif name == "grid":
+        template = grid_template(image_count, columns, spacing)
+    elif name == "strip":
+        template = strip_template(image_count, spacing)
+    elif name == "feature":
+        template = feature_template(image_count, spacing)
+    else:
+        raise LayoutError("unknown montage layout %s" % name)
+
+    layout = Layout(name, photo_w, photo_h, template, image_count, label_h, label_position, sensor_size)
+    logger.info("Layout %s", layout.describe())
+    return layout
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+from time import perf_counter, time
+
+import bisect
+import json
+import os
+import threading
+import logging
+
+logger = logging.getLogger("photobooth")
+
+# upper bounds in seconds, from a button latency up to a print job
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+class Histogram:
+    """
+    Count of the observations per bucket (not cumulative), sum and count
+    """
+
+    def __init__(self, buckets = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            yield bound, total
+
+
+class Span:
+    """
+    A running measurement, stopped by the context manager or stop()
+    (which can be called from another thread)
+    """
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.start = perf_counter()
+        self.duration = None
+
+    def stop(self):
+        # only the first stop is recorded
+        if self.duration is None:
+            self.duration = perf_counter() - self.start
+            self.metrics.observe(self.name, self.duration, **self.labels)
+        return self.duration
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
+
+
+class Metrics:
+    """
+    Timing histograms of the session phases, written periodically into a metrics file:
+    "prometheus" rewrites a text file in the Prometheus exposition format
+    (e.g. for the textfile collector of the node exporter),
+    "jsonl" appends a snapshot of all histograms as one json object per line.
+    Observing is a bisect and three additions under a lock, the file is only
+    written from the background thread when something changed.
+    """
+
+    filename = os.path.dirname(os.path.realpath(__file__)) + '/metrics.prom'
+    prefix = "photobooth_"
+
+    def __init__(self):
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.format = "prometheus"
+        self.interval = 10
+        self.enabled = True
+        self.changed = False
+        self.running = False
+        self.thread = None
+
+    def configure(self, config):
+        if hasattr(config, "metrics_enabled"):
+            self.enabled = config.metrics_enabled
+        if hasattr(config, "metrics_file"):
+            self.filename = config.metrics_file
+        if hasattr(config, "metrics_format"):
+            self.format = config.metrics_format
+        if hasattr(config, "metrics_interval"):
+            self.interval = config.metrics_interval
+
+    def span(self, name, **labels):
+        return Span(self, name, labels)
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+            self.changed = True
+
+    def summary(self):
+        """
+        Count and mean per histogram, e.g. for the log
+        """
+        with self.lock:
+            return {self.series(name, labels): "%s x %.3fs" % (h.count, h.sum / h.count) for (name, labels), h in sorted(self.histograms.items())}
+
+    def series(self, name, labels, extra = ()):
+        labels = tuple(labels) + tuple(extra)
+        if not labels:
+            return name
+        return name + "{" + ",".join('%s="%s"' % (key, str(value).replace('"', '\\"')) for key, value in labels) + "}"
+
+    def prometheus(self):
+        lines = []
+        typed = set()
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            metric = self.prefix + name + "_seconds"
+            if not metric in typed:
+                lines.append("# TYPE %s histogram" % metric)
+                typed.add(metric)
+            for bound, count in histogram.cumulative():
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                lines.append("%s %s" % (self.series(metric + "_bucket", labels, (("le", le),)), count))
+            lines.append("%s %r" % (self.series(metric + "_sum", labels), histogram.sum))
+            lines.append("%s %s" % (self.series(metric + "_count", labels), histogram.count))
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        return {
+            "time": time(),
+            "histograms": [{
+                "name": name,
+                "labels": dict(labels),
+                "buckets": list(histogram.buckets),
+                "counts": histogram.counts,
+                "sum": histogram.sum,
+                "count": histogram.count,
+            } for (name, labels), histogram in sorted(self.histograms.items())],
+        }
+
+    def write(self):
+        with self.lock:
+            if not self.changed:
+                return
+            self.changed = False
+            if self.format == "jsonl":
+                data = json.dumps(self.snapshot()) + "\n"
+            else:
+                data = self.prometheus()
+
+        try:
+            if self.format == "jsonl":
+                with open(self.filename, "a") as f:
+                    f.write(data)
+            else:
+                # a scraper never reads a partial file
+                temp = self.filename + ".tmp"
+                with open(temp, "w") as f:
+                    f.write(data)
+                os.replace(temp, self.filename)
+        except (IOError, OSError) as e:
+            logger.error("Error writing metrics %s: %s", self.filename, e)
+
+    def start(self):
+        if not self.enabled or self.thread is not None:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            with self.condition:
+                self.running = False
+                self.condition.notify()
+            self.thread.join()
+            self.thread = None
+        if self.enabled:
+            self.write()
+
+    def run(self):
+        while True:
+            with self.condition:
+                if self.running:
+                    self.condition.wait(self.interval)
+                if not self.running:
+                    return
+            self.write()
+
+
+# shared by all modules like the logger
+metrics = Metrics()
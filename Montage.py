@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+from PIL import Image
+from time import perf_counter
+
+import subprocess
+import logging
+
+from Layout import LayoutError, create_layout
+from LabelCache import fit_image
+
+logger = logging.getLogger("photobooth")
+
+class Montage:
+    """
+    In-process replacement for the ImageMagick `montage` calls.
+    Every frame is decoded once, the frames are pasted into the precomputed slots
+    of the layout (see Layout.py) together with the label into a single canvas
+    and the result is encoded once.
+    The default grid layout matches the previous `montage` calls:
+      - multi: `-tile 2x2 -geometry +10+10` (10px spacing around every tile)
+      - label: `-tile 1x2 -geometry +0+0` with the image fitted to photo_w x photo_h
+        and the label fitted to photo_w x label_h
+    """
+
+    photo_w         = 1920
+    photo_h         = 1280
+    label_h         = 0
+    jpeg_quality    = 90
+    reads_memory    = True
+
+    def __init__(self, photo_w, photo_h, label_h = 0, config = None):
+        self.photo_w = photo_w
+        self.photo_h = photo_h
+        self.label_h = label_h
+
+        if config is not None:
+            if hasattr(config, "montage_jpeg_quality"):
+                self.jpeg_quality = config.montage_jpeg_quality
+
+    def fit(self, img, width, height):
+        """
+        Resize the image so that it fits into width x height (keeping the aspect ratio)
+        like the ImageMagick read modifier `image.jpg[WxH]`
+        """
+        return fit_image(img, width, height)
+
+    def load(self, src):
+        """
+        Load a frame from a path, a file object or an already decoded image
+        """
+        if isinstance(src, Image.Image):
+            img = src
+        else:
+            img = Image.open(src)
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+        return img
+
+    def default_layout(self, count, label):
+        # the grid of the previous `montage` calls
+        label_h = self.label_h if label is not None else 0
+        return create_layout(None, self.photo_w, self.photo_h, label_h, count, count > 1)
+
+    def supports(self, layout):
+        return True
+
+    def place(self, img, slot):
+        """
+        Crop the frame to the aspect ratio of the slot and scale it to the slot size
+        (a no-op for the frames which were captured in the slot size)
+        """
+        if img.size == (slot.w, slot.h):
+            return img
+        crop = slot.crop(img.size)
+        if crop != (0, 0) + img.size:
+            img = img.crop(crop)
+        if img.size != (slot.w, slot.h):
+            img = img.resize((slot.w, slot.h), Image.LANCZOS)
+        return img
+
+    def compose(self, frames, label = None, layout = None):
+        """
+        Create the final image from the frames (paths, file objects or images) and the optional label
+        (a path or the already fitted image of the LabelCache which is pasted as it is)
+        """
+        if layout is None:
+            layout = self.default_layout(len(frames), label)
+        if len(frames) != layout.image_count:
+            raise LayoutError("%s frames for the %s layout with %s frames" % (len(frames), layout.name, layout.image_count))
+
+        images = [self.load(src) for src in frames]
+
+        canvas = Image.new('RGB', (layout.width, layout.height), layout.background)
+        for slot in layout.slots:
+            canvas.paste(self.place(images[slot.frame], slot), (slot.x, slot.y))
+
+        if label is not None and layout.label is not None:
+            box = layout.label
+            label = self.fit(self.load(label), box.w, box.h)
+            canvas.paste(label, (box.x + (box.w - label.size[0]) // 2, box.y + (box.h - label.size[1]) // 2))
+        return canvas
+
+    def save(self, img, filename):
+        img.save(filename, 'JPEG', quality=self.jpeg_quality)
+
+    def create(self, frames, filename, label = None, layout = None):
+        start = perf_counter()
+        self.save(self.compose(frames, label, layout), filename)
+        logger.info("Montage (pil) took %.3fs", perf_counter() - start)
+        return filename
+
+
+class MontageImageMagick:
+    """
+    The previous implementation which calls the ImageMagick `montage` binary.
+    Kept as fallback and for timing comparisons (config.montage_backend = "imagemagick")
+    """
+
+    photo_w         = 1920
+    photo_h         = 1280
+    label_h         = 0
+    reads_memory    = False
+
+    def __init__(self, photo_w, photo_h, label_h = 0, config = None):
+        self.photo_w = photo_w
+        self.photo_h = photo_h
+        self.label_h = label_h
+
+    def supports(self, layout):
+        # only grids of equal slots (one per frame) with the label below can be expressed
+        # with `montage -tile -geometry`, other templates are refused at startup
+        if layout.columns is None or len(layout.slots) != layout.image_count:
+            return False
+        first = layout.slots[0]
+        if any(abs(slot.w - first.w) > 1 or abs(slot.h - first.h) > 1 for slot in layout.slots):
+            return False
+        return layout.label is None or layout.label.y > 0
+
+    def create(self, frames, filename, label_path = None, layout = None):
+        start = perf_counter()
+
+        if len(frames) > 1:
+            if layout is None:
+                layout = create_layout(None, self.photo_w, self.photo_h, 0, len(frames), True)
+            # every tile is the slot of the layout plus the spacing around it, so the canvas
+            # has the size of the photo area like the montage of the pil backend
+            # (a frame with another aspect ratio than its slot is fitted, not cropped)
+            slot = layout.slots[0]
+            tile = "%sx%s" % (layout.columns, layout.rows)
+            geometry = "%sx%s+%s+%s" % (slot.w, slot.h, layout.spacing, layout.spacing)
+            background = "rgb(%s,%s,%s)" % layout.background
+            fileNameTemp = filename.replace('_montage.jpg', '_montageTemp.jpg')
+            subprocess.call(["montage"] + list(frames) + ["-tile", tile, "-geometry", geometry, "-background", background, fileNameTemp])
+        else:
+            fileNameTemp = frames[0]
+
+        if label_path is not None:
+            # prepare filename for correct width
+            fileNameTemp = "%s[%sx%s]" % (fileNameTemp, self.photo_w, self.photo_h)
+
+            # append label to image
+            label = "%s[%sx%s]" % (label_path, self.photo_w, self.label_h)
+
+            # when using geometry +0+0 the concatenate mode is selected which is okay here
+            # see http://www.imagemagick.org/Usage/montage/#zero_geometry
+            subprocess.call(["montage", fileNameTemp, label, "-tile", "1x2", "-geometry", "+0+0", filename])
+        else:
+            filename = fileNameTemp
+
+        logger.info("Montage (imagemagick) took %.3fs", perf_counter() - start)
+        return filename
+
+
+def create_montage(photo_w, photo_h, label_h = 0, config = None):
+    backend = "pil"
+    if config is not None and hasattr(config, "montage_backend"):
+        backend = config.montage_backend
+
+    if backend == "imagemagick":
+        return MontageImageMagick(photo_w, photo_h, label_h, config)
+    return Montage(photo_w, photo_h, label_h, config)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+from time import monotonic
+
+import threading
+import heapq
+import itertools
+import logging
+
+logger = logging.getLogger("photobooth")
+
+class OutputPattern:
+    """
+    Handle of a timed output pattern: a list of (level, seconds) steps,
+    repeated until it is cancelled or replaced if repeat is set.
+    After a pattern which is not repeated the pin is set to final (if given).
+    """
+
+    def __init__(self, scheduler, pin, steps, repeat, final = None):
+        self.scheduler = scheduler
+        self.pin = pin
+        self.steps = steps
+        self.repeat = repeat
+        self.final = final
+        self.index = 0
+        self.finished = threading.Event()
+
+    def cancel(self, level = None):
+        """
+        Stop the pattern, the pin is set to level if given
+        """
+        self.scheduler.cancel(self, level)
+
+    def is_active(self):
+        return not self.finished.is_set()
+
+    def wait(self, timeout = None):
+        return self.finished.wait(timeout)
+
+
+class OutputScheduler:
+    """
+    Runs pulses and blink patterns of the GPIO outputs from one timer thread
+    so that no caller sleeps. There is at most one pattern per pin,
+    a new pattern or a direct set() replaces it.
+    """
+
+    def __init__(self, output):
+        self.output = output
+        self.patterns = {}
+        self.timers = []
+        self.counter = itertools.count()
+        self.condition = threading.Condition()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def set(self, pin, level):
+        with self.condition:
+            self.remove(self.patterns.get(pin))
+            self.output(pin, level)
+
+    def pattern(self, pin, steps, repeat = False, final = None):
+        """
+        Start a pattern of (level, seconds) steps on the pin,
+        final is the level after a pattern which is not repeated
+        """
+        pattern = OutputPattern(self, pin, steps, repeat, final)
+        with self.condition:
+            self.remove(self.patterns.get(pin))
+            self.patterns[pin] = pattern
+            self.step(pattern, monotonic())
+            self.condition.notify()
+        return pattern
+
+    def pulse(self, pin, level, seconds, idle):
+        return self.pattern(pin, [(level, seconds)], final=idle)
+
+    def blink(self, pin, interval, on = True, off = False):
+        return self.pattern(pin, [(on, interval), (off, interval)], repeat=True)
+
+    def cancel(self, pattern, level = None):
+        with self.condition:
+            if self.patterns.get(pattern.pin) is pattern:
+                self.remove(pattern)
+                if level is not None:
+                    self.output(pattern.pin, level)
+
+    def remove(self, pattern):
+        # must be called with the lock
+        if pattern is None:
+            return
+        if self.patterns.get(pattern.pin) is pattern:
+            del self.patterns[pattern.pin]
+        pattern.finished.set()
+
+    def step(self, pattern, now):
+        # must be called with the lock, outputs the current step and schedules the next one
+        level, seconds = pattern.steps[pattern.index]
+        self.output(pattern.pin, level)
+        heapq.heappush(self.timers, (now + seconds, next(self.counter), pattern))
+
+    def advance(self, pattern, now):
+        # must be called with the lock
+        pattern.index += 1
+        if pattern.index >= len(pattern.steps):
+            if not pattern.repeat:
+                if pattern.final is not None:
+                    self.output(pattern.pin, pattern.final)
+                self.remove(pattern)
+                return
+            pattern.index = 0
+        self.step(pattern, now)
+
+    def pending(self):
+        # must be called with the lock
+        return [pattern for pattern in self.patterns.values() if not pattern.repeat]
+
+    def run(self):
+        with self.condition:
+            while self.running:
+                # drop the timers of cancelled or replaced patterns
+                while self.timers and self.timers[0][2].finished.is_set():
+                    heapq.heappop(self.timers)
+                if not self.timers:
+                    self.condition.wait()
+                    continue
+                now = monotonic()
+                deadline, _, pattern = self.timers[0]
+                if deadline > now:
+                    self.condition.wait(deadline - now)
+                    continue
+                heapq.heappop(self.timers)
+                try:
+                    # the next step is measured from the deadline so that blinking does not drift
+                    self.advance(pattern, deadline)
+                except Exception as e:
+                    logger.error("Error setting output %s: %s", pattern.pin, e)
+                    self.remove(pattern)
+
+    def stop(self, timeout = None):
+        """
+        Cancel the repeated patterns, wait for the running pulses (e.g. the relay)
+        and stop the thread
+        """
+        with self.condition:
+            for pattern in list(self.patterns.values()):
+                if pattern.repeat:
+                    self.remove(pattern)
+            pulses = self.pending()
+        for pattern in pulses:
+            pattern.wait(timeout)
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+import threading
+import queue
+import logging
+
+logger = logging.getLogger("photobooth")
+
+class PostProcessJob:
+    """
+    The images of one session which are processed in the background.
+    preview_ready is set as soon as a screen sized version can be shown,
+    done is set when the final image and all frames are written.
+    """
+
+    def __init__(self, base_filename, frames, image_mode_multi = False):
+        self.base_filename      = base_filename
+        self.frames             = frames
+        self.image_mode_multi   = image_mode_multi
+        self.final_image        = None
+        self.print_image        = None     # pre-rendered image for the printer
+        self.preview            = None
+        self.files              = []
+        self.error              = None
+        self.preview_ready      = threading.Event()
+        self.done               = threading.Event()
+        self.on_preview         = None     # called (from the worker thread) when the preview is ready
+        self.lock               = threading.Lock()
+
+    def set_preview(self, preview):
+        self.preview = preview
+        self.mark_preview_ready()
+
+    def mark_preview_ready(self):
+        with self.lock:
+            if self.preview_ready.is_set():
+                return
+            self.preview_ready.set()
+        if self.on_preview is not None:
+            self.on_preview(self)
+
+    def is_preview_ready(self):
+        return self.preview_ready.is_set()
+
+    def is_done(self):
+        return self.done.is_set()
+
+    def wait(self, timeout = None):
+        """
+        Wait for the full resolution image and return its filename
+        """
+        self.done.wait(timeout)
+        return self.final_image
+
+
+class PostProcessor:
+    """
+    Worker thread with a bounded job queue which creates the montage,
+    writes the images and runs the on_finished callback (e.g. backups)
+    so that the booth is usable again right after the last shot.
+    """
+
+    queue_size = 2
+
+    def __init__(self, camera, config = None, on_finished = None):
+        self.camera = camera
+        self.on_finished = on_finished
+
+        if config is not None and hasattr(config, "postprocess_queue_size"):
+            self.queue_size = config.postprocess_queue_size
+
+        # submit() blocks when the queue is full so that a fast guest cannot pile up sessions in memory
+        self.jobs = queue.Queue(self.queue_size)
+        self.thread = threading.Thread(target=self.run, name="postprocessor", daemon=True)
+        self.thread.start()
+
+    def submit(self, job):
+        self.jobs.put(job)
+        logger.info("Post processing queued for %s (%s waiting)", job.base_filename, self.jobs.qsize())
+        return job
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                self.jobs.task_done()
+                break
+            self.process(job)
+            self.jobs.task_done()
+
+    def join(self):
+        """
+        Wait until all queued jobs are processed
+        """
+        self.jobs.join()
+
+    def process(self, job):
+        try:
+            self.camera.convertMergeImages(job)
+            job.files = self.camera.save_frames(job)
+            if not job.final_image in job.files:
+                job.files.append(job.final_image)
+        except Exception as e:
+            print("Error while processing images: %s" % e)
+            logger.error("Error while processing images: %s", e)
+            job.error = e
+        finally:
+            # never leave somebody waiting for the preview or the final image
+            job.done.set()
+            job.mark_preview_ready()
+
+        if job.error is None and self.on_finished is not None:
+            try:
+                self.on_finished(job)
+            except Exception as e:
+                print("Error after processing images: %s" % e)
+                logger.error("Error after processing images: %s", e)
+
+    def stop(self):
+        """
+        Finish the queued jobs and stop the worker
+        """
+        self.jobs.put(None)
+        self.thread.join()
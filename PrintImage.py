@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+from PIL import Image
+from time import perf_counter
+
+import glob
+import os
+import tempfile
+import logging
+
+logger = logging.getLogger("photobooth")
+
+class PrintImage:
+    """
+    Renders the final image at the native resolution and page size of the printer
+    (Canon Selphy: 148x100mm at 300dpi) so that CUPS does not need to scale it.
+    The images are written into their own folder (not the images folder, they are not archived)
+    which keeps the print images of the last keep_sessions sessions, images which are
+    still in use (in_use() returns their paths, e.g. a queued print) are deleted later.
+    """
+
+    enabled     = True
+    page_w_mm   = 148
+    page_h_mm   = 100
+    dpi         = 300
+    rotate      = 0         # e.g. 90 if the printer expects portrait pages
+    format      = "png"     # png (lossless, fast to decode) or jpeg
+    background  = (255, 255, 255)
+    folder      = os.path.join(tempfile.gettempdir(), "photobooth-print")
+    keep_sessions = 2
+    in_use      = None
+
+    def __init__(self, config = None):
+        if config is not None:
+            if hasattr(config, "print_prerender"):
+                self.enabled = config.print_prerender
+            if hasattr(config, "print_page_mm"):
+                self.page_w_mm, self.page_h_mm = config.print_page_mm
+            if hasattr(config, "print_dpi"):
+                self.dpi = config.print_dpi
+            if hasattr(config, "print_rotate"):
+                self.rotate = config.print_rotate
+            if hasattr(config, "print_format"):
+                self.format = config.print_format
+            if hasattr(config, "print_folder") and config.print_folder is not None:
+                self.folder = config.print_folder
+            if hasattr(config, "print_keep_sessions"):
+                self.keep_sessions = config.print_keep_sessions
+
+    def page_size(self):
+        return (round(self.page_w_mm / 25.4 * self.dpi), round(self.page_h_mm / 25.4 * self.dpi))
+
+    def options(self):
+        """
+        CUPS options for a pre-rendered image (print it pixel by pixel)
+        """
+        return {"ppi": str(self.dpi)}
+
+    def render(self, img):
+        """
+        Fit the image into the page (centered, keeping the aspect ratio)
+        """
+        if isinstance(img, str):
+            img = Image.open(img)
+            # let the jpeg decoder scale down while decoding
+            img.draft('RGB', self.page_size())
+
+        if self.rotate:
+            img = img.rotate(self.rotate, expand=True)
+
+        page_w, page_h = self.page_size()
+        scale = min(page_w / img.size[0], page_h / img.size[1])
+        size = (round(img.size[0] * scale), round(img.size[1] * scale))
+        img = img.convert('RGB').resize(size, Image.LANCZOS)
+
+        page = Image.new('RGB', (page_w, page_h), self.background)
+        page.paste(img, ((page_w - size[0]) // 2, (page_h - size[1]) // 2))
+        return page
+
+    def create(self, img, base_filename):
+        """
+        Write the print-ready image into the print folder and return its filename
+        """
+        start = perf_counter()
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+        self.cleanup()
+        base_filename = os.path.join(self.folder, os.path.basename(base_filename))
+        if self.format == "jpeg":
+            filename = base_filename + '_print.jpg'
+            self.render(img).save(filename, 'JPEG', quality=95)
+        else:
+            filename = base_filename + '_print.png'
+            # fastest compression: the file is only read once by CUPS, encoding and decoding speed matters
+            self.render(img).save(filename, 'PNG', compress_level=1)
+        logger.info("Print image %s created in %.3fs", filename, perf_counter() - start)
+        return filename
+
+    def cleanup(self):
+        """
+        Delete the print images before the last keep_sessions (the new one is not written yet)
+        """
+        paths = sorted(glob.glob(os.path.join(self.folder, "*_print.*")), key=os.path.getmtime)
+        kept = set(self.in_use()) if self.in_use is not None else set()
+        for path in paths[:max(len(paths) - self.keep_sessions + 1, 0)]:
+            if path in kept:
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                pass
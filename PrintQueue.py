@@ -0,0 +1,401 @@
+#!/usr/bin/env python3
+
+from time import time
+
+import threading
+import collections
+import itertools
+import json
+import os
+import logging
+
+from Metrics import metrics
+from PrinterMonitor import JOB_HELD, JOB_PROCESSING, JOB_STOPPED, JOB_CANCELED, JOB_ABORTED, JOB_COMPLETED
+
+logger = logging.getLogger("photobooth")
+
+# states of a print job
+QUEUED      = "queued"      # waiting in the print queue
+SUBMITTED   = "submitted"   # sent to CUPS
+PRINTING    = "printing"    # CUPS is processing the job
+ERROR       = "error"       # held/stopped by CUPS, can be retried
+DONE        = "done"
+FAILED      = "failed"
+CANCELED    = "canceled"
+
+FINISHED_STATES = (DONE, FAILED, CANCELED)
+
+class PrintHandle:
+    """
+    A print request. The state is updated by the print queue.
+    """
+
+    def __init__(self, handle_id, filename, copies = 1, options = None, variant = None, pressed_at = None):
+        self.id             = handle_id
+        self.filename       = filename
+        self.copies         = copies
+        self.options        = options if options is not None else {}
+        self.variant        = variant   # "prerendered" or "original" print image
+        self.state          = QUEUED
+        self.message        = ""
+        self.cups_job_id    = None
+        self.attempts       = 0
+        self.queued_at      = time()
+        # the print button press (the queue time if it is not known)
+        self.pressed_at     = pressed_at if pressed_at is not None else self.queued_at
+        self.submitted_at   = None
+        self.processing_at  = None
+        self.done_at        = None
+        self.finished       = threading.Event()
+
+    def is_active(self):
+        return not self.state in FINISHED_STATES
+
+    def has_error(self):
+        return self.state == ERROR
+
+    def wait(self, timeout = None):
+        self.finished.wait(timeout)
+        return self.state
+
+    def record(self):
+        return {
+            "id": self.id,
+            "filename": self.filename,
+            "copies": self.copies,
+            "options": self.options,
+            "variant": self.variant,
+            "state": self.state,
+            "message": self.message,
+            "attempts": self.attempts,
+            "pressed_at": self.pressed_at,
+            "queued_at": self.queued_at,
+            "submitted_at": self.submitted_at,
+            "processing_at": self.processing_at,
+            "done_at": self.done_at,
+        }
+
+
+class PrintHistory:
+    """
+    Append-only history of the finished print jobs (one json object per line)
+    with queue wait and print duration statistics
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.count = collections.Counter()
+        self.queue_wait = 0.0
+        self.print_duration = 0.0
+        self.measured = 0
+        # time from the button press until CUPS processes the job
+        # with and without pre-rendered print image
+        self.start_delay = collections.defaultdict(list)
+        if os.path.exists(filename):
+            with open(filename) as f:
+                for line in f:
+                    try:
+                        self.add_stats(json.loads(line))
+                    except ValueError:
+                        continue
+
+    def add_stats(self, record):
+        self.count[record["state"]] += 1
+        if record["processing_at"] is not None and record["done_at"] is not None:
+            self.queue_wait += record["processing_at"] - record["queued_at"]
+            self.print_duration += record["done_at"] - record["processing_at"]
+            self.measured += 1
+            # the records before the variant was recorded are not compared
+            if record.get("variant") is not None and record.get("pressed_at") is not None:
+                self.start_delay[record["variant"]].append(record["processing_at"] - record["pressed_at"])
+
+    def add(self, handle):
+        record = handle.record()
+        with self.lock:
+            with open(self.filename, "a") as f:
+                f.write(json.dumps(record) + "\n")
+            self.add_stats(record)
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.count)
+            if self.measured > 0:
+                stats["avg_queue_wait"] = self.queue_wait / self.measured
+                stats["avg_print_duration"] = self.print_duration / self.measured
+            for variant, delays in self.start_delay.items():
+                stats["avg_start_delay_" + variant] = sum(delays) / len(delays)
+            return stats
+
+
+class PrintQueue:
+    """
+    Non-blocking print submission. submit() returns a PrintHandle immediately,
+    a worker thread sends the jobs to CUPS (max_active at the same time)
+    and the states are updated from the snapshot of the printer monitor.
+    """
+
+    copies          = 1
+    max_active      = 2       # jobs sent to CUPS at the same time
+    retries         = 2       # automatic resubmits of an aborted job
+    history_file    = os.path.dirname(os.path.realpath(__file__)) + '/print_history.jsonl'
+
+    def __init__(self, printer, connection_factory, monitor, config = None, on_change = None):
+        self.printer = printer
+        self.connection_factory = connection_factory
+        self.monitor = monitor
+        self.on_change = on_change
+        self.on_finished = None     # called with the handle of a finished job (e.g. for the catalog)
+
+        if config is not None:
+            if hasattr(config, "print_copies"):
+                self.copies = config.print_copies
+            if hasattr(config, "print_max_active"):
+                self.max_active = config.print_max_active
+            if hasattr(config, "print_retries"):
+                self.retries = config.print_retries
+            if hasattr(config, "print_history"):
+                self.history_file = config.print_history
+
+        self.history = PrintHistory(self.history_file)
+        # the CUPS connection is used by the worker and for cancel/retry
+        self.connection = None
+        self.connection_lock = threading.Lock()
+        self.handles = []
+        self.counter = itertools.count(1)
+        self.condition = threading.Condition()
+        self.running = True
+
+        self.thread = threading.Thread(target=self.run, name="print queue", daemon=True)
+        self.thread.start()
+
+    def submit(self, filename, copies = None, options = None, variant = None, pressed_at = None):
+        if copies is None:
+            copies = self.copies
+        handle = PrintHandle(next(self.counter), filename, copies, options, variant, pressed_at)
+        with self.condition:
+            self.handles.append(handle)
+            self.condition.notify()
+        print("Print queued: %s" % filename)
+        logger.info("Print %s queued: %s (%s copies)", handle.id, filename, copies)
+        return handle
+
+    def active(self):
+        with self.condition:
+            return [handle for handle in self.handles if handle.is_active()]
+
+    def find(self, filename):
+        for handle in self.active():
+            if handle.filename == filename:
+                return handle
+        return None
+
+    def has_active(self):
+        return len(self.active()) > 0
+
+    def errors(self):
+        return [handle for handle in self.active() if handle.has_error()]
+
+    def cancel(self, handle):
+        with self.condition:
+            if not handle.is_active():
+                return
+            cups_job_id = handle.cups_job_id
+            self.finish(handle, CANCELED)
+        self.finished([handle])
+        if cups_job_id is not None:
+            self.call(lambda conn: conn.cancelJob(cups_job_id))
+            self.monitor.forget(cups_job_id)
+        if self.on_change is not None:
+            self.on_change()
+
+    def retry(self, handle):
+        """
+        Retry a held/stopped job: release it if possible, otherwise cancel and resubmit it
+        """
+        with self.condition:
+            if not handle.has_error():
+                return
+            cups_job_id = handle.cups_job_id
+            handle.message = ""
+
+        def release(conn):
+            # a stopped job continues when the printer is enabled, a held job must be released
+            conn.enablePrinter(self.printer)
+            job = self.monitor.get_job(cups_job_id)
+            if job is not None and job["state"] == JOB_HELD:
+                conn.setJobHoldUntil(cups_job_id, "no-hold")
+
+        if cups_job_id is not None and self.call(release):
+            with self.condition:
+                handle.state = SUBMITTED
+            self.monitor.refresh()
+            logger.info("Print %s released", handle.id)
+        else:
+            if cups_job_id is not None:
+                self.call(lambda conn: conn.cancelJob(cups_job_id))
+                self.monitor.forget(cups_job_id)
+            self.resubmit(handle)
+
+    def resubmit(self, handle):
+        with self.condition:
+            handle.state = QUEUED
+            handle.cups_job_id = None
+            self.condition.notify()
+        logger.info("Print %s queued again", handle.id)
+
+    def call(self, function):
+        """
+        Run a CUPS call with the connection of the queue, returns False on errors
+        """
+        try:
+            with self.connection_lock:
+                if self.connection is None:
+                    self.connection = self.connection_factory()
+                function(self.connection)
+            return True
+        except Exception as e:
+            logger.error("Print queue: %s", e)
+            return False
+
+    def finish(self, handle, state):
+        # must be called with the lock, finished() must be called after the lock is released
+        handle.state = state
+        handle.done_at = time()
+        handle.finished.set()
+        self.handles.remove(handle)
+
+    def finished(self, handles):
+        """
+        Record the finished jobs (catalog and history on the SD card)
+        without the lock, so that submit() and status() do not wait for the writes
+        """
+        for handle in handles:
+            # from the print button press (the queue time if it is not known) until the job is done
+            metrics.observe("print", handle.done_at - handle.pressed_at, state=handle.state)
+            if self.on_finished is not None:
+                try:
+                    self.on_finished(handle)
+                except Exception as e:
+                    logger.error("Print %s: %s", handle.id, e)
+            self.history.add(handle)
+            logger.info("Print %s %s after %s attempts", handle.id, handle.state, handle.attempts)
+
+    def update(self):
+        """
+        Update the job states from the printer monitor (called from the monitor thread)
+        """
+        changed = False
+        finished = []
+        with self.condition:
+            for handle in list(self.handles):
+                if handle.cups_job_id is None:
+                    continue
+                job = self.monitor.get_job(handle.cups_job_id)
+                # not watched (yet), e.g. forgotten while it is retried
+                if job is None:
+                    continue
+                state = job["state"]
+
+                if state == JOB_COMPLETED or state == JOB_CANCELED:
+                    self.monitor.forget(handle.cups_job_id)
+                    self.finish(handle, DONE if state == JOB_COMPLETED else CANCELED)
+                    finished.append(handle)
+                elif state == JOB_ABORTED:
+                    self.monitor.forget(handle.cups_job_id)
+                    if handle.attempts <= self.retries:
+                        handle.state = QUEUED
+                        handle.cups_job_id = None
+                    else:
+                        self.finish(handle, FAILED)
+                        finished.append(handle)
+                elif state == JOB_HELD or state == JOB_STOPPED:
+                    if handle.state != ERROR or handle.message != job["message"]:
+                        handle.state = ERROR
+                        handle.message = job["message"]
+                    else:
+                        continue
+                elif state == JOB_PROCESSING:
+                    if handle.processing_at is None:
+                        handle.processing_at = time()
+                        logger.info("Print %s processing after %.2fs", handle.id, handle.processing_at - handle.queued_at)
+                    if handle.state == PRINTING:
+                        continue
+                    handle.state = PRINTING
+                else:
+                    continue
+                changed = True
+            self.condition.notify()
+
+        self.finished(finished)
+        if changed and self.on_change is not None:
+            self.on_change()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and self.next_job() is None:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                handle = self.next_job()
+                handle.state = SUBMITTED
+                handle.attempts += 1
+
+            self.send(handle)
+
+    def next_job(self):
+        # must be called with the lock
+        sent = [handle for handle in self.handles if handle.cups_job_id is not None]
+        if len(sent) >= self.max_active:
+            return None
+        for handle in self.handles:
+            if handle.state == QUEUED:
+                return handle
+        return None
+
+    def send(self, handle):
+        print("Try to print %s" %(handle.filename))
+        logger.info("Try to print %s", handle.filename)
+        options = dict(handle.options)
+        if handle.copies > 1:
+            options["copies"] = str(handle.copies)
+        try:
+            with self.connection_lock:
+                if self.connection is None:
+                    self.connection = self.connection_factory()
+                cups_job_id = self.connection.printFile(self.printer, handle.filename, 'photobooth', options)
+        except Exception as e:
+            print("Error while printing: %s" % e)
+            logger.error("Error while printing %s: %s", handle.filename, e)
+            with self.condition:
+                self.finish(handle, FAILED)
+            self.finished([handle])
+            if self.on_change is not None:
+                self.on_change()
+            return
+
+        with self.condition:
+            canceled = handle.state == CANCELED
+            if not canceled:
+                # the monitor knows the job before update() can see it
+                self.monitor.watch(cups_job_id)
+                handle.cups_job_id = cups_job_id
+                handle.submitted_at = time()
+                metrics.observe("print_submit", handle.submitted_at - handle.queued_at)
+
+        if canceled:
+            # canceled while it was sent
+            self.call(lambda conn: conn.cancelJob(cups_job_id))
+            return
+        print("Print job successfully created.")
+        logger.info("Print job %s successfully created", cups_job_id)
+
+    def stats(self):
+        return self.history.stats()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join(2)
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+from time import monotonic
+
+import threading
+import logging
+
+logger = logging.getLogger("photobooth")
+
+# CUPS states
+PRINTER_STOPPED = 5
+JOB_PENDING     = 3
+JOB_HELD        = 4
+JOB_PROCESSING  = 5
+JOB_STOPPED     = 6
+JOB_CANCELED    = 7
+JOB_ABORTED     = 8
+JOB_COMPLETED   = 9
+
+class PrinterMonitor:
+    """
+    Thread which keeps a snapshot of the printer and the watched jobs
+    so that the main loop does not need any CUPS calls to check the print state.
+    It polls fast right after a job was submitted and slowly while idle.
+    When the CUPS server supports subscriptions only the notifications are fetched
+    and the states are requested when something happened.
+    on_change is called (from the monitor thread) whenever the snapshot changes.
+    """
+
+    poll_fast       = 0.2     # seconds between polls right after a job was submitted
+    poll_active     = 1.0     # seconds between polls while a job is printing
+    poll_idle       = 10.0    # seconds between polls without jobs
+    fast_period     = 5.0     # seconds of fast polling after a job was submitted
+    lease_duration  = 3600
+
+    def __init__(self, printer, connection_factory, config = None, on_change = None):
+        self.printer = printer
+        self.connection_factory = connection_factory
+        self.on_change = on_change
+
+        if config is not None:
+            if hasattr(config, "printer_poll_fast"):
+                self.poll_fast = config.printer_poll_fast
+            if hasattr(config, "printer_poll_active"):
+                self.poll_active = config.printer_poll_active
+            if hasattr(config, "printer_poll_idle"):
+                self.poll_idle = config.printer_poll_idle
+
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.running = True
+
+        self.printer_state = None
+        self.printer_message = ""
+        self.jobs = {}              # job id => {"state": .., "message": ..}
+        # poll the initial state
+        self.fast_until = monotonic() + self.fast_period
+
+        self.subscription = None
+        self.sequence = 0
+
+        self.thread = threading.Thread(target=self.run, name="printer monitor", daemon=True)
+        self.thread.start()
+
+    def watch(self, job_id):
+        """
+        Track the state of a submitted job
+        """
+        with self.condition:
+            self.jobs[job_id] = {"state": JOB_PENDING, "message": ""}
+            self.fast_until = monotonic() + self.fast_period
+            self.condition.notify()
+
+    def forget(self, job_id):
+        with self.condition:
+            self.jobs.pop(job_id, None)
+
+    def refresh(self):
+        """
+        Poll now (e.g. after a job was canceled or the printer was enabled)
+        """
+        with self.condition:
+            self.fast_until = monotonic() + self.fast_period
+            self.condition.notify()
+
+    def get_printer_error(self):
+        with self.lock:
+            if self.printer_state == PRINTER_STOPPED:
+                return self.printer_message
+        return None
+
+    def get_job(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            return dict(job)
+
+    def is_job_done(self, job_id):
+        job = self.get_job(job_id)
+        return job is None or job["state"] >= JOB_CANCELED
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join(2)
+
+    def interval(self):
+        if monotonic() < self.fast_until:
+            return self.poll_fast
+        if any(job["state"] < JOB_CANCELED for job in self.jobs.values()):
+            return self.poll_active
+        return self.poll_idle
+
+    def run(self):
+        conn = None
+        while True:
+            with self.condition:
+                if not self.running:
+                    break
+                job_ids = list(self.jobs.keys())
+
+            try:
+                if conn is None:
+                    conn = self.connection_factory()
+                    self.subscribe(conn)
+                if self.has_notifications(conn):
+                    self.poll(conn, job_ids)
+            except Exception as e:
+                # e.g. cups restarted, reconnect with the next poll
+                logger.error("Printer monitor: %s", e)
+                conn = None
+                self.subscription = None
+
+            with self.condition:
+                if self.running:
+                    self.condition.wait(self.interval())
+
+        self.unsubscribe(conn)
+
+    def subscribe(self, conn):
+        """
+        Use CUPS notifications if they are available (pull based, ippget)
+        """
+        try:
+            self.subscription = conn.createSubscription(
+                "ipp://localhost/printers/%s" % self.printer,
+                events=["printer-state-changed", "job-state-changed", "job-progress"],
+                lease_duration=self.lease_duration)
+            self.sequence = 0
+            logger.info("Printer monitor: using CUPS subscription %s", self.subscription)
+        except Exception as e:
+            self.subscription = None
+            logger.info("Printer monitor: no CUPS subscriptions (%s), polling", e)
+
+    def unsubscribe(self, conn):
+        if conn is not None and self.subscription is not None:
+            try:
+                conn.cancelSubscription(self.subscription)
+            except Exception:
+                pass
+
+    def has_notifications(self, conn):
+        """
+        Check whether there are new events for the subscription.
+        Without subscription (or right after a submit) the states are always polled.
+        """
+        if self.subscription is None or monotonic() < self.fast_until:
+            return True
+
+        notifications = conn.getNotifications([self.subscription], [self.sequence + 1])
+        events = notifications.get("events", [])
+        for event in events:
+            self.sequence = max(self.sequence, event.get("notify-sequence-number", self.sequence))
+        return len(events) > 0
+
+    def poll(self, conn, job_ids):
+        # pycups is only loaded by the printer stage of the startup
+        import cups
+        attr = conn.getPrinterAttributes(self.printer, requested_attributes=["printer-state", "printer-state-message"])
+        jobs = {}
+        for job_id in job_ids:
+            try:
+                job = conn.getJobAttributes(job_id, requested_attributes=["job-state", "job-printer-state-message"])
+            except cups.IPPError as e:
+                # CUPS purges finished jobs from its history => done
+                # other errors (e.g. CUPS restarts) keep the snapshot and reconnect in run()
+                if e.args[0] != cups.IPP_NOT_FOUND:
+                    raise
+                logger.info("Printer monitor: job %s not found (%s)", job_id, e)
+                job = {}
+            jobs[job_id] = {"state": job.get("job-state", JOB_COMPLETED), "message": job.get("job-printer-state-message", "")}
+
+        changed = False
+        with self.lock:
+            if attr.get("printer-state") != self.printer_state or attr.get("printer-state-message", "") != self.printer_message:
+                self.printer_state = attr.get("printer-state")
+                self.printer_message = attr.get("printer-state-message", "")
+                changed = True
+            for job_id, job in jobs.items():
+                # the job could have been forgotten in the meantime
+                if job_id in self.jobs and self.jobs[job_id] != job:
+                    self.jobs[job_id] = job
+                    changed = True
+
+        if changed and self.on_change is not None:
+            self.on_change()
@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+
+from time import time, monotonic
+
+import threading
+import collections
+import queue
+import glob
+import os
+import shutil
+import logging
+
+from Backup import BackupJournal
+from Metrics import metrics
+
+logger = logging.getLogger("photobooth")
+
+class Staging:
+    """
+    The session images are written into a RAM folder (e.g. a tmpfs like /dev/shm)
+    and flushed to the images folder on the SD card by a background thread,
+    so that no SD card write is in the capture path.
+    Every session image is in the journal as soon as it is written (written() is called
+    by the camera), so after a restart the files which are still in the staging folder
+    are flushed, also the frames of a session which was interrupted before its montage,
+    and the files which were lost (power cut) are logged. recovered lists the flushed files
+    (e.g. for the backups).
+    Intermediate files (e.g. _montageTemp.jpg) are never flushed,
+    the staged copies of the last keep_sessions sessions stay in RAM (e.g. for printing).
+    Staged files which are still in use (in_use() returns their paths, e.g. a queued print)
+    are deleted by a later cleanup.
+    Without a staging_folder the images are written into the images folder directly.
+    """
+
+    folder          = None
+    keep_sessions   = 2
+    journal_file    = os.path.dirname(os.path.realpath(__file__)) + '/staging_journal.jsonl'
+    in_use          = None
+
+    def __init__(self, images_folder, config = None):
+        self.images_folder = images_folder
+
+        if config is not None:
+            if hasattr(config, "staging_folder") and config.staging_folder is not None:
+                self.folder = os.path.abspath(config.staging_folder)
+            if hasattr(config, "staging_keep_sessions"):
+                self.keep_sessions = config.staging_keep_sessions
+            if hasattr(config, "staging_journal"):
+                self.journal_file = config.staging_journal
+
+        self.counter = 0
+        self.lock = threading.Lock()
+        # journal ids of the written files which are not submitted yet
+        self.written_ids = {}
+        self.recovered = []
+        # staged base filenames of the flushed sessions, oldest first
+        self.sessions = collections.deque()
+        self.jobs = queue.Queue()
+        # statistics
+        self.bytes_flushed = 0
+        self.seconds_flushing = 0.0
+        self.journal = None
+        self.thread = None
+        if not self.is_enabled():
+            return
+
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+        self.journal = BackupJournal(self.journal_file)
+        self.replay()
+
+        self.thread = threading.Thread(target=self.run, name="staging", daemon=True)
+        self.thread.start()
+
+    def is_enabled(self):
+        return self.folder is not None
+
+    def throughput(self):
+        """
+        Average write throughput into the images folder in bytes per second
+        """
+        if self.seconds_flushing == 0:
+            return 0.0
+        return self.bytes_flushed / self.seconds_flushing
+
+    def persistent_path(self, path):
+        """
+        Return the path of a staged file in the images folder
+        (other paths are returned unchanged)
+        """
+        if not self.is_enabled() or path is None or os.path.dirname(path) != self.folder:
+            return path
+        return os.path.join(self.images_folder, os.path.basename(path))
+
+    def next_id(self):
+        with self.lock:
+            self.counter += 1
+            return "%d-%d" % (int(time() * 1000), self.counter)
+
+    def replay(self):
+        """
+        Flush the files of the journal and the frames of an interrupted session
+        which are still in the staging folder, then empty the staging folder
+        """
+        for entry in self.journal.get_pending():
+            if os.path.exists(entry["src"]):
+                logger.info("Resume flush %s -> %s", entry["src"], entry["dest"])
+                if self.flush_entry(entry):
+                    self.recovered.append(entry["dest"])
+            else:
+                print("Staged image %s was lost" % entry["src"])
+                logger.error("Staged image %s was lost before it was flushed to %s", entry["src"], entry["dest"])
+                self.journal.done(entry["id"], error="lost")
+
+        for path in sorted(glob.glob(os.path.join(self.folder, "*.jpg"))):
+            # e.g. a frame which was written right before the power cut, before its journal entry
+            dest = self.persistent_path(path)
+            name = os.path.basename(path)
+            if "_montageTemp." in name or os.path.exists(dest):
+                continue
+            logger.info("Flush leftover %s -> %s", path, dest)
+            item_id = self.next_id()
+            self.journal.add(item_id, path, dest)
+            if self.flush_entry({"id": item_id, "src": path, "dest": dest}):
+                self.recovered.append(dest)
+
+        if self.recovered:
+            print("Recovered %s images of interrupted sessions" % len(self.recovered))
+            logger.warning("Recovered %s images of interrupted sessions", len(self.recovered))
+        self.remove(glob.glob(os.path.join(self.folder, "*")))
+
+    def written(self, path):
+        """
+        Journal a session image as soon as it is written into the staging folder
+        """
+        if not self.is_enabled() or os.path.dirname(path) != self.folder:
+            return
+        item_id = self.next_id()
+        self.journal.add(item_id, path, self.persistent_path(path))
+        with self.lock:
+            self.written_ids[path] = item_id
+
+    def submit(self, job, on_flushed = None):
+        """
+        Queue the written files of a post processed job, on_flushed(job) is called
+        (from the staging thread) when they are in the images folder
+        """
+        if not self.is_enabled():
+            if on_flushed is not None:
+                on_flushed(job)
+            return
+
+        entries = []
+        for path in job.files:
+            dest = self.persistent_path(path)
+            with self.lock:
+                item_id = self.written_ids.pop(path, None)
+            if item_id is None:
+                # e.g. written without the camera
+                item_id = self.next_id()
+                self.journal.add(item_id, path, dest)
+            entries.append({"id": item_id, "src": path, "dest": dest})
+        self.jobs.put((job, entries, on_flushed))
+
+    def run(self):
+        while True:
+            item = self.jobs.get()
+            if item is None:
+                self.jobs.task_done()
+                break
+            job, entries, on_flushed = item
+            self.flush(job, entries)
+            if on_flushed is not None:
+                try:
+                    on_flushed(job)
+                except Exception as e:
+                    print("Error after flushing images: %s" % e)
+                    logger.error("Error after flushing images: %s", e)
+            self.jobs.task_done()
+
+    def flush(self, job, entries):
+        start = monotonic()
+        paths = {}
+        for entry in entries:
+            # a file which could not be flushed stays in the staging folder and in the journal
+            paths[entry["src"]] = entry["dest"] if self.flush_entry(entry) else entry["src"]
+        # the backups, the catalog and the gallery see the files in the images folder
+        staged = job.base_filename
+        job.base_filename = self.persistent_path(staged)
+        job.files = [paths[path] for path in job.files]
+        job.final_image = paths.get(job.final_image, job.final_image)
+        metrics.observe("staging_flush", monotonic() - start)
+        logger.info("Flushed %s files of %s in %.3fs", len(entries), os.path.basename(staged), monotonic() - start)
+        self.cleanup(staged)
+
+    def flush_entry(self, entry):
+        """
+        Copy a staged file into the images folder (fsync and rename, so that there is
+        no partial image after a power cut), returns whether the copy was written
+        """
+        start = monotonic()
+        temp = entry["dest"] + ".part"
+        try:
+            with open(entry["src"], "rb") as fsrc, open(temp, "wb") as fdest:
+                shutil.copyfileobj(fsrc, fdest, 1024 * 1024)
+                fdest.flush()
+                os.fsync(fdest.fileno())
+                size = fdest.tell()
+            os.replace(temp, entry["dest"])
+        except (IOError, OSError) as e:
+            print("Error: %s" % e)
+            logger.error("Error flushing %s -> %s: %s", entry["src"], entry["dest"], e)
+            return False
+        self.bytes_flushed += size
+        self.seconds_flushing += monotonic() - start
+        self.journal.done(entry["id"])
+        return True
+
+    def cleanup(self, base_filename):
+        """
+        Delete the staged files of the sessions before the last keep_sessions
+        """
+        self.sessions.append(base_filename)
+        kept = []
+        while len(self.sessions) > self.keep_sessions:
+            base = self.sessions.popleft()
+            if not self.remove(glob.glob(glob.escape(base) + "*")):
+                kept.append(base)
+        # tried again by the next cleanup
+        self.sessions.extendleft(reversed(kept))
+
+    def remove(self, paths):
+        """
+        Delete the staged files, returns False if some of them are kept
+        """
+        # the files which are not flushed yet or still in use (e.g. printing) are kept
+        kept = set(entry["src"] for entry in self.journal.get_pending())
+        if self.in_use is not None:
+            kept.update(self.in_use())
+        removed = True
+        for path in paths:
+            if path in kept:
+                removed = False
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        return removed
+
+    def join(self):
+        """
+        Wait until all queued sessions are flushed
+        """
+        if self.thread is not None:
+            self.jobs.join()
+
+    def stop(self):
+        """
+        Flush the queued sessions and stop the worker
+        """
+        if self.thread is not None:
+            self.jobs.put(None)
+            self.thread.join()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+from time import perf_counter
+
+import threading
+import logging
+
+from Metrics import metrics
+
+logger = logging.getLogger("photobooth")
+
+class Startup:
+    """
+    Runs the independent startup stages (camera, printer, LEDs, storage) in parallel threads.
+    A stage can depend on other stages and only starts when they are finished.
+    wait() re-raises the first error of a stage in the calling thread.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.done = {}
+        self.timings = {}
+        self.errors = []
+        self.lock = threading.Lock()
+        self.start = perf_counter()
+
+    def stage(self, name, function, after = ()):
+        self.done[name] = threading.Event()
+        thread = threading.Thread(target=self.run, args=(name, function, after), name="startup-" + name, daemon=True)
+        self.stages[name] = thread
+        thread.start()
+
+    def run(self, name, function, after):
+        for dependency in after:
+            self.done[dependency].wait()
+        start = perf_counter()
+        try:
+            with self.lock:
+                failed = bool(self.errors)
+            # a failed dependency would only cause follow-up errors
+            if not failed:
+                function()
+        except BaseException as e:
+            logger.error("Startup stage %s failed: %s", name, e)
+            with self.lock:
+                self.errors.append(e)
+        finally:
+            duration = perf_counter() - start
+            with self.lock:
+                self.timings[name] = duration
+            metrics.observe("startup_stage", duration, stage=name)
+            self.done[name].set()
+
+    def wait(self):
+        for thread in self.stages.values():
+            thread.join()
+        total = perf_counter() - self.start
+        metrics.observe("startup", total)
+
+        report = ", ".join("%s %.2fs" % (name, duration) for name, duration in sorted(self.timings.items()))
+        print("Startup in %.2fs (%s)" % (total, report))
+        logger.info("Startup in %.2fs (%s)", total, report)
+
+        if self.errors:
+            raise self.errors[0]
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+
+from time import monotonic
+
+import threading
+import os
+import logging
+
+from Metrics import metrics
+
+logger = logging.getLogger("photobooth")
+
+class Storage:
+    """
+    Watches the free space of the images folder and the backup destinations
+    and predicts how many sessions still fit (free space / average session size).
+    check() is one statvfs per destination, so it is cheap enough for every session.
+    When less than min_sessions fit into a destination, the retention policies
+    free space in a background thread (in the configured order):
+      - "frames": delete the frames of the oldest multi sessions, the montages are kept
+      - "sessions": delete all files of the oldest sessions
+    Both only delete files which are confirmed in another destination, never the last copy.
+    Every deleted file is recorded in the catalog.
+    """
+
+    min_sessions    = 20
+    reserve         = 100 * 1024 * 1024      # bytes which are never used (e.g. for the system on the SD card)
+    session_bytes   = 8 * 1024 * 1024        # estimated size of a session until the first one is written
+    retention       = ()
+
+    def __init__(self, images_folder, catalog, backup = None, staging = None, config = None):
+        self.images_folder = images_folder
+        self.catalog = catalog
+        self.backup = backup
+        self.staging = staging
+
+        if config is not None:
+            if hasattr(config, "storage_min_sessions"):
+                self.min_sessions = config.storage_min_sessions
+            if hasattr(config, "storage_reserve"):
+                self.reserve = config.storage_reserve
+            if hasattr(config, "storage_session_size"):
+                self.session_bytes = config.storage_session_size
+            if hasattr(config, "storage_retention"):
+                self.retention = tuple(config.storage_retention)
+
+        self.destinations = [images_folder]
+        if backup is not None:
+            self.destinations.extend(backup.destinations.keys())
+
+        self.sessions_written = 0
+        # destinations with less than min_sessions left (logged once)
+        self.low = set()
+        self.evicting = set()
+        self.condition = threading.Condition()
+        self.running = True
+
+        # statistics
+        self.evicted_files = 0
+        self.evicted_bytes = 0
+
+        self.thread = threading.Thread(target=self.run, name="storage", daemon=True)
+        self.thread.start()
+
+    def free_bytes(self, folder):
+        """
+        Free bytes for the booth in the folder or None if it is not available (e.g. a removed usb stick)
+        """
+        try:
+            stat = os.statvfs(folder)
+        except OSError:
+            return None
+        return stat.f_bavail * stat.f_frsize
+
+    def sessions_left(self, free):
+        return max(0, int((free - self.reserve) // self.session_bytes))
+
+    def throughput(self, folder):
+        """
+        Measured write throughput into the folder in bytes per second (None if nothing was written yet)
+        """
+        if folder == self.images_folder:
+            if self.staging is None or not self.staging.is_enabled():
+                return None
+            value = self.staging.throughput()
+        elif self.backup is not None and folder in self.backup.destinations:
+            value = self.backup.destinations[folder].throughput()
+        else:
+            return None
+        return value if value > 0 else None
+
+    def session_written(self, job):
+        """
+        Update the average session size with the files of a finished session
+        """
+        size = 0
+        for path in job.files:
+            try:
+                size += os.path.getsize(path)
+            except OSError:
+                pass
+        if size == 0:
+            return
+        self.sessions_written += 1
+        if self.sessions_written == 1:
+            self.session_bytes = size
+        else:
+            # moving average, single and multi sessions are mixed
+            self.session_bytes = 0.8 * self.session_bytes + 0.2 * size
+
+    def check(self):
+        """
+        Return the number of sessions which still fit into every available destination
+        (None if no destination is available) and start the retention policies if needed
+        """
+        start = monotonic()
+        fits = None
+        for folder in self.destinations:
+            free = self.free_bytes(folder)
+            if free is None:
+                continue
+            sessions = self.sessions_left(free)
+            fits = sessions if fits is None else min(fits, sessions)
+
+            if sessions < self.min_sessions:
+                if not folder in self.low:
+                    self.low.add(folder)
+                    print("Storage %s: space for %s sessions" % (folder, sessions))
+                    logger.warning("Storage %s: %.0f MB free, space for %s sessions", folder, free / 1024 / 1024, sessions)
+                if self.retention:
+                    with self.condition:
+                        self.evicting.add(folder)
+                        self.condition.notify()
+            elif folder in self.low:
+                self.low.discard(folder)
+                logger.info("Storage %s: space for %s sessions", folder, sessions)
+        metrics.observe("storage_check", monotonic() - start)
+        return fits
+
+    def status(self):
+        """
+        Free space, sessions left and write throughput per destination, e.g. for the log
+        """
+        status = {}
+        for folder in self.destinations:
+            free = self.free_bytes(folder)
+            status[folder] = {
+                "available": free is not None,
+                "free": free,
+                "sessions": self.sessions_left(free) if free is not None else None,
+                "throughput": self.throughput(folder),
+            }
+        return status
+
+    def log_status(self):
+        for folder, status in self.status().items():
+            if not status["available"]:
+                logger.info("Storage %s: not available", folder)
+                continue
+            throughput = status["throughput"]
+            logger.info("Storage %s: %.0f MB free, space for %s sessions of %.1f MB, %s", folder,
+                status["free"] / 1024 / 1024, status["sessions"], self.session_bytes / 1024 / 1024,
+                "%.0f KB/s" % (throughput / 1024) if throughput is not None else "no writes yet")
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and not self.evicting:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                folder = self.evicting.pop()
+            try:
+                with metrics.span("storage_evict"):
+                    self.evict(folder)
+            except Exception as e:
+                logger.error("Error freeing space in %s: %s", folder, e)
+
+    def evict(self, folder):
+        """
+        Apply the retention policies until min_sessions fit into the folder again
+        """
+        for policy in self.retention:
+            if policy not in ("frames", "sessions"):
+                logger.error("Unknown storage retention policy %s", policy)
+                continue
+            while self.running:
+                free = self.free_bytes(folder)
+                if free is None or self.sessions_left(free) >= self.min_sessions:
+                    return
+                candidates = self.catalog.eviction_candidates(folder, self.images_folder, policy == "frames")
+                removed = [self.remove(folder, candidate["path"]) for candidate in candidates]
+                if not any(removed):
+                    break
+        free = self.free_bytes(folder)
+        if free is not None and self.sessions_left(free) < self.min_sessions:
+            logger.warning("Storage %s: nothing left to delete, space for %s sessions", folder, self.sessions_left(free))
+
+    def remove(self, folder, path):
+        # the backups are named like the file in the images folder
+        target = path if folder == self.images_folder else os.path.join(folder, os.path.basename(path))
+        try:
+            size = os.path.getsize(target)
+            os.remove(target)
+        except FileNotFoundError:
+            size = 0
+        except OSError as e:
+            logger.error("Error deleting %s: %s", target, e)
+            return False
+        self.evicted_files += 1
+        self.evicted_bytes += size
+        self.catalog.evicted(path, folder)
+        logger.info("Storage %s: deleted %s (%s KB)", folder, os.path.basename(target), size // 1024)
+        return True
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.thread.join(1)
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+from PIL import Image, ImageFont, ImageDraw
+
+import collections
+import threading
+import logging
+
+logger = logging.getLogger("photobooth")
+
+class TextCache:
+    """
+    Renders text overlays only in the size of the text (not the whole screen)
+    and keeps the rendered buffers and the loaded fonts in memory
+    """
+
+    font_path   = "/usr/share/fonts/dejavu/DejaVuSans.ttf"
+    max_entries = 32
+    screen_w    = 1024
+    screen_h    = 600
+
+    def __init__(self, screen_w, screen_h, config = None):
+        self.screen_w = screen_w
+        self.screen_h = screen_h
+
+        if config is not None:
+            if hasattr(config, "font_path"):
+                self.font_path = config.font_path
+            if hasattr(config, "text_cache_entries"):
+                self.max_entries = config.text_cache_entries
+
+        self.fonts = {}
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def font(self, fontsize):
+        font = self.fonts.get(fontsize)
+        if font is None:
+            font = ImageFont.truetype(self.font_path, fontsize)
+            self.fonts[fontsize] = font
+        return font
+
+    def render(self, text, x, y, fontsize):
+        """
+        Render the text into a transparent image which is padded to the camera`s block size (32x16).
+        Returns the image data, its size and the window (position on the screen)
+        """
+        font = self.font(fontsize)
+        left, top, right, bottom = font.getbbox(text)
+
+        # clip the text to the screen
+        width = max(1, min(right, self.screen_w - x))
+        height = max(1, min(bottom, self.screen_h - y))
+
+        img = Image.new("RGBA", (((width + 31) // 32) * 32, ((height + 15) // 16) * 16), (0,0,0,0))
+        draw = ImageDraw.Draw(img)
+        draw.text((0,0), text, (255,255,255), font=font)
+
+        return img.tobytes(), img.size, (x, y, img.size[0], img.size[1])
+
+    def get(self, text, x = 50, y = 50, fontsize = 80):
+        key = (text, fontsize, x, y, self.screen_w, self.screen_h)
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+            entry = self.render(text, x, y, fontsize)
+            self.entries[key] = entry
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+            return entry
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self.entries),
+            }
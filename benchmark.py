@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+"""
+End-to-end session benchmark with simulated camera, GPIO, CUPS and LED backends.
+
+Every scenario runs photobooth.main in its own process (clean state, own peak RSS)
+and presses the buttons from a script thread.
+
+usage: benchmark.py [--fast] [--staging] [--sessions N] [--verbose] [scenario ...]
+scenarios: single, multi, print, printer_error, label_removed, server_load (default: all)
+"""
+
+from time import monotonic, sleep
+
+import argparse
+import glob
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+
+path = os.path.dirname(os.path.realpath(__file__))
+
+
+class Timings:
+    """
+    Durations of the wrapped methods and timestamps of the scripted events
+    """
+
+    def __init__(self):
+        self.phases = {}
+        self.events = []
+        self.lock = threading.Lock()
+
+    def add(self, phase, duration):
+        with self.lock:
+            self.phases.setdefault(phase, []).append(duration)
+
+    def mark(self, name):
+        with self.lock:
+            self.events.append((monotonic(), name))
+
+    def last(self, name, after = 0):
+        with self.lock:
+            times = [t for t, event in self.events if event == name and t >= after]
+        return times[-1] if times else None
+
+    def wrap(self, obj, attr, phase):
+        function = getattr(obj, attr)
+
+        def wrapper(*args, **kwargs):
+            start = monotonic()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.add(phase, monotonic() - start)
+                self.mark(phase)
+
+        setattr(obj, attr, wrapper)
+
+
+class Scenario:
+    """
+    Scripted button presses against the running photobooth
+    """
+
+    def __init__(self, photobooth, timings, sessions):
+        from simulation import gpio, cups
+        self.photobooth = photobooth
+        self.config = photobooth.config
+        self.timings = timings
+        self.sessions = sessions
+        self.gpio = gpio
+        self.cups = cups
+        self.latencies = {}
+
+    def wait(self, predicate, timeout = 60):
+        deadline = monotonic() + timeout
+        while not predicate():
+            if monotonic() > deadline:
+                raise TimeoutError("scenario step timed out")
+            sleep(0.005)
+
+    def press(self, pin):
+        # the button can be disabled for a moment (e.g. while a session finishes)
+        self.wait(lambda: self.gpio.press(pin), 30)
+        return monotonic()
+
+    def latency(self, name, value):
+        self.latencies.setdefault(name, []).append(value)
+
+    def session(self, multi = False):
+        self.press(self.config.btn_multi if multi else self.config.btn_single)
+        pressed = self.press(self.config.btn_dome)
+        self.wait(lambda: self.timings.last("show_image", pressed) is not None)
+        self.latency("dome_to_preview", self.timings.last("show_image", pressed) - pressed)
+        self.latency("dome_to_last_shot", self.timings.last("shutter", pressed) - pressed)
+
+    def print_image(self):
+        submitted = len(self.cups.submitted)
+        pressed = self.press(self.config.btn_print)
+        self.wait(lambda: len(self.cups.submitted) > submitted)
+        self.latency("print_to_submit", self.cups.submitted[-1][0] - pressed)
+        return pressed
+
+    def wait_printed(self, pressed):
+        boxio = self.photobooth.boxio
+        self.wait(lambda: not boxio.print_started())
+        self.latency("print_to_done", monotonic() - pressed)
+
+    def wait_backups(self):
+        self.photobooth.postprocessor.join()
+        self.photobooth.staging.join()
+        backup = self.photobooth.backup
+        self.wait(lambda: all(stats["queue"] == 0 for stats in backup.stats().values()))
+
+    def run(self, name):
+        try:
+            # the presses are dropped until main() has started the event loop
+            self.wait(lambda: self.photobooth.boxio.event_loop is not None)
+            getattr(self, "scenario_" + name)()
+            self.wait_backups()
+        finally:
+            self.gpio.press(self.config.btn_exit)
+
+    def scenario_single(self):
+        for _ in range(self.sessions):
+            self.session(False)
+
+    def scenario_multi(self):
+        for _ in range(self.sessions):
+            self.session(True)
+
+    def scenario_print(self):
+        for _ in range(self.sessions):
+            self.session(False)
+            self.wait_printed(self.print_image())
+
+    def scenario_label_removed(self):
+        # the USB stick with the label is removed during the event
+        self.session(True)
+        os.remove(self.config.label_path)
+        for _ in range(self.sessions):
+            self.session(True)
+
+    def scenario_server_load(self):
+        # phones download from the gallery server (own process) during the sessions
+        url = "http://127.0.0.1:%s/" % self.config.server_port
+        self.session(False)
+        clients = subprocess.Popen([sys.executable, os.path.realpath(__file__), "--load", url, "--clients", "16"],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            for _ in range(self.sessions):
+                self.session(False)
+        finally:
+            clients.terminate()
+            clients.wait()
+
+    def scenario_printer_error(self):
+        self.session(False)
+        self.cups.errors.append("Ribbon empty")
+        pressed = self.print_image()
+        self.wait(lambda: self.photobooth.boxio.has_print_error() != False)
+        self.latency("print_to_error", monotonic() - pressed)
+        # retry with the print button
+        self.press(self.config.btn_print)
+        self.wait_printed(pressed)
+
+
+def configure(config, folder, fast, staging = False, server = False):
+    from PIL import Image
+
+    config.images_folder = os.path.relpath(os.path.join(folder, "photos"), path)
+    config.images_folder_copy = [os.path.join(folder, "copy1"), os.path.join(folder, "copy2")]
+    config.label_path = os.path.join(folder, "label.jpg")
+    Image.new('RGB', (config.photo_w, config.label_h), (200, 30, 30)).save(config.label_path)
+    config.backup_journal = os.path.join(folder, "backup_journal.jsonl")
+    config.print_history = os.path.join(folder, "print_history.jsonl")
+    config.metrics_file = os.path.join(folder, "metrics.prom")
+    config.gallery_cache_folder = os.path.join(folder, "thumbnails")
+    config.catalog_file = os.path.join(folder, "catalog.sqlite")
+    config.label_cache_file = os.path.join(folder, "label_cache.png")
+    config.staging_journal = os.path.join(folder, "staging_journal.jsonl")
+    config.print_folder = os.path.join(folder, "print")
+    if staging:
+        config.staging_folder = os.path.join(folder, "staging")
+    if server:
+        config.server_enabled = True
+        config.server_port = free_port()
+        config.server_host = "127.0.0.1"
+        config.server_thumbnails_folder = os.path.join(folder, "web_thumbnails")
+
+    if not os.path.exists(config.font_path):
+        fonts = glob.glob("/usr/share/fonts/**/DejaVuSans.ttf", recursive=True) or glob.glob("/usr/share/fonts/**/*.ttf", recursive=True)
+        if fonts:
+            config.font_path = fonts[0]
+
+    if fast:
+        from simulation import cups
+        config.prep_delay = 0.01
+        config.photo_countdown_time = 0
+        cups.filter_time = 0.2
+        cups.print_time = 0.5
+
+
+def free_port():
+    import socket
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def load_clients(url, clients):
+    """
+    Guests which load the gallery page, the thumbnails and the photos in a loop
+    (runs in its own process so that it does not load the photobooth process)
+    """
+    import re
+    import urllib.request
+
+    def client():
+        while True:
+            try:
+                page = urllib.request.urlopen(url, timeout=10).read().decode("utf-8")
+                for name in re.findall(r'src="/thumb/([^"]+)"', page):
+                    urllib.request.urlopen(url + "thumb/" + name, timeout=10).read()
+                    urllib.request.urlopen(url + "download/" + name, timeout=10).read()
+            except OSError:
+                sleep(0.1)
+
+    threads = [threading.Thread(target=client, daemon=True) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def run_scenario(name, sessions, fast, staging, reconfigure_time, result_file):
+    sys.path.insert(0, path)
+    os.chdir(path)
+
+    import simulation
+    simulation.install()
+    from simulation import camera as sim_camera
+    sim_camera.reconfigure_time = reconfigure_time
+
+    import config
+    # photos, journals and the catalog of the run are removed afterwards
+    folder = tempfile.mkdtemp(prefix="photobooth-bench-")
+    try:
+        configure(config, folder, fast, staging, name == "server_load")
+
+        start = monotonic()
+        import photobooth
+        photobooth.startup.wait()
+        startup = monotonic() - start
+
+        timings = Timings()
+        camera = photobooth.camera
+        timings.wrap(camera, "prep_for_photo_screen", "prep")
+        timings.wrap(camera, "overlay_countdown", "countdown")
+        timings.wrap(camera.camera, "capture", "shutter")
+        timings.wrap(camera, "capture", "capture")
+        timings.wrap(camera, "convertMergeImages", "montage")
+        timings.wrap(camera, "save_frames", "save_frames")
+        timings.wrap(camera, "show_image", "show_image")
+        timings.wrap(photobooth.backup, "submit", "backup_submit")
+
+        scenario = Scenario(photobooth, timings, sessions)
+        script = threading.Thread(target=scenario.run, args=(name,), daemon=True)
+        script.start()
+
+        try:
+            photobooth.main()
+        except Exception:
+            # the exit button raises an exception
+            pass
+        script.join(5)
+
+        result = {
+            "scenario": name,
+            "startup": startup,
+            "latencies": scenario.latencies,
+            "phases": timings.phases,
+            "reconfigurations": sum(1 for _, event, _ in camera.camera.events if event == "resolution"),
+            "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        }
+
+        try:
+            photobooth.exit_box()
+        except SystemExit:
+            pass
+        result["metrics"] = open(config.metrics_file).read() if os.path.exists(config.metrics_file) else ""
+
+        with open(result_file, "w") as f:
+            json.dump(result, f)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def mean(values):
+    return sum(values) / len(values) if values else 0.0
+
+
+def report(result):
+    print("== %s (startup %.2fs, peak RSS %.1f MB, %s resolution changes)" % (result["scenario"], result["startup"],
+        result["peak_rss_kb"] / 1024, result["reconfigurations"]))
+    for name, values in sorted(result["latencies"].items()):
+        print("   %-20s mean %7.3fs  max %7.3fs  (%s)" % (name, mean(values), max(values), len(values)))
+    for name, values in sorted(result["phases"].items()):
+        print("   %-20s mean %7.3fs  sum %7.3fs  (%s)" % (name, mean(values), sum(values), len(values)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Photobooth session benchmark with simulated hardware")
+    parser.add_argument("scenarios", nargs="*", default=["single", "multi", "print", "printer_error", "label_removed", "server_load"])
+    parser.add_argument("--sessions", type=int, default=3, help="sessions per scenario")
+    parser.add_argument("--fast", action="store_true", help="no countdown, short prep delay and print times")
+    parser.add_argument("--staging", action="store_true", help="write the session images into a staging folder")
+    parser.add_argument("--reconfigure-time", type=float, default=0, help="simulated seconds per camera resolution change")
+    parser.add_argument("--verbose", action="store_true", help="show the output of the photobooth")
+    parser.add_argument("--json", help="write all results to this file")
+    parser.add_argument("--run", help=argparse.SUPPRESS)
+    parser.add_argument("--load", help=argparse.SUPPRESS)
+    parser.add_argument("--clients", type=int, default=16, help=argparse.SUPPRESS)
+    parser.add_argument("--result", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.load:
+        load_clients(args.load, args.clients)
+        return
+
+    if args.run:
+        run_scenario(args.run, args.sessions, args.fast, args.staging, args.reconfigure_time, args.result)
+        return
+
+    results = []
+    for name in args.scenarios:
+        fd, result_file = tempfile.mkstemp(suffix=".json")
+        os.close(fd)
+        command = [sys.executable, os.path.realpath(__file__), "--run", name, "--result", result_file, "--sessions", str(args.sessions)]
+        if args.fast:
+            command.append("--fast")
+        if args.staging:
+            command.append("--staging")
+        if args.reconfigure_time:
+            command.extend(["--reconfigure-time", str(args.reconfigure_time)])
+        output = None if args.verbose else subprocess.DEVNULL
+        subprocess.call(command, stdout=output, stderr=output)
+
+        if os.path.getsize(result_file) == 0:
+            os.remove(result_file)
+            print("== %s failed (run with --verbose)" % name)
+            continue
+        with open(result_file) as f:
+            result = json.load(f)
+        os.remove(result_file)
+        results.append(result)
+        report(result)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Compare the in-process compositor with the ImageMagick `montage` subprocesses.
+
+usage: benchmark_montage.py [runs] [folder]
+The synthetic frames and results are written to folder (default: a temporary folder).
+"""
+
+from PIL import Image
+from time import perf_counter
+
+import sys
+import os
+import shutil
+import tempfile
+
+from Montage import Montage, MontageImageMagick
+
+
+def create_frames(folder, photo_w, photo_h, label_h, image_count):
+    tile_w = round(photo_w / 2.0) - (2*10)
+    tile_h = round(photo_h / 2.0) - (2*10)
+    frames = []
+    for i in range(1, image_count + 1):
+        filename = os.path.join(folder, "bench_multi_%sof%s.jpg" % (i, image_count))
+        Image.effect_noise((tile_w, tile_h), 64).convert('RGB').save(filename, 'JPEG', quality=90)
+        frames.append(filename)
+    label = os.path.join(folder, "label.jpg")
+    Image.new('RGB', (photo_w, label_h), (200, 30, 30)).save(label, 'JPEG', quality=90)
+    return frames, label
+
+
+def run(montage, frames, filename, label, runs):
+    timings = []
+    for _ in range(runs):
+        start = perf_counter()
+        montage.create(frames, filename, label)
+        timings.append(perf_counter() - start)
+    return min(timings), sum(timings) / len(timings)
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    if len(sys.argv) > 2:
+        folder = sys.argv[2]
+        os.makedirs(folder, exist_ok=True)
+        temporary = False
+    else:
+        folder = tempfile.mkdtemp()
+        temporary = True
+    photo_w, label_h = 1920, 128
+    photo_h = 1280 - label_h
+
+    try:
+        frames, label = create_frames(folder, photo_w, photo_h, label_h, 4)
+        filename = os.path.join(folder, "bench_montage.jpg")
+
+        backends = [("pil", Montage(photo_w, photo_h, label_h))]
+        if shutil.which("montage") is not None:
+            backends.append(("imagemagick", MontageImageMagick(photo_w, photo_h, label_h)))
+        else:
+            print("ImageMagick `montage` not found, skipping subprocess backend")
+
+        for name, montage in backends:
+            best, mean = run(montage, frames, filename, label, runs)
+            print("%-12s best %.3fs  mean %.3fs  (%s runs)" % (name, best, mean, runs))
+    finally:
+        # a given folder is kept (e.g. to look at the montages)
+        if temporary:
+            shutil.rmtree(folder, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -12,9 +12,13 @@ led_print       = 16     # pin that the print led is attached to
 led_dome        = 5      # pin that the big dome led is attached to
 
 relay           = 24     # pin that the relay for enable the printer is connected
+relay_time      = 2      # seconds the relay is closed to switch the printer
 
 # WS2801 LED count
 pixel_count = 14    
+# maximum LED frames per second (the thread only wakes up when the animation changes) and rainbow steps per second
+led_fps = 30
+led_rainbow_speed = 10
 
 # max resolution:
 # v1: 2592x1944
@@ -32,6 +36,27 @@ preview_hflip = True
 # if there should be no label you need to can comment this entry out
 label_path  = "/media/pi/INTENSO/label.jpg"
 label_h     = 128
+# the fitted label is kept in memory and as a local copy (label_cache.png next to photobooth.py unless label_cache_file is set),
+# so the booth keeps the label when the USB stick is removed
+
+# montage backend: "pil" (in-process compositor) or "imagemagick" (montage subprocess)
+montage_backend = "pil"
+montage_jpeg_quality = 90
+
+# keep the captured frames in memory and pass them directly to the montage
+# capture_memory_format: "jpeg" (encoded by the camera) or "rgb" (raw array, no decode needed, needs numpy)
+capture_to_memory = True
+capture_memory_format = "jpeg"
+# write the single frames to disk as well (only the final image otherwise)
+archive_frames = True
+# capture from the video port: no mode switch of the sensor per shot but a lower image quality
+capture_video_port = False
+
+# number of sessions which can wait for the background processing (montage, saving, backups)
+postprocess_queue_size = 2
+
+# memory limit (bytes) of the decoded overlay images (assets)
+asset_cache_size = 32 * 1024 * 1024
 
 # display resolution
 screen_w   = 1024   
@@ -40,9 +65,27 @@ screen_h   = 600
 # number of images for multi shot
 image_count = 4     
 
-# blink speed of dome led
+# layout of the multi shot montage:
+# "grid": montage_columns photos per row
+# "strip": two identical strips with image_count photos side by side (e.g. to cut a 2x6 print)
+# "feature": the first photo large and the others stacked on the right
+# or a template with (x, y, w, h[, frame]) fractions of the photo area, e.g.
+# {"slots": [(0, 0, 0.5, 1), (0.5, 0, 0.5, 0.5), (0.5, 0.5, 0.5, 0.5)], "spacing": 10}
+# montage_spacing: pixels around every photo, label_position: "bottom" or "top"
+montage_layout = "grid"
+montage_columns = 2
+montage_spacing = 10
+label_position = "bottom"
+
+# blink speed of dome led (one blink period in 100ms ticks)
 blink_speed = 8     
 
+# seconds between the printer status checks
+# (fast: right after a print was started, active: while printing, idle: no print job)
+printer_poll_fast = 0.2
+printer_poll_active = 1.0
+printer_poll_idle = 10.0
+
 # number of seconds as users prepare to have photo taken
 prep_delay  = 2             
 
@@ -55,9 +98,88 @@ show_image_time = 60
 # Primary folder to save images to (required):
 images_folder = "photos"
 
+# staging_folder: RAM folder (tmpfs) for the session images, they are flushed to the images_folder in the background
+# and the intermediate files never reach the SD card (None writes into the images_folder directly)
+# staging_keep_sessions: staged copies of the last sessions which stay in RAM (e.g. for printing)
+# the pending flushes are in staging_journal.jsonl next to photobooth.py unless staging_journal is set
+staging_folder = None
+#staging_folder = "/dev/shm/photobooth"
+staging_keep_sessions = 2
+
 # Additional locations where images will be saved to (optional):
 images_folder_copy = ["/home/pi/photos", "/media/pi/INTENSO/photos"]
 
+# backup copies
+# backup_fsync: "file" (fsync every copied file), "idle" (sync when all copies are done), "never"
+backup_fsync = "file"
+backup_checksum = "sha1"
+# retries of a failing copy (a missing destination is retried until it is available again)
+backup_retries = 5
+# maximum seconds between retries
+backup_backoff_max = 60
+
+# free space of the images folder and the backup destinations (checked before every session)
+# storage_min_sessions: below this number of sessions which still fit, the retention policies free space
+# storage_reserve: bytes which are never used, storage_session_size: estimated session size until the first one is written
+# storage_retention: policies in this order, "frames" deletes the frames of the oldest multi sessions (the montages are kept),
+# "sessions" deletes the oldest sessions which are confirmed in another destination ([]: only warn)
+storage_min_sessions = 20
+storage_reserve = 100 * 1024 * 1024
+storage_session_size = 8 * 1024 * 1024
+storage_retention = []
+#storage_retention = ["frames", "sessions"]
+
+# print queue
+# print_copies: copies of every print
+# print_max_active: number of jobs which are sent to CUPS at the same time
+# print_retries: automatic resubmits of an aborted print job
+print_copies = 1
+print_max_active = 2
+print_retries = 2
+
+# print-ready image in the native resolution of the printer (created in the background after the montage)
+# print_page_mm: page size (width, height) in mm, print_rotate: degrees if the printer expects portrait pages
+# print_folder: folder of the print images (not archived), the images of the last print_keep_sessions sessions are kept
+print_prerender = True
+print_page_mm = (148, 100)
+print_dpi = 300
+print_rotate = 0
+print_format = "png"
+print_folder = None
+#print_folder = "/dev/shm/photobooth-print"
+print_keep_sessions = 2
+
+# attract mode: slideshow of the last sessions after gallery_idle_time seconds without activity
+# gallery_interval: seconds per slide, gallery_size: number of cached sessions,
+# gallery_intro_every: the intro is shown after this number of slides (0: never)
+gallery_enabled = True
+gallery_idle_time = 60
+gallery_interval = 5
+gallery_size = 50
+gallery_intro_every = 4
+
+# download server for the guests: gallery of the sessions on http://<booth>:server_port/ (a separate process)
+# server_max_connections: more connections are answered with 503, server_max_transfers: files sent at the same time
+# the thumbnails are in web_thumbnails next to photobooth.py unless server_thumbnails_folder is set
+server_enabled = False
+server_port = 8080
+server_max_connections = 32
+server_max_transfers = 4
+server_thumbnail_size = 400
+
+# sqlite catalog of the sessions, copies and prints (catalog.sqlite next to photobooth.py unless catalog_file is set)
+
+# timing histograms of the session phases
+# metrics_format: "prometheus" (text file for the node exporter textfile collector) or "jsonl" (one snapshot per line)
+# metrics_interval: seconds between the updates of the metrics file
+# the file is metrics.prom next to photobooth.py unless metrics_file is set
+metrics_enabled = True
+metrics_format = "prometheus"
+metrics_interval = 10
+
+# font of the countdown and the printer messages
+font_path = "/usr/share/fonts/dejavu/DejaVuSans.ttf"
+
 lang = {
         "error_printer" : "Drucker Fehler", 
         "printer_started" : "Druck gestartet",
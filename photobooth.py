@@ -1,10 +1,10 @@
 #!/usr/bin/env python3
 
-from time import sleep
 import sys
-import shutil
 import os
+import threading
 import logging
+from time import monotonic
 
 
 # Logging
@@ -21,6 +21,15 @@ try:
     from BoxIO import BoxIO
     from LEDs import LEDs
     from Camera import Camera
+    from PostProcessor import PostProcessor
+    from Backup import Backup
+    from Staging import Staging
+    from Storage import Storage
+    from EventLoop import EventLoop
+    from Metrics import metrics
+    from Startup import Startup
+    from Gallery import ThumbnailCache, Gallery
+    from Catalog import Catalog
     
 except ImportError as missing_module:
     print('--------------------------------------------')
@@ -38,10 +47,31 @@ except ImportError as missing_module:
 
 
 def exit_box():
-    camera.stop()
-    leds.clear()
+    # a failed startup stage leaves its part uninitialized
+    if camera is not None:
+        logger.info('Asset cache: %s', camera.assets.stats())
+        logger.info('Text cache: %s', camera.texts.stats())
+    logger.info('Timings: %s', metrics.summary())
+    if postprocessor is not None:
+        postprocessor.stop()
+    if staging is not None:
+        staging.stop()
+    if storage is not None:
+        storage.stop()
+    if backup is not None:
+        backup.stop()
+    if camera is not None:
+        camera.stop()
+    if leds is not None:
+        leds.stop()
     boxio.trigger_relay()
     boxio.cleanup()
+    if catalog is not None:
+        catalog.close()
+    if server is not None:
+        server.terminate()
+        server.wait(5)
+    metrics.stop()
     sys.exit()
     
     
@@ -58,7 +88,8 @@ def check_folders():
         else:
             print('ERROR: Cannot use same folder path ('+folder+') twice.')
             logger.error('ERROR: Cannot use same folder path (%s) twice.', folder)
-            exit_box()
+            # runs in the storage stage, the startup re-raises it in the main thread
+            raise Exception('Cannot use same folder path (%s) twice.' % folder)
 
         #Create folder if doesn't exist
         if not os.path.exists(folder):
@@ -69,11 +100,47 @@ def check_folders():
             except:
                 print('Error creating folder: %s' % folder)
                 logger.error('Error creating folder %s', folder)
-                
-                
-    # check label path
-    if hasattr(config, "label_path") and not os.path.exists(config.label_path):
-        config.label_path = None
+
+
+def images_written(job):
+    """
+    flush the images from the staging folder to the images folder
+    (called from the post processing thread when the images of a session are written)
+    """
+    staging.submit(job, session_finished)
+
+def session_finished(job):
+    """
+    save photos into backup folder and add the session to the gallery
+    (called when the images of a session are in the images folder)
+    """
+    # the files and the pending copies are in the catalog before the first copy is done
+    catalog.finish_session(job, backup.destinations.keys())
+    backup.submit(job.files)
+    backup.log_stats()
+    storage.session_written(job)
+    
+    if thumbnails is not None and job.final_image is not None:
+        try:
+            # the preview is already screen sized so there is nothing to decode
+            thumbnails.add(job.final_image, job.preview)
+        except Exception as e:
+            logger.error("Error adding %s to the gallery: %s", job.final_image, e)
+
+def backup_copied(item, checksum):
+    catalog.copy_done(item["src"], item["dest"], checksum)
+
+def backup_failed(item, error):
+    catalog.copy_done(item["src"], item["dest"], error=error)
+
+def print_finished(handle):
+    catalog.print_finished(handle)
+
+def printing_files():
+    # the staged files of the queued prints are not deleted by the staging cleanup
+    if boxio.print_queue is None:
+        return set()
+    return set(handle.filename for handle in boxio.print_queue.active())
 
 def intro():
     # intro screen
@@ -81,207 +148,366 @@ def intro():
     return camera.overlay_image(intro_image, 0, 4)
         
 def main():
-    overlay_intro = intro()
+    # the intro is already shown during the startup
+    overlay_intro = startup_intro if startup_intro is not None else intro()
 
-    i = 0
+    processing_overlay = None
     error_overlay = None
     error_message = False
-    while True:
-
-        # LEDs rainbow
-        leds.rainbow_step()
+    image_timer = None
+    print_blink = None
+    printing = False
+    slideshow_timer = None
+    last_activity = monotonic()
+    
+    loop = EventLoop()
+    
+    # one blink period has blink_speed ticks of 100ms
+    blink_interval = config.blink_speed * 0.05
+    
+    def hide_image():
+        # Hide last image? only if not printing
+        if not boxio.print_started():
+            camera.hide_image_if_needed()
+    
+    def preview_ready(job, preview_span):
+        nonlocal overlay_intro, processing_overlay, image_timer
         
-        # Blink the Dome LED
-        i = i+1
-        if i%config.blink_speed == 4:
-            boxio.set_dome_led(True)
-        elif i%config.blink_speed == 0:
-            boxio.set_dome_led(False)
-            
+        # the preview of the session is ready, also if it is not shown any more
+        preview_span.stop()
         
-        # Dome button pressed
-        if boxio.is_dome_pressed():
-            print("Dome pressed")
-            logger.info('Dome pressed')
-            
-            # disable buttons so no new interrupt rises
-            boxio.disable_buttons()
+        # a new session was started in the meantime
+        if job is not camera.current_job:
+            return
+        
+        logger.info('Show montage')
+        if processing_overlay is not None:
+            camera.remove_overlay(processing_overlay)
+            processing_overlay = None
+        
+        # show montage in layer 5
+        camera.show_image()
+        if camera.show_image_time > 0:
+            if image_timer is not None:
+                image_timer.cancel()
+            # small margin so that the show_image_time has passed for sure when checking
+            image_timer = loop.call_later(camera.show_image_time + 0.1, hide_image)
+        
+        # show intro in layer 4
+        overlay_intro = intro()
+    
+    def start_attract_mode():
+        nonlocal slideshow_timer
+        if gallery is None or gallery.is_running():
+            return
+        # only when nothing else is shown
+        if camera.current_job is not None or processing_overlay is not None or printing or error_message:
+            return
+        if monotonic() - last_activity < config.gallery_idle_time:
+            return
+        if gallery.start():
+            logger.info("Start gallery")
+            slideshow_timer = loop.call_every(config.gallery_interval, gallery.show_next)
+    
+    def stop_attract_mode():
+        nonlocal slideshow_timer, last_activity
+        last_activity = monotonic()
+        if slideshow_timer is not None:
+            slideshow_timer.cancel()
+            slideshow_timer = None
+        if gallery is not None and gallery.is_running():
+            gallery.stop()
+            logger.info("Stop gallery")
+    
+    def dome_pressed():
+        nonlocal overlay_intro, processing_overlay, error_overlay, error_message
+        
+        # the event can be posted twice before the buttons are disabled
+        if not boxio.is_dome_pressed():
+            return
+        
+        # first remove the slideshow
+        stop_attract_mode()
+        boxio.observe_press("dome")
+        preview_span = metrics.span("dome_to_preview")
+        
+        print("Dome pressed")
+        logger.info('Dome pressed')
+        
+        # disable buttons so no new interrupt rises
+        boxio.disable_buttons()
+        
+        # remove intro overlay 
+        if overlay_intro is not None:
+            camera.remove_overlay(overlay_intro)
+            overlay_intro = None
+        
+        # the previous session is still processed in the background
+        if processing_overlay is not None:
+            camera.remove_overlay(processing_overlay)
+            processing_overlay = None
             
-            # remove intro overlay 
-            if overlay_intro is not None:
-                camera.remove_overlay(overlay_intro)
-                overlay_intro = None
-                
-            # Print is started despite dome is pressed => there was an error => cancel print job
+        # Dome is pressed while a print job has an error => cancel the print job
+        # (the other print jobs in the queue continue)
+        if error_message:
+            print("Dome is pressed despite print error => cancel print job")
+            logger.warning("Dome is pressed despite print error => cancel print job")
+            boxio.reset_print_pressed()
+            boxio.cancel_print_job()
+            if not error_overlay is None:
+                camera.remove_overlay(error_overlay)
+                error_overlay = None
+            error_message = False
             if boxio.print_started():
-                print("Dome is pressed despite printin in progress => Error?")
-                logger.warning("Dome is pressed despite printin in progress => Error?")
-                boxio.set_print_led(False)
-                boxio.reset_print_pressed()
-                boxio.cancel_print_job()
-                if not error_overlay is None:
-                    camera.remove_overlay(error_overlay)
-                    error_overlay = None
-                error_message = False
-            
-            # create filename with timestamp
-            camera.create_file_name() 
+                error_overlay = camera.overlay_text_as_image(config.lang["printer_started"], 5, 0, 30, 50)
+        
+        # statvfs of the destinations, a low space starts the retention policies in the background
+        if storage.check() == 0:
+            print("No space left for the images")
+            logger.error("No space left for the images")
+        
+        # hide last image (before the filename is created, hide_image resets it)
+        camera.hide_image()
+        
+        # create filename with timestamp
+        camera.create_file_name() 
 
-            # set image mode
-            camera.set_image_mode_multi(boxio.is_image_mode_multi())
-            
-            # flash LEDs
-            leds.show(255,255,255)
-            
-            # hide last image
-            camera.hide_image()
-            
-            image_count = 1
-            if boxio.is_image_mode_multi():
-                image_count = config.image_count
-            
-            # capture 1/image_count images
-            photo_filenames = []
+        # set image mode
+        camera.set_image_mode_multi(boxio.is_image_mode_multi())
+        catalog.start_session(staging.persistent_path(camera.base_filename), boxio.is_image_mode_multi())
+        
+        # flash LEDs
+        leds.flash()
+        
+        image_count = 1
+        if boxio.is_image_mode_multi():
+            image_count = config.image_count
+        
+        # capture 1/image_count images
+        with metrics.span("capture", images=image_count):
             for photo_number in range(1, image_count + 1):
-                    camera.prep_for_photo_screen(photo_number)
-                    fname = camera.capture(photo_number)
-                    photo_filenames.append(fname)
-            
-            # disable flash
-            leds.clear()
-            
-            # do montage
-            logger.info('Do montage')
-            mfname = camera.convertMergeImages()
-            # on a single shot without label the name is identical so skip this
-            if not mfname in photo_filenames:
-                photo_filenames.append(mfname)
-            
-            # save photos into backup folder
-            if hasattr(config, "images_folder_copy") and isinstance(config.images_folder_copy, list):
-                for dest in config.images_folder_copy:
-                    for src in photo_filenames:
-                        print(src + ' -> ' + dest)
-                        logger.info('Copy %s -> %s', src, dest)
-                        try:
-                            shutil.copy2(src, dest)
-                            print("Copied")
-                        except shutil.Error as e:
-                            print("Error: %s" % e)
-                            logger.error('Error: %s ', e)
-                        except IOError as e:
-                            print("Error: %s" % e.strerror)
-                            logger.error('Error: %s ', e.strerror)            
+                camera.prep_for_photo_screen(photo_number)
+                camera.capture(photo_number)
+        
+        # disable flash
+        leds.rainbow()
+        
+        # do montage, save and copy the images in the background
+        logger.info('Do montage')
+        processing_overlay = camera.show_processing()
+        job = camera.create_job()
+        job.on_preview = lambda job: loop.post("preview", job, preview_span)
+        postprocessor.submit(job)
+        
+        # enable buttons
+        boxio.reset_dome_pressed()
+        boxio.enable_buttons()
+    
+    def print_pressed():
+        nonlocal error_overlay, error_message, printing
+        
+        if not boxio.is_print_pressed():
+            return
+        
+        stop_attract_mode()
+        pressed_at = boxio.observe_press("print")
+        
+        # Retry print job 
+        if error_message:
+            print("PRINTER Pressed (again)")
+            logger.debug("PRINTER PRESSED (again)")
+            boxio.cancel_print_job(True)
             
-            # enable buttons
-            boxio.reset_dome_pressed()
-            boxio.enable_buttons()
+            if not error_overlay is None:
+                camera.remove_overlay(error_overlay)
+                error_overlay = camera.overlay_text_as_image(config.lang["printer_started"], 5, 0, 30, 50)
             
-            # show montage in layer 5
-            camera.show_image()
+            error_message = False
             
-            # show intro in layer 4
-            overlay_intro = intro()
-        
-        # Print Button Pressed
-        if boxio.is_print_pressed():
-           
-            # Start print
-            if not boxio.print_started():
-                print("Print pressed")
-                logger.info('Print pressed')
-                # Disable Front User Buttons only so no new photo/print can be triggered
-                boxio.disable_buttons(True)
-                
-                filename = camera.get_image()
-                print_id = boxio.print_image(filename)
-                error_overlay = camera.overlay_text_as_image(config.lang["printer_started"], 5, 0, 30, 50)
+        # Queue print, the buttons stay enabled so that the next guests can go on
+        else:
+            print("Print pressed")
+            logger.info('Print pressed')
             
-            # Retry print job 
-            if error_message:
-                print("PRINTER Pressed (again)")
-                logger.debug("PRINTER PRESSED (again)")
-                boxio.cancel_print_job(True)
-                
-                if not error_overlay is None:
-                    camera.remove_overlay(error_overlay)
+            filename, options, variant = camera.get_print_image()
+            handle = boxio.print_image(filename, options, variant, pressed_at)
+            if handle is not None:
+                catalog.print_queued(staging.persistent_path(camera.current_job.base_filename), handle)
+                printing = True
+                if error_overlay is None:
                     error_overlay = camera.overlay_text_as_image(config.lang["printer_started"], 5, 0, 30, 50)
-                
-                error_message = False
-                
-                # when there was an error the front buttons are enabled => disable them again
-                boxio.disable_buttons(True)
-                
-            boxio.reset_print_pressed()
+                start_print_blinking()
+            
+        boxio.reset_print_pressed()
+    
+    def start_print_blinking():
+        nonlocal print_blink
+        # the print button sets the led so the blinking may have been replaced
+        if print_blink is None or not print_blink.is_active():
+            print_blink = boxio.blink_print_led(blink_interval)
+    
+    def stop_print_blinking():
+        nonlocal print_blink
+        if print_blink is not None:
+            print_blink.cancel()
+            print_blink = None
+    
+    def printer_changed():
+        nonlocal error_overlay, error_message, printing
         
         # Currently printing
-        if boxio.print_started():
-            
-            # Print has errors      
-            error = boxio.has_print_error()
-            if not error == False and error_message == False:
-                print("PRINT ERROR")
-                logger.debug("PRINT ERROR")
-                logger.debug(error)
-                if not error_overlay is None:
-                    camera.remove_overlay(error_overlay)
-                    
-                if "ribbon" in error.lower():
-                    message = config.lang["error_ribbon"]
-                elif "paper" in error.lower():
-                    message = config.lang["error_paper"]
-                else:
-                    message = config.lang["error_printer"]
-                error_overlay = camera.overlay_text_as_image(message, 5, 0, 30, 50)
-                error_message = True
-                
-                # Enable front buttons so that we can make a new photo
-                boxio.enable_buttons(True)
+        if not printing:
+            return
             
-            # Print finished
-            if boxio.printed():
-                print("PRINT FINISHED")
-                logger.debug("PRINT FINISHED")
-                boxio.set_print_led(False)
-
-                if not error_overlay is None:
-                    camera.remove_overlay(error_overlay)
-                    error_overlay = None
-                
-                error_message = False
-                boxio.enable_buttons(True)
+        # Print has errors      
+        error = boxio.has_print_error()
+        if not error == False and error_message == False:
+            print("PRINT ERROR")
+            logger.debug("PRINT ERROR")
+            logger.debug(error)
+            if not error_overlay is None:
+                camera.remove_overlay(error_overlay)
                 
+            if "ribbon" in error.lower():
+                message = config.lang["error_ribbon"]
+            elif "paper" in error.lower():
+                message = config.lang["error_paper"]
             else:
-                # Blink the Print LED
-                if i%config.blink_speed == 4:
-                    boxio.set_print_led(True)
-                elif i%config.blink_speed == 0:
-                    boxio.set_print_led(False)
-        else:
-            # Hide last image? only if not printing
-            camera.hide_image_if_needed()
+                message = config.lang["error_printer"]
+            error_overlay = camera.overlay_text_as_image(message, 5, 0, 30, 50)
+            error_message = True
+        
+        # All print jobs finished
+        if boxio.printed():
+            print("PRINT FINISHED")
+            logger.debug("PRINT FINISHED")
+            printing = False
+            stop_print_blinking()
+            boxio.set_print_led(False)
+
+            if not error_overlay is None:
+                camera.remove_overlay(error_overlay)
+                error_overlay = None
+            
+            error_message = False
             
+            # the image was kept while printing
+            hide_image()
+    
+    def exit_pressed():
+        print("Exit pressed")
+        logger.info('Exit pressed')
+        raise Exception('Exit Button pressed')
+    
+    # timed tasks
+    boxio.blink_dome_led(blink_interval)
+    leds.rainbow()
+    if gallery is not None:
+        loop.call_every(1, start_attract_mode)
+    
+    # buttons and background workers post events
+    loop.on("dome", dome_pressed)
+    loop.on("print", print_pressed)
+    loop.on("exit", exit_pressed)
+    loop.on("preview", preview_ready)
+    loop.on("printer", printer_changed)
+    boxio.set_event_loop(loop)
+    
+    loop.run()
 
-        # Exit Button pressed
-        if boxio.is_exit_pressed():
-            print("Exit pressed")
-            logger.info('Exit pressed')
-            raise Exception('Exit Button pressed')
 
-        sleep(0.1)
+def start_camera():
+    global camera, startup_intro
+    camera = Camera(config)
+    # the print images of the queued prints are not deleted by the cleanup
+    camera.print_renderer.in_use = printing_files
+    # the intro is shown as soon as the camera is ready, the rest is rendered afterwards
+    startup_intro = intro()
+    # the printer messages are rendered before they are needed
+    camera.prepare(config.lang.values(), 0, 30, 50)
 
+def start_printer():
+    boxio.start_printer(config)
+    boxio.print_queue.on_finished = print_finished
 
-        
-# check folder existence
-check_folders()
+def start_leds():
+    global leds
+    leds = LEDs(0,0,config.pixel_count, config=config)
+
+def start_storage():
+    global backup, catalog, staging, storage
+    # check folder existence
+    check_folders()
+    images_folder = os.path.dirname(os.path.realpath(__file__)) + '/' + config.images_folder
+    # images which were not flushed before the last shutdown are flushed first
+    staging = Staging(images_folder, config)
+    staging.in_use = printing_files
+    catalog = Catalog(config)
+    backup = Backup(config, backup_copied, backup_failed)
+    storage = Storage(images_folder, catalog, backup, staging, config)
+    # the images of interrupted sessions which were flushed by the staging
+    backup.submit(staging.recovered)
+    storage.check()
+    storage.log_status()
+
+def start_postprocessor():
+    global postprocessor
+    # the session images are journaled as soon as they are in the staging folder
+    camera.on_written = staging.written
+    postprocessor = PostProcessor(camera, config, images_written)
+
+def start_server():
+    global server
+    if not hasattr(config, "server_enabled") or not config.server_enabled:
+        return
+    # asyncio and the http modules are only loaded when the server is enabled
+    import GalleryServer
+    # the download server for the guests runs in its own process
+    server = GalleryServer.spawn(config, os.path.dirname(os.path.realpath(__file__)) + '/' + config.images_folder)
 
+def start_gallery():
+    global thumbnails, gallery
+    if not hasattr(config, "gallery_enabled") or not config.gallery_enabled:
+        return
+    thumbnails = ThumbnailCache(config.screen_w, config.screen_h, config)
+    gallery = Gallery(camera.camera, thumbnails, config)
+    # the missing thumbnails of older sessions are created in the background
+    threading.Thread(target=thumbnails.scan, args=(camera.get_path() + '/' + config.images_folder,), daemon=True).start()
+
+
+metrics.configure(config)
+metrics.start()
+
+camera = None
+startup_intro = None
+leds = None
+postprocessor = None
+backup = None
+catalog = None
+staging = None
+storage = None
+thumbnails = None
+gallery = None
+server = None
+
+# the GPIO setup is fast and needed by the printer stage
 boxio = BoxIO(config)
-leds = LEDs(0,0,config.pixel_count)
-camera = Camera(config)
+
+# camera, printer (relay and CUPS), LEDs and storage are initialized in parallel
+startup = Startup()
+startup.stage("camera", start_camera)
+startup.stage("printer", start_printer)
+startup.stage("leds", start_leds)
+startup.stage("storage", start_storage)
+startup.stage("server", start_server, after=("storage",))
+startup.stage("postprocessor", start_postprocessor, after=("camera", "storage"))
+startup.stage("gallery", start_gallery, after=("camera", "storage"))
         
         
 if __name__ == "__main__":
     try:
+        # a failed stage is re-raised here so that the started parts are cleaned up
+        startup.wait()
         main()
 
     except KeyboardInterrupt:
@@ -0,0 +1,27 @@
+"""
+Simulated hardware backends so that the photobooth can run without a Raspberry Pi.
+
+install() registers fake `picamera`, `RPi.GPIO`, `cups` and `Adafruit_GPIO.SPI` modules
+which must happen before BoxIO, Camera or LEDs are imported.
+"""
+
+import sys
+
+from simulation import camera, gpio, cups, spi
+
+
+def install():
+    sys.modules["picamera"] = camera
+    sys.modules["picamera.array"] = camera.array
+
+    rpi = type(sys)("RPi")
+    rpi.GPIO = gpio
+    sys.modules["RPi"] = rpi
+    sys.modules["RPi.GPIO"] = gpio
+
+    sys.modules["cups"] = cups
+
+    adafruit = type(sys)("Adafruit_GPIO")
+    adafruit.SPI = spi
+    sys.modules["Adafruit_GPIO"] = adafruit
+    sys.modules["Adafruit_GPIO.SPI"] = spi
@@ -0,0 +1,135 @@
+"""
+Fake `picamera` module: PiCamera writes synthetic frames and keeps the overlays in memory
+"""
+
+from PIL import Image
+from time import sleep, monotonic
+
+import collections
+import io
+import sys
+import threading
+
+PiResolution = collections.namedtuple("PiResolution", ["width", "height"])
+
+# seconds the sensor needs for one capture
+capture_time = 0.2
+# seconds a resolution change needs to restart the pipeline, 0 by default because
+# the real cost depends on the camera module and is not measured here
+# (the benchmark counts the resolution changes and can set it with --reconfigure-time)
+reconfigure_time = 0
+
+
+class PiRGBArray:
+    def __init__(self, camera, size = None):
+        self.camera = camera
+        self.size = size
+        self.array = None
+
+
+array = type(sys)("picamera.array")
+array.PiRGBArray = PiRGBArray
+
+
+class PiOverlay:
+    def __init__(self, source, size, format, layer, alpha, window):
+        self.size = size
+        self.format = format
+        self.layer = layer
+        self.alpha = alpha
+        self.window = window
+        self.updates = 0
+        self.update(source)
+
+    def update(self, source):
+        self.bytes = len(source)
+        self.updates += 1
+
+
+class PiPreview:
+    def __init__(self, resolution, hflip):
+        self.resolution = resolution
+        self.hflip = hflip
+        self.alpha = 255
+
+
+class PiCamera:
+    """
+    Records every call in events as (time, name, details)
+    """
+
+    def __init__(self):
+        self._resolution = PiResolution(1920, 1080)
+        self.hflip = False
+        self.annotate_text = ''
+        self.annotate_text_size = 32
+        self.preview = None
+        self.overlays = []
+        self.events = []
+        self.lock = threading.Lock()
+        self.frames = {}
+        self.closed = False
+
+    def record(self, name, details = None):
+        with self.lock:
+            self.events.append((monotonic(), name, details))
+
+    @property
+    def resolution(self):
+        return self._resolution
+
+    @resolution.setter
+    def resolution(self, value):
+        # setting the resolution restarts the camera pipeline (even for the same value)
+        sleep(reconfigure_time)
+        self._resolution = PiResolution(*value)
+        self.record("resolution", value)
+
+    def start_preview(self, resolution = None, hflip = False, **options):
+        self.preview = PiPreview(resolution, hflip)
+
+    def stop_preview(self):
+        self.preview = None
+
+    def add_overlay(self, source, size = None, format = None, layer = 0, alpha = 255, fullscreen = True, window = None, **options):
+        overlay = PiOverlay(source, size, format, layer, alpha, window)
+        self.overlays.append(overlay)
+        self.record("add_overlay", size)
+        return overlay
+
+    def remove_overlay(self, overlay):
+        self.overlays.remove(overlay)
+        self.record("remove_overlay", overlay.size)
+
+    def frame(self, size):
+        """
+        Synthetic frame (cached per size)
+        """
+        if not size in self.frames:
+            img = Image.radial_gradient('L').resize(size).convert('RGB')
+            jpeg = io.BytesIO()
+            img.save(jpeg, 'JPEG', quality=90)
+            self.frames[size] = (img, jpeg.getvalue())
+        return self.frames[size]
+
+    def capture(self, output, format = None, resize = None, use_video_port = False, **options):
+        size = tuple(resize) if resize is not None else tuple(self._resolution)
+        img, jpeg = self.frame(size)
+        sleep(capture_time)
+
+        if isinstance(output, PiRGBArray):
+            import numpy as np
+            output.array = np.asarray(img)
+        elif isinstance(output, str):
+            with open(output, 'wb') as f:
+                f.write(jpeg)
+        else:
+            output.write(jpeg)
+        self.record("capture", size)
+
+    def capture_sequence(self, outputs, format = 'jpeg', resize = None, use_video_port = False, **options):
+        for output in outputs:
+            self.capture(output, format, resize, use_video_port)
+
+    def close(self):
+        self.closed = True
@@ -0,0 +1,137 @@
+"""
+Fake `cups` module: an in-memory print server shared by all connections.
+Jobs are pending for filter_time seconds and processing for print_time seconds.
+errors is a list of printer messages, the next jobs stop with these messages
+until the printer is enabled again.
+"""
+
+from time import monotonic
+
+import itertools
+import os
+import threading
+
+IPP_PRINTER_IDLE        = 3
+IPP_PRINTER_PROCESSING  = 4
+IPP_PRINTER_STOPPED     = 5
+IPP_NOT_FOUND           = 1030
+IPP_OPERATION_NOT_SUPPORTED = 1281
+
+filter_time = 0.5
+print_time  = 2.0
+errors      = []
+
+user        = None
+printer     = "Canon_SELPHY"
+printer_state = IPP_PRINTER_IDLE
+printer_message = ""
+jobs        = {}
+submitted   = []        # (time, job id, file, options)
+lock        = threading.Lock()
+ids         = itertools.count(1)
+
+
+class IPPError(Exception):
+    pass
+
+
+def setUser(name):
+    global user
+    user = name
+
+
+def update():
+    # must be called with the lock
+    global printer_state, printer_message
+    now = monotonic()
+    for job in jobs.values():
+        if job["job-state"] == 3 and now >= job["ready_at"]:
+            if job["error"] is not None:
+                job["job-state"] = 6
+                job["job-printer-state-message"] = job["error"]
+                printer_state = IPP_PRINTER_STOPPED
+                printer_message = job["error"]
+            else:
+                job["job-state"] = 5
+                job["done_at"] = now + print_time
+        if job["job-state"] == 5 and now >= job["done_at"]:
+            job["job-state"] = 9
+            job["job-printer-state-message"] = ""
+
+
+class Connection:
+
+    def getDefault(self):
+        return printer
+
+    def enablePrinter(self, name):
+        global printer_state, printer_message
+        with lock:
+            if printer_state == IPP_PRINTER_STOPPED:
+                printer_state = IPP_PRINTER_IDLE
+                printer_message = ""
+            now = monotonic()
+            for job in jobs.values():
+                if job["job-state"] == 6:
+                    job["job-state"] = 5
+                    job["error"] = None
+                    job["done_at"] = now + print_time
+
+    def acceptJobs(self, name):
+        pass
+
+    def cancelAllJobs(self, name = None):
+        with lock:
+            for job in jobs.values():
+                if job["job-state"] < 7:
+                    job["job-state"] = 7
+
+    def printFile(self, name, filename, title, options):
+        if not os.path.exists(filename):
+            raise IPPError(IPP_NOT_FOUND, "No such file")
+        with lock:
+            job_id = next(ids)
+            jobs[job_id] = {
+                "job-id": job_id,
+                "job-state": 3,
+                "job-printer-state-message": "",
+                "ready_at": monotonic() + filter_time,
+                "done_at": None,
+                "error": errors.pop(0) if errors else None,
+            }
+            submitted.append((monotonic(), job_id, filename, dict(options)))
+        return job_id
+
+    def getJobs(self, which_jobs = "not-completed", **options):
+        with lock:
+            update()
+            return {job_id: {"job-state": job["job-state"]} for job_id, job in jobs.items() if job["job-state"] < 7}
+
+    def getJobAttributes(self, job_id, requested_attributes = None):
+        with lock:
+            update()
+            if not job_id in jobs:
+                raise IPPError(IPP_NOT_FOUND, "Job not found")
+            return dict(jobs[job_id])
+
+    def getPrinterAttributes(self, name = None, requested_attributes = None):
+        with lock:
+            update()
+            return {"printer-state": printer_state, "printer-state-message": printer_message}
+
+    def cancelJob(self, job_id, purge_job = False):
+        with lock:
+            if job_id in jobs:
+                jobs[job_id]["job-state"] = 7
+
+    def setJobHoldUntil(self, job_id, hold):
+        with lock:
+            if job_id in jobs and jobs[job_id]["job-state"] == 4 and hold == "no-hold":
+                jobs[job_id]["job-state"] = 3
+
+    def createSubscription(self, uri, events = None, lease_duration = None, **options):
+        # like a server without ippget notifications => the monitor polls
+        raise IPPError(IPP_OPERATION_NOT_SUPPORTED, "Subscriptions not supported")
+
+    def cancelSubscription(self, subscription_id):
+        pass
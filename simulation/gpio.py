@@ -0,0 +1,78 @@
+"""
+Fake `RPi.GPIO` module. press(pin) runs the registered callback like a falling edge.
+"""
+
+import threading
+
+BCM     = 11
+BOARD   = 10
+IN      = 1
+OUT     = 0
+HIGH    = 1
+LOW     = 0
+PUD_UP  = 22
+PUD_DOWN = 21
+FALLING = 32
+RISING  = 31
+BOTH    = 33
+
+mode = None
+pins = {}           # pin => output level
+callbacks = {}      # pin => callback
+outputs = []        # (pin, level) history
+lock = threading.Lock()
+
+
+def setmode(new_mode):
+    global mode
+    mode = new_mode
+
+
+def setwarnings(flag):
+    pass
+
+
+def setup(pin, direction, pull_up_down = None, initial = None):
+    with lock:
+        pins[pin] = initial if initial is not None else (HIGH if pull_up_down == PUD_UP else LOW)
+
+
+def output(pin, level):
+    with lock:
+        pins[pin] = int(bool(level))
+        outputs.append((pin, pins[pin]))
+
+
+def input(pin):
+    with lock:
+        return pins.get(pin, LOW)
+
+
+def add_event_detect(pin, edge, callback = None, bouncetime = None):
+    with lock:
+        if pin in callbacks:
+            raise RuntimeError("Conflicting edge detection already enabled for this GPIO channel")
+        callbacks[pin] = callback
+
+
+def remove_event_detect(pin):
+    with lock:
+        callbacks.pop(pin, None)
+
+
+def press(pin):
+    """
+    Simulate a button press, returns False if the button is disabled
+    """
+    with lock:
+        callback = callbacks.get(pin)
+    if callback is None:
+        return False
+    callback(pin)
+    return True
+
+
+def cleanup():
+    with lock:
+        callbacks.clear()
+
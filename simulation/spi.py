@@ -0,0 +1,40 @@
+"""
+Fake `Adafruit_GPIO.SPI` module without hardware
+"""
+
+MSBFIRST = 0
+LSBFIRST = 1
+
+
+class NullSPI:
+    """
+    SPI device without hardware, keeps the last written frame
+    """
+
+    def __init__(self):
+        self.frames = 0
+        self.last = None
+
+    def write(self, data):
+        self.frames += 1
+        self.last = bytes(data)
+
+    def close(self):
+        pass
+
+
+class SpiDev(NullSPI):
+
+    def __init__(self, port, device, max_speed_hz = 500000):
+        NullSPI.__init__(self)
+        self.port = port
+        self.device = device
+
+    def set_mode(self, mode):
+        pass
+
+    def set_bit_order(self, order):
+        pass
+
+    def set_clock_hz(self, hz):
+        pass